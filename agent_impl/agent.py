@@ -1,11 +1,30 @@
+import asyncio
 from spade.agent import Agent
-from spade.template import Template
-from agent_impl.behaviour.alive import CheckAgentAlive, RequestAlive, ReplyAlive
+from spade.behaviour import FSMBehaviour
+from agent_impl.behaviour.alive import CheckAgentAlive, handle_heartbeat, handle_request_alive
 from agent_impl.behaviour.balancing import BalancingBehaviour
-from agent_impl.behaviour.transfer import TransferRequestBehaviour, TransferConfirmBehaviour, TransferConfirmErrorBehaviour
-from agent_impl.behaviour.time import TimeRequestBehaviour, TimeReplyBehaviour, TimeReplyErrorBehaviour
-from common.plan_load_save import save_plan_to_file, load_plan_from_file
-from common.get_time import get_time
+from agent_impl.behaviour.dispatcher import MessageDispatcher
+from agent_impl.behaviour.transfer import handle_transfer_request, handle_transfer_confirm, handle_transfer_confirm_error
+from agent_impl.behaviour.swap import handle_swap_request, handle_swap_proposal, handle_swap_reject
+from agent_impl.behaviour.hierarchy import CoordinatorBehaviour, handle_group_poll, handle_group_load, \
+    handle_balance_order, handle_group_summary, group_coordinator
+from agent_impl.behaviour.ingest import handle_task_assign, handle_task_assign_confirm
+from agent_impl.behaviour.termination import TerminationBehaviour, handle_termination_token, \
+    handle_termination_ack, handle_terminate
+from agent_impl.behaviour.time import handle_time_request, handle_time_reply, handle_time_reply_error
+from agent_impl.membership import Membership
+from agent_impl.peer_loads import PeerLoadCache
+from agent_impl.plan import Plan
+from agent_impl.session import NegotiationSession
+from common.plan_journal import PlanJournal
+from common.plan_load_save import load_plan_from_file, load_snapshot, journal_path, catalog_path
+from common.plan_writer import PlanWriter
+from common.task_catalog import load_catalog
+from common.specializations import spec_mask
+from common.event_log import get_log
+from common.metrics import MetricsRegistry
+
+log = get_log("SETUP")
 
 # logging.basicConfig(
 #     level=logging.DEBUG,
@@ -14,80 +33,325 @@ from common.get_time import get_time
 
 
 class WorkerAgent(Agent):
-    def __init__(self, jid, password, plan_file, other_agents=None, specializations = None, my_total_task_time = None):
+    def __init__(self, jid, password, plan_file, other_agents=None, specializations = None, my_total_task_time = None,
+                 transport=None):
         super().__init__(jid, password)
         self.COMMUNICATION_INTERVAL = 5
         self.BALANCE_THRESHOLD = 0.15
-        self.transfer_object = None
-        self.neighbor_choice = None
+        # После BALANCE_BACKOFF_AFTER раундов подряд без передачи пауза между раундами удваивается
+        # до COMMUNICATION_INTERVAL * BALANCE_BACKOFF_LIMIT (и расходует попытки за пропущенные раунды);
+        # пауза случайно укорачивается до BALANCE_JITTER, чтобы агенты не просыпались одновременно
+        self.BALANCE_BACKOFF_AFTER = 6
+        self.BALANCE_BACKOFF_LIMIT = 8
+        self.BALANCE_JITTER = 0.25
+        # Пакет передачи: не больше TRANSFER_BATCH_LIMIT задач, точность подбора суммы - SUBSET_SUM_EPSILON
+        self.TRANSFER_BATCH_LIMIT = 32
+        self.SUBSET_SUM_EPSILON = 0.01
+        # Если пакет не подобрать, соседу предлагается обмен из SWAP_CANDIDATES самых мелких задач
+        self.SWAP_CANDIDATES = 16
+        # Одновременно идут переговоры не больше чем с NEGOTIATION_SESSIONS соседями;
+        # сессия без продвижения дольше SESSION_TIMEOUT секунд закрывается
+        self.NEGOTIATION_SESSIONS = 4
+        self.SESSION_TIMEOUT = self.COMMUNICATION_INTERVAL * 6
+        self.sessions = {}  # thread -> NegotiationSession
+        # ID задач незавершенных передач (prepare без commit/abort): второй раз их не предлагаем
+        self.reserved = set()
+        self.reserved_time = 0.0
+        # Трудозатраты соседей из метаданных их сообщений, считаются свежими LOAD_CACHE_TTL секунд
+        self.LOAD_CACHE_TTL = self.COMMUNICATION_INTERVAL * 3
+        self.peer_loads = PeerLoadCache(self.LOAD_CACHE_TTL)
+        self.dispatcher = None
+        self.balancer = None
         self.my_total_task_time = my_total_task_time
         self.plan_file = plan_file
-        self.other_agents = other_agents if other_agents else []
+        # Соседи: [jid, специализации, маска специализаций]
+        self.other_agents = [[info[0], info[1], spec_mask(info[1])] for info in other_agents or []]
+        # Детектор отказов: сигнал жизни - обычные сообщения соседа; heartbeat раз в HEARTBEAT_INTERVAL
+        # секунд получает только напарник, от которого ждем ответа и который столько же молчит.
+        # Сосед, не ответивший на heartbeat или с phi > PHI_THRESHOLD, пока ждем его ответа,
+        # не выбирается до первого своего сообщения
+        self.HEARTBEAT_INTERVAL = self.COMMUNICATION_INTERVAL * 2
+        self.PHI_THRESHOLD = 5
+        self.membership = Membership(self.PHI_THRESHOLD, self.HEARTBEAT_INTERVAL, self.HEARTBEAT_INTERVAL,
+                                     probe_timeout=self.HEARTBEAT_INTERVAL)
         self.specializations = specializations if specializations else []
-        self.plan = []
+        self.spec_mask = spec_mask(self.specializations)
+        self.plan = Plan()
+        # Общий каталог задач: план, сообщения и файлы ссылаются на задачи по ID
+        self.catalog = load_catalog(catalog_path(plan_file))
+        # Изменения плана сохраняются не чаще раза в SAVE_DELAY секунд, в фоновом потоке
+        self.SAVE_DELAY = 1.0
+        # Журнал передач: после сбоя план восстанавливается по снимку и хвосту журнала,
+        # сжимается не чаще, чем раз в JOURNAL_COMPACT_EVERY записей
+        self.JOURNAL_COMPACT_EVERY = 100
+        self.journal = PlanJournal(journal_path(plan_file), self.catalog, self.JOURNAL_COMPACT_EVERY)
+        self.plan_writer = PlanWriter(plan_file, lambda: self.plan.to_list(), self.SAVE_DELAY, self.journal)
         self.attempts_to_balancing = 20
-
+        # False - сбалансированный агент не останавливается, а ждет новых задач (прием задач, ingest.py)
+        self.STOP_WHEN_BALANCED = True
+        self.INGEST_POLL_INTERVAL = 1.0
+        self.ingest = None  # IngestBehaviour на агенте, который принимает новые задачи
+        # Иерархическая балансировка (join_group): переносы назначает координатор группы, раз в
+        # COMMUNICATION_INTERVAL; изменившуюся сводку группы получают GROUP_SUMMARY_FANOUT координаторов других групп.
+        # Координатор без переносов HIERARCHY_IDLE_CYCLES периодов и член группы без поручений столько же
+        # раундов исчерпывают попытки
+        self.HIERARCHY_IDLE_CYCLES = 3
+        self.GROUP_SUMMARY_FANOUT = 2
+        self.groups = None  # [[jid, ...], ...] - все группы
+        self.group_index = None
+        self.group = None  # члены своей группы: [jid, специализации, маска], jid по возрастанию
+        self.coordinator = None
+        self.coordinated_until = None  # до этого времени агент ждет первого сообщения координатора
+        # Глобальное завершение (termination.py): ring - jid всех агентов системы. Без ring агент
+        # останавливается сам, как только у него кончились попытки; волна маркера без ответа дольше
+        # TERMINATION_WAVE_TIMEOUT секунд повторяется
+        self.ring = None
+        self.TERMINATION_WAVE_TIMEOUT = self.HEARTBEAT_INTERVAL * 6
+        self.termination = None
+        self.terminated = False  # остановлен по обнаружении глобального завершения
+        # Счетчики сообщений и передач, задержки запрос-ответ, текущая нагрузка (см. common/metrics.py)
+        self.metrics = MetricsRegistry(agent=str(jid))
+        self.metrics.gauge("load", lambda: self.my_total_task_time or 0.0)
+        self.metrics.gauge("plan_tasks", lambda: len(self.plan))
+        self.metrics.gauge("pending_transfers", lambda: len(self.journal.pending))
+        self.metrics.gauge("sessions", lambda: len(self.sessions))
+        self.metrics.gauge("peers_suspected", lambda: len(self.membership.suspected()))
+        self.metrics.gauge("attempts_left", lambda: self.attempts_to_balancing)
+        self.metrics.gauge("plan_writes", lambda: self.plan_writer.writes)
+        # Балансировка начинается, когда запущены все агенты (см. agent_impl/startup.py)
+        self.ready = asyncio.Event()
+        # None - обмен через XMPP-сервер, иначе локальная шина (например, LocalBus для симуляции)
+        self.transport = transport
+        if self.transport is not None:
+            self.transport.register(self)
 
     async def setup(self):
         self.load_plan()
-        print(
-            f"{get_time()} [SETUP] {self.jid} запущен."
-            f" Начальное время на выполнение всех задач: {self.my_total_task_time}, файл: {self.plan_file}")
-
-        # Шаблоны для различных типов сообщений
-        request_agent_alive = Template()
-        request_agent_alive.set_metadata("type", "request_alive")
-        replay_agent_alive = Template()
-        replay_agent_alive.set_metadata("type", "replay_alive")
-        time_request_template = Template()
-        time_request_template.set_metadata("type", "time_request")
-        time_reply_template = Template()
-        time_reply_template.set_metadata("type", "time_reply")
-        time_reply_error_template = Template()
-        time_reply_error_template.set_metadata("type", "time_reply_error")
-        transfer_request_template = Template()
-        transfer_request_template.set_metadata("type", "transfer_request")
-        transfer_confirm_template = Template()
-        transfer_confirm_template.set_metadata("type", "transfer_confirm")
-        transfer_confirm_error_template = Template()
-        transfer_confirm_error_template.set_metadata("type", "transfer_confirm_error")
+        log.info(self, "запущен. Начальное время на выполнение всех задач: %s, файл: %s",
+                 self.my_total_task_time, self.plan_file)
 
         # Добавляем поведения
-        self.add_behaviour(CheckAgentAlive(period=self.COMMUNICATION_INTERVAL * 5.5))
-        self.add_behaviour(RequestAlive(), template=request_agent_alive)
-        self.add_behaviour(ReplyAlive(), template=replay_agent_alive)
-
-        self.add_behaviour(BalancingBehaviour(period=self.COMMUNICATION_INTERVAL))
-        self.add_behaviour(TimeRequestBehaviour(), template=time_request_template)
-        self.add_behaviour(TimeReplyBehaviour(), template=time_reply_template)
-        self.add_behaviour(TimeReplyErrorBehaviour(), template=time_reply_error_template)
-        self.add_behaviour(TransferRequestBehaviour(), template=transfer_request_template)
-        self.add_behaviour(TransferConfirmBehaviour(), template=transfer_confirm_template)
-        self.add_behaviour(TransferConfirmErrorBehaviour(), template=transfer_confirm_error_template)
+        self.add_behaviour(CheckAgentAlive(period=self.HEARTBEAT_INTERVAL))
+        self.balancer = BalancingBehaviour()
+        self.add_behaviour(self.balancer)
+        if self.ingest is not None:
+            self.add_behaviour(self.ingest)
+        if self.group is not None:
+            self.coordinator = CoordinatorBehaviour(period=self.COMMUNICATION_INTERVAL)
+            self.add_behaviour(self.coordinator)
+        if self.ring is not None and self.STOP_WHEN_BALANCED:
+            self.termination = TerminationBehaviour(self.ring, period=self.COMMUNICATION_INTERVAL)
+            self.add_behaviour(self.termination)
+
+        # Все входящие сообщения разбирает одно поведение по типу сообщения
+        self.dispatcher = MessageDispatcher({
+            "heartbeat": handle_heartbeat,
+            "request_alive": handle_request_alive,
+            "time_request": handle_time_request,
+            "time_reply": handle_time_reply,
+            "time_reply_error": handle_time_reply_error,
+            "transfer_request": handle_transfer_request,
+            "transfer_confirm": handle_transfer_confirm,
+            "transfer_confirm_error": handle_transfer_confirm_error,
+            "swap_request": handle_swap_request,
+            "swap_proposal": handle_swap_proposal,
+            "swap_reject": handle_swap_reject,
+            "task_assign": handle_task_assign,
+            "task_assign_confirm": handle_task_assign_confirm,
+            "group_poll": handle_group_poll,
+            "group_load": handle_group_load,
+            "balance_order": handle_balance_order,
+            "group_summary": handle_group_summary,
+            "termination_token": handle_termination_token,
+            "termination_ack": handle_termination_ack,
+            "terminate": handle_terminate,
+        })
+        self.add_behaviour(self.dispatcher)
+
+    async def _async_start(self, auto_register=True):
+        if self.transport is None:
+            return await super()._async_start(auto_register=auto_register)
+
+        # Локальная шина: без подключения к серверу и без presence
+        await self.setup()
+        self._alive.set()
+        for behaviour in self.behaviours:
+            if not behaviour.is_running:
+                behaviour.set_agent(self)
+                if issubclass(type(behaviour), FSMBehaviour):
+                    for _, state in behaviour.get_states().items():
+                        state.set_agent(self)
+                behaviour.start()
+
+    async def _async_stop(self):
+        # Несохраненные изменения плана записываются до остановки поведений
+        await self.flush_plan()
+        await self.journal.close()
+        if self.transport is None:
+            return await super()._async_stop()
+
+        for behaviour in self.behaviours:
+            behaviour.kill()
+        self._alive.clear()
+
+    def dispatch(self, msg):
+        self.peer_loads.update_from_message(msg)
+        # Любое сообщение соседа - сигнал, что он жив
+        sender = str(msg.sender).split('/')[0]
+        if self.membership.heard(sender):
+            self.metrics.inc("peer_rejoined_total")
+            log.info(self, "сосед %s снова на связи", sender)
+        if self.termination is not None:
+            self.termination.received(msg)
+        if self.dispatcher is None:
+            return super().dispatch(msg)
+        # Без перебора шаблонов всех поведений: сообщение сразу в очередь диспетчера
+        self.dispatcher.queue.put_nowait(msg)
+        return []
+
+    def join_group(self, groups, index):
+        """Иерархическая балансировка в группе groups[index] (члены группы должны быть среди соседей)"""
+        self.groups, self.group_index = groups, index
+        known = {info[0]: info for info in self.other_agents}
+        known[str(self.jid)] = [str(self.jid), self.specializations, self.spec_mask]
+        self.group = [known[jid] for jid in groups[index]]
+
+    def group_coordinator(self):
+        """Координатор своей группы, None - балансировка не иерархическая"""
+        if self.group is None:
+            return None
+        return group_coordinator(self, self.groups[self.group_index])
+
+    def coordinated(self):
+        """Переносы назначает координатор группы (coordinator_heard).
+
+        Координатора, который молчит с самого начала дольше COMMUNICATION_INTERVAL * 4,
+        агент не ждет и балансирует попарными переговорами, пока не услышит его.
+        """
+        if self.group is None:
+            return False
+        if self.coordinator_heard():
+            return True
+        now = asyncio.get_running_loop().time()
+        if self.coordinated_until is None:
+            self.coordinated_until = now + self.COMMUNICATION_INTERVAL * 4
+        return now < self.coordinated_until
+
+    def coordinator_heard(self):
+        """Координатор группы - сам агент или уже отвечал ему"""
+        coordinator = self.group_coordinator()
+        return coordinator == str(self.jid) or self.membership.last_heard(coordinator) is not None
+
+    def passive(self):
+        """Агент сам не начнет переносов: попытки кончились, переговоров и необработанных сообщений нет"""
+        return self.attempts_to_balancing < 0 and not self.sessions \
+            and (self.dispatcher is None or self.dispatcher.queue.empty())
+
+    def wake_balancing(self):
+        """Следующий раунд балансировки - сразу (передача прошла, получены новые задачи)"""
+        if self.balancer is not None:
+            self.balancer.wake()
+
+    def back_off_balancing(self):
+        """Следующий раунд балансировки - после растущей паузы (раунд прошел без передачи)"""
+        if self.balancer is not None:
+            self.balancer.back_off()
+
+    def open_session(self, peer, thread=None):
+        session = NegotiationSession(peer, self.SESSION_TIMEOUT, thread)
+        self.sessions[session.thread] = session
+        return session
+
+    def close_session(self, session):
+        """Сессия завершена; задачи ее пакета остаются зарезервированы до commit/abort в журнале,
+        а непринятое предложение обмена снимается с резерва.
+
+        Таймеры запросов сессии, оставшихся без ответа (таймаут, напарник под подозрением, отказ
+        от обмена), снимаются: повторная отправка передачи запустит свой таймер.
+        """
+        self.sessions.pop(session.thread, None)
+        self.metrics.discard_timer("time", session.thread)
+        if session.txn is not None:
+            self.metrics.discard_timer("swap", session.txn)
+            self.metrics.discard_timer("transfer", session.txn)
+        if session.offer:
+            self.release(session.offer)
+            session.offer = None
+
+    def session_for(self, msg):
+        """Сессия, к которой относится ответ соседа, или None (сессия закрыта или чужой thread)"""
+        session = self.sessions.get(msg.thread)
+        if session is not None and session.jid == str(msg.sender).split('/')[0]:
+            return session
+        return None
+
+    def busy_peers(self):
+        return {session.jid for session in self.sessions.values()}
+
+    def reserve(self, tasks):
+        for task in tasks:
+            self.reserved.add(task["id"])
+            self.reserved_time += task["time"]
+
+    def release(self, tasks):
+        for task in tasks:
+            if task["id"] in self.reserved:
+                self.reserved.discard(task["id"])
+                self.reserved_time -= task["time"]
+        if not self.reserved:
+            self.reserved_time = 0.0
+
+    def accept_tasks(self, txn, tasks):
+        """Добавляет задачи в план и записывает в журнал под txn: принимаются все или ни одной"""
+        added = []
+        try:
+            for task in tasks:
+                self.plan.append(task)
+                added.append(task)
+        except Exception:
+            for task in added:
+                self.plan.remove(task)
+            raise
+        self.journal.log_add(txn, added)
+        self.calculate_time()
+
+    def refresh_catalog(self):
+        """Перечитывает каталог, дополненный приемом задач (agent_impl/behaviour/ingest.py)"""
+        self.catalog = load_catalog(catalog_path(self.plan_file))
+        return self.catalog
+
+    def available_time(self):
+        """Трудозатраты без задач, которые уже передаются соседям"""
+        return self.calculate_time() - self.reserved_time
 
     def calculate_time(self):
-        """Пересчитывает общий вес рюкзака"""
-        self.my_total_task_time = sum(item["time"] for item in self.plan)
+        """Обновляет общий вес рюкзака (сумма ведется планом при каждом изменении)"""
+        self.my_total_task_time = self.plan.total_time
         return self.my_total_task_time
 
     def save_plan(self):
-        """Сохраняет текущий рюкзак в файл"""
-        return save_plan_to_file(self.plan_file, self.plan)
+        """Ставит текущий рюкзак в очередь на сохранение (запись выполнит plan_writer)"""
+        self.plan_writer.mark_dirty()
+        return True
+
+    async def flush_plan(self):
+        """Немедленно записывает рюкзак, если он изменился с прошлой записи"""
+        return await self.plan_writer.flush()
 
     def load_plan(self):
-        self.plan = load_plan_from_file(self.plan_file)
+        """Начальный план из plan_file, либо, если есть журнал, последний снимок и записи журнала после него"""
+        self.plan = Plan()
+        replayed = self.journal.recover(self.plan, lambda: load_plan_from_file(self.plan_file, self.catalog),
+                                       load_snapshot(self.plan_file))
+        if replayed:
+            log.info(self, "План восстановлен по журналу, записей: %s, незавершенных передач: %s",
+                     replayed, len(self.journal.pending))
+        self.reserved, self.reserved_time = set(), 0.0
+        for entry in self.journal.pending.values():
+            self.reserve(entry["tasks"])
         self.calculate_time()
 
-    def find_best_object_to_transfer(self, time_to_shed):
-        suitable_objects = [
-            item for item in self.plan
-            if item["time"] < time_to_shed
-               and all(spec in self.neighbor_choice[1] for spec in item["specializations"])
-        ]
-
-        if not suitable_objects:
-            return None
-
-        # Находим объект с весом, наиболее близким к time_to_shed
-        best_object = min(suitable_objects, key=lambda x: abs(x["time"] - time_to_shed))
-        return best_object
\ No newline at end of file
+    def find_best_objects_to_transfer(self, time_to_shed, peer):
+        # Набор незарезервированных объектов, суммарный вес которых наиболее близок к time_to_shed
+        return self.plan.find_batch(time_to_shed, peer[2], self.TRANSFER_BATCH_LIMIT, self.SUBSET_SUM_EPSILON,
+                                    exclude=self.reserved)
\ No newline at end of file
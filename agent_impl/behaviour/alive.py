@@ -1,46 +1,113 @@
+import asyncio
 import json
-from spade.behaviour import CyclicBehaviour, PeriodicBehaviour
-from common.get_time import get_time
+from spade.behaviour import PeriodicBehaviour
+from common.event_log import get_log
 from spade.message import Message
+from agent_impl.behaviour.piggyback import PiggybackMixin
 
+log = get_log("ALIVE")
+
+
+class CheckAgentAlive(PiggybackMixin, PeriodicBehaviour):
+    """Детектор отказов соседей (agent_impl/membership.py) и таймауты сессий переговоров.
+
+    Основной сигнал жизни - обычные сообщения соседей с нагрузкой в метаданных (PiggybackMixin).
+    Раз в HEARTBEAT_INTERVAL:
+      - пересчитывает подозрения; подозреваемые исключаются из выбора для балансировки
+      - закрывает сессии, которые не продвигались дольше SESSION_TIMEOUT или чей напарник
+        под подозрением; незавершенная передача остается в журнале и будет повторена
+        BalancingBehaviour, когда напарник снова будет на связи
+      - отправляет heartbeat с просьбой ответить только тем, от кого агент ждет ответа (waiting):
+        напарникам открытых сессий, получателям неподтвержденных передач и координатору группы,
+        не ответившему на отправленную ему нагрузку, если они молчат дольше HEARTBEAT_INTERVAL, -
+        и подозреваемым из них, чтобы заметить возвращение (каждого - со все большей паузой);
+        не ответивший за HEARTBEAT_INTERVAL попадает под подозрение. Напарник, которого агент
+        только выбирает, проверяется первым сообщением переговоров, а пассивный агент
+        (WorkerAgent.passive) heartbeat не отправляет (кроме проверки молчащего инициатора
+        обнаружения завершения, см. TerminationBehaviour)
+    """
 
-class CheckAgentAlive(PeriodicBehaviour):
     async def run(self):
+        agent = self.agent
         try:
-            if not self.agent.neighbor_choice is None:
-                msg = Message(to=self.agent.neighbor_choice[0])
-                msg.set_metadata("type", "request_alive")
-                await self.send(msg)
-                print(f"{get_time()} [CheckAgentAlive] {self.agent.jid}:"
-                      f" Выполняю проверку связи с {self.agent.neighbor_choice}")
+            for jid in agent.membership.update(self.waiting()):
+                agent.metrics.inc("peer_suspected_total")
+                log.warning(agent, "сосед %s давно не отвечает, исключен из балансировки", jid)
+
+            for session in list(agent.sessions.values()):
+                if session.expired() or not agent.membership.is_alive(session.jid):
+                    agent.close_session(session)
+                    agent.attempts_to_balancing -= 1
+                    agent.membership.failed(session.jid)
+                    agent.metrics.inc("peer_unreachable_total", peer=session.jid)
+                    log.warning(agent, "напарник %s не ответил, выбираем другого для обмена", session.jid)
+
+            await self.send_heartbeats()
         except Exception as e:
-            self.agent.neighbor_choice = None
-            self.agent.transfer_object = None
-            print(f"{get_time()} [CheckAgentAlive] {self.agent.jid}: Ошибка: {e}")
+            log.error(agent, "Ошибка: %s", e)
 
+    def waiting(self):
+        """Соседи, от которых агент ждет ответа: сессии, неподтвержденные передачи и назначения, координатор"""
+        agent = self.agent
+        waiting = {session.jid for session in agent.sessions.values()}
+        waiting.update(entry["to"] for entry in agent.journal.pending.values())
+        if agent.ingest is not None:
+            waiting.update(entry["to"] for entry in agent.ingest.pending.values())
+        # Координатор группы, которому отправлена нагрузка и который с тех пор молчит дольше SESSION_TIMEOUT
+        # (без переносов ему незачем писать): если он отказал, его место займет следующий
+        # (agent_impl/behaviour/hierarchy.py)
+        coordinator = agent.group_coordinator()
+        if coordinator is not None:
+            last_heard, last_sent = agent.membership.last_heard(coordinator), agent.membership.last_sent(coordinator)
+            if last_sent is not None and (last_heard is None or last_heard < last_sent and
+                                          asyncio.get_running_loop().time() - last_heard > agent.SESSION_TIMEOUT):
+                waiting.add(coordinator)
+        waiting.discard(str(agent.jid))
+        return waiting
 
-class RequestAlive(CyclicBehaviour):
-    async def run(self):
-        msg = await self.receive(timeout=self.agent.COMMUNICATION_INTERVAL * 5.5)
-        if msg and msg.get_metadata("type") == "request_alive":
-            reply = msg.make_reply()
-            reply.set_metadata("type", "reply_alive")
-            await self.send(reply)
-            print(f"{get_time()} [RequestAlive] {self.agent.jid}:"
-                  f" Ответил агенту {msg.sender}")
+    async def send_heartbeats(self):
+        agent = self.agent
+        if agent.passive():
+            return
+        now = asyncio.get_running_loop().time()
+        waiting = self.waiting()
+        targets = []
+        for jid in sorted(waiting):
+            if not agent.membership.is_alive(jid):
+                continue
+            last_heard, last_sent = agent.membership.last_heard(jid), agent.membership.last_sent(jid)
+            if (last_heard is None or now - last_heard >= agent.HEARTBEAT_INTERVAL) and \
+                    (last_sent is None or now - last_sent >= agent.HEARTBEAT_INTERVAL):
+                targets.append(jid)
+        targets += sorted(agent.membership.due_for_probe(waiting, agent.HEARTBEAT_INTERVAL))
 
+        for jid in targets:
+            await probe(self, jid)
+        if targets:
+            log.debug(agent, "heartbeat: %s", targets)
 
-class ReplyAlive(CyclicBehaviour):
-    async def run(self):
-        msg = await self.receive(timeout=self.agent.COMMUNICATION_INTERVAL * 5.5)
-        if (msg and
-                msg.get_metadata("type") == "reply_alive" and
-                self.agent.neighbor_choice and
-                str(msg.sender).split('/')[0] == self.agent.neighbor_choice[0]):
-            pass
-        else:
-            self.agent.neighbor_choice = None
-            self.agent.transfer_object = None
-            self.agent.attempts_to_balancing -= 1
-            print(f"{get_time()} [ReplyAlive] {self.agent.jid}:"
-                  f" напарник не ответил, выбираем другого для обмена")
\ No newline at end of file
+
+async def probe(behaviour, jid):
+    """heartbeat с просьбой ответить: без ответа за probe_timeout сосед попадет под подозрение"""
+    msg = Message(to=jid)
+    msg.set_metadata("type", "heartbeat")
+    msg.body = json.dumps({"probe": True})
+    behaviour.agent.membership.probed(jid)
+    await behaviour.send(msg)
+
+
+async def handle_heartbeat(behaviour, msg):
+    # Сам сигнал уже учтен при получении (WorkerAgent.dispatch); на проверку отвечаем
+    if msg.body and json.loads(msg.body).get("probe"):
+        # Не make_reply: он копирует тело, и ответ тоже оказался бы пробой
+        reply = Message(to=str(msg.sender).split('/')[0])
+        reply.set_metadata("type", "heartbeat")
+        await behaviour.send(reply)
+
+
+async def handle_request_alive(behaviour, msg):
+    # Проверка связи агентов прежней версии
+    reply = msg.make_reply()
+    reply.set_metadata("type", "reply_alive")
+    await behaviour.send(reply)
+    log.debug(behaviour.agent, "Ответил агенту %s", msg.sender)
@@ -1,63 +1,215 @@
+import asyncio
 import json
 import random
-from spade.behaviour import PeriodicBehaviour
-from common.get_time import get_time
+from spade.behaviour import CyclicBehaviour
+from common.event_log import get_log
 from spade.message import Message
+from agent_impl.behaviour.time import start_transfer
+from agent_impl.behaviour.transfer import send_transfer_request
+from agent_impl.behaviour.piggyback import PiggybackMixin
+from common.specializations import spec_mask, single_bits
 
+log = get_log("BALANCE")
+
+
+class BalancingBehaviour(PiggybackMixin, CyclicBehaviour):
+    """Раунды балансировки по адаптивному расписанию.
+
+    Раунд открывает сессии переговоров (agent_impl/session.py) на свободные места,
+    до NEGOTIATION_SESSIONS одновременно: перегруженный агент раздает задачи
+    нескольким более легким соседям, не дожидаясь ответа каждого по очереди.
+
+    После успешной передачи или получения задач следующий раунд начинается сразу (wake).
+    Если несколько раундов подряд прошли без передачи, пауза растет экспоненциально
+    со случайным разбросом (back_off) до COMMUNICATION_INTERVAL * BALANCE_BACKOFF_LIMIT.
+    Пауза в k интервалов расходует k попыток (attempts_to_balancing), как k пропущенных
+    раундов: сбалансированная система останавливается не позже, чем с раундами каждые
+    COMMUNICATION_INTERVAL, но отправляет меньше сообщений.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._wakeup = asyncio.Event()
+        self._backoff_factor = 1  # пауза в единицах COMMUNICATION_INTERVAL
+        self._next_round_at = 0.0
+        self._idle_rounds = 0
+
+    def wake(self):
+        """Начать следующий раунд немедленно и сбросить паузу"""
+        self._backoff_factor = 1
+        self._idle_rounds = 0
+        self._wakeup.set()
+
+    def back_off(self):
+        """Отложить следующий раунд: раунд закончился без передачи.
+
+        Пауза не растет, пока в кэше есть заметно более легкий сосед - передача еще возможна.
+        Раунды, пропущенные из-за паузы, списываются с попыток балансировки.
+        """
+        # Пауза не длиннее, чем позволяют оставшиеся попытки, и разброс только укорачивает ее:
+        # сбалансированный агент исчерпает попытки не позже, чем с раундами каждые COMMUNICATION_INTERVAL
+        skipped = max(0, min(self._backoff_factor - 1, self.agent.attempts_to_balancing + 1))
+        self.agent.attempts_to_balancing -= skipped
+        jitter = self.agent.BALANCE_JITTER
+        delay = self.agent.COMMUNICATION_INTERVAL * (1 + skipped) * random.uniform(1 - jitter, 1)
+        self._next_round_at = asyncio.get_running_loop().time() + delay
+        self._idle_rounds += 1
+        if self.lighter_peer_known() or self._idle_rounds < self.agent.BALANCE_BACKOFF_AFTER:
+            self._backoff_factor = 1
+        else:
+            self._backoff_factor = min(self._backoff_factor * 2, self.agent.BALANCE_BACKOFF_LIMIT)
+
+    def lighter_peer_known(self):
+        known = self.agent.peer_loads.least_loaded(self.agent.membership.live(self.agent.other_agents))
+        if known is None:
+            return False
+        _, load = known
+        my_time = self.agent.available_time()
+        return my_time > load + self.agent.BALANCE_THRESHOLD * (my_time + load) / 2
+
+    async def wait_next_round(self):
+        # Срок может отодвинуться, пока ждем (back_off из обработчика ответа), поэтому проверяем в цикле
+        loop = asyncio.get_running_loop()
+        while not self._wakeup.is_set():
+            remaining = self._next_round_at - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        self._wakeup.clear()
 
-class BalancingBehaviour(PeriodicBehaviour):
     async def run(self):
-        """Основное поведение балансировки"""
+        """Основное поведение балансировки: открывает сессии переговоров на свободные места"""
+        # Барьер готовности: соседи еще подключаются, раунд ушел бы впустую
+        await self.agent.ready.wait()
+        await self.wait_next_round()
+        # Пока идут переговоры, проверяем их состояние с обычным интервалом
+        self._next_round_at = asyncio.get_running_loop().time() + self.agent.COMMUNICATION_INTERVAL
         try:
+            self.agent.metrics.inc("balancing_rounds_total")
             if self.agent.attempts_to_balancing < 0:
-                print(f"{get_time()} [BALANCE] {self.agent.jid}: Веса сбалансированы. Завершаю работу")
-                await self.agent.stop()
+                if self.agent.STOP_WHEN_BALANCED and self.agent.termination is None:
+                    log.info(self.agent, "Веса сбалансированы. Завершаю работу")
+                    await self.agent.stop()
+                    return
+                # Агент остановится вместе со всеми, когда завершение обнаружит маркер (termination.py);
+                # до того его может разбудить пришедшая задача, а новые задачи (ingest.py) - через wake
+                self.back_off()
                 return
-            # Шаг 1: Сон уже реализован через PeriodicBehaviour
+            # Шаг 1: Сон - ожидание в wait_next_round
 
             # Шаг 2: Выбор случайного соседа
             if not self.agent.other_agents:
-                print(f"{get_time()} [BALANCE] {self.agent.jid}: Нет других агентов для балансировки")
+                log.debug(self.agent, "Нет других агентов для балансировки")
                 return
 
-            # Избегаем запуска нескольких обменов для одного агента одновременно
-            if self.agent.neighbor_choice is None:
-                # Получаем все уникальные специализации из плана
-                all_specializations = set()
-                for task in self.agent.plan:
-                    all_specializations.update(task['specializations'])
+            free = self.agent.NEGOTIATION_SESSIONS - len(self.agent.sessions)
+            if free <= 0:
+                return
 
-                # Выбираем случайную специализацию
-                if all_specializations:
-                    chosen_specialization = random.choice(list(all_specializations))
+            # Незавершенные передачи (нет подтверждения, в том числе до перезапуска) повторяются раньше новых
+            free -= await self.resend_pending(free)
 
-                    # Фильтруем other_agents по выбранной специализации
-                    matching_agents = []
-                    for agent_info in self.agent.other_agents:
-                        if chosen_specialization in agent_info[1]:
-                            matching_agents.append(agent_info)
+            if self.agent.coordinated():
+                # Иерархический режим: переносы назначает координатор группы (hierarchy.py). Члену, который
+                # уже слышал координатора, хватает HIERARCHY_IDLE_CYCLES попыток - поручение его разбудит
+                if not self.agent.sessions:
+                    if self.agent.coordinator_heard():
+                        self.agent.attempts_to_balancing = \
+                            min(self.agent.attempts_to_balancing, self.agent.HIERARCHY_IDLE_CYCLES)
+                    self.agent.attempts_to_balancing -= 1
+                    self.back_off()
+                return
 
-                    # Если есть подходящие агенты - выбираем случайного
-                    if matching_agents:
-                        self.agent.neighbor_choice = random.choice(matching_agents)
-                    else:
-                        return  # нет подходящих агентов
-                else:
-                    return  # нет специализаций в плане
+            # Первая сессия - как раньше, к случайному или заведомо более легкому соседу.
+            # Остальные места занимаются, только если по кэшу известны еще более легкие соседи
+            opened, tried = 0, set()
+            while opened < free:
+                if not await self.open_session(known_only=opened > 0 or bool(self.agent.sessions), tried=tried):
+                    break
+                opened += 1
 
-                print(f"{get_time()} [BALANCE] {self.agent.jid}: Выбран сосед {self.agent.neighbor_choice}")
+            if not self.agent.sessions and not opened:
+                self.back_off()
 
-                # Шаг 3: Обмен данными - запрос веса соседа
-                self.agent.calculate_time()
+        except Exception as e:
+            log.error(self.agent, "Ошибка: %s", e)
 
-                msg = Message(to=self.agent.neighbor_choice[0])
-                msg.set_metadata("type", "time_request")
-                msg.body = json.dumps({"weight": self.agent.my_total_task_time})
+    async def open_session(self, known_only, tried):
+        """Выбирает соседа (кроме уже выбранных в этом раунде - tried) и начинает с ним сессию.
 
-                await self.send(msg)
-                print(f"{get_time()} [BALANCE] {self.agent.jid}: Отправлен запрос трудозатрат к {self.agent.neighbor_choice}")
+        False, если подходящего соседа нет.
+        """
+        # Получаем маску всех специализаций из плана
+        all_specializations = self.agent.plan.specialization_mask()
+        if not all_specializations:
+            return False  # нет специализаций в плане
 
-        except Exception as e:
-            self.agent.neighbor_choice = None
-            self.agent.transfer_object = None
-            print(f"{get_time()} [BALANCE] {self.agent.jid}: Ошибка: {e}")
\ No newline at end of file
+        # Выбираем случайную специализацию
+        chosen_specialization = random.choice(list(single_bits(all_specializations)))
+
+        # Фильтруем живых соседей по выбранной специализации, без соседей, с которыми уже идут переговоры
+        busy = self.agent.busy_peers() | tried
+        matching_agents = [info for info in self.agent.membership.live(self.agent.other_agents)
+                           if info[2] & chosen_specialization and info[0] not in busy]
+        if not matching_agents:
+            return False  # нет подходящих агентов
+
+        # Наименее загруженный из известных по кэшу, если он заметно легче нас, иначе случайный
+        peer = self.choose_neighbor(matching_agents, known_only)
+        if peer is None:
+            return False
+        tried.add(peer[0])
+        session = self.agent.open_session(peer)
+        log.debug(self.agent, "Выбран сосед %s", peer)
+
+        # Шаг 3: Обмен данными - вес соседа берем из кэша, если он свежий, иначе запрашиваем
+        cached_time = self.agent.peer_loads.get(session.jid)
+        if cached_time is not None:
+            log.debug(self.agent, "Трудозатраты соседа из кэша = %s, запрос не нужен", cached_time)
+            self.agent.metrics.inc("peer_load_cache_hits_total")
+            await start_transfer(self, session, cached_time)
+            return True
+
+        msg = Message(to=session.jid, thread=session.thread)
+        msg.set_metadata("type", "time_request")
+        msg.body = json.dumps({"weight": self.agent.calculate_time()})
+
+        self.agent.metrics.start_timer("time", session.thread)
+        await self.send(msg)
+        log.debug(self.agent, "Отправлен запрос трудозатрат к %s", peer)
+        return True
+
+    async def resend_pending(self, limit):
+        """Повторно отправляет до limit незавершенных передач, для которых нет открытой сессии"""
+        in_sessions = {session.txn for session in self.agent.sessions.values()}
+        resent = 0
+        for txn, entry in list(self.agent.journal.pending.items()):
+            if resent >= limit:
+                break
+            # Напарнику под подозрением не повторяем: передача дождется его возвращения
+            if txn in in_sessions or entry["to"] in self.agent.busy_peers() \
+                    or not self.agent.membership.is_alive(entry["to"]):
+                continue
+            specializations = next((info[1] for info in self.agent.other_agents if info[0] == entry["to"]), [])
+            session = self.agent.open_session([entry["to"], specializations, spec_mask(specializations)])
+            session.txn, session.tasks = txn, entry["tasks"]
+            await send_transfer_request(self, session, txn, entry["tasks"], swap=entry.get("swap"))
+            log.info(self.agent, "Повторно отправлен пакет %s (%s задач) агенту %s",
+                     txn, len(entry["tasks"]), entry["to"], txn=txn)
+            resent += 1
+        return resent
+
+    def choose_neighbor(self, matching_agents, known_only=False):
+        known = self.agent.peer_loads.least_loaded(matching_agents)
+        if known is not None:
+            agent_info, load = known
+            my_time = self.agent.available_time()
+            threshold_value = self.agent.BALANCE_THRESHOLD * (my_time + load) / 2
+            if my_time > load + threshold_value:
+                return agent_info
+        if known_only:
+            return None
+        return random.choice(matching_agents)
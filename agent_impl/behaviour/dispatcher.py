@@ -0,0 +1,39 @@
+import time
+from spade.behaviour import CyclicBehaviour
+from common.event_log import get_log
+from agent_impl.behaviour.piggyback import PiggybackMixin
+
+log = get_log("DISPATCH")
+
+
+class MessageDispatcher(PiggybackMixin, CyclicBehaviour):
+    """Единственное принимающее поведение агента.
+
+    Ждет входящее сообщение и передает его обработчику по metadata "type".
+    Обработчик - обычная корутина handler(behaviour, msg), поэтому новый тип
+    сообщений не добавляет агенту ни поведения, ни опрашивающей задачи.
+    """
+
+    def __init__(self, handlers):
+        super().__init__()
+        self.handlers = dict(handlers)
+
+    async def run(self):
+        # receive(timeout) просыпается по таймауту, а здесь задача спит, пока нет сообщений
+        msg = await self.queue.get()
+        msg_type = msg.get_metadata("type")
+        handler = self.handlers.get(msg_type)
+        metrics = self.agent.metrics
+        if handler is None:
+            metrics.inc("messages_unknown_total")
+            log.warning(self.agent, "Неизвестный тип сообщения %s от %s", msg_type, msg.sender)
+            return
+        metrics.inc("messages_received_total", type=msg_type)
+        # Время работы обработчика - реальное: ожидание ответа сюда не входит, только работа агента
+        started = time.perf_counter()
+        try:
+            await handler(self, msg)
+        except Exception as e:
+            metrics.inc("handler_errors_total", type=msg_type)
+            log.error(self.agent, "Ошибка обработки %s: %s", msg_type, e)
+        metrics.observe("handler_seconds", time.perf_counter() - started, type=msg_type)
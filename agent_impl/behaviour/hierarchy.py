@@ -0,0 +1,412 @@
+import asyncio
+import json
+import random
+from spade.behaviour import PeriodicBehaviour
+from spade.message import Message
+from agent_impl.behaviour.alive import probe
+from agent_impl.behaviour.piggyback import PiggybackMixin
+from agent_impl.behaviour.time import send_batch, start_transfer
+from common.event_log import get_log
+from common.specializations import spec_mask
+
+log = get_log("HIERARCHY")
+
+
+class CoordinatorBehaviour(PiggybackMixin, PeriodicBehaviour):
+    """Иерархическая балансировка: координатор группы (common/topology.py, build_groups)
+    планирует переносы сразу для всей группы вместо попарных переговоров.
+
+    Координатор - первый по jid член группы, которого агент считает живым (membership):
+    если координатор отказал, его место занимает следующий. Поведение есть у каждого
+    члена группы:
+      - член группы сообщает координатору свою нагрузку (group_load), когда она изменилась
+        или закончилось его поручение, - не чаще раза в период; без изменений он молчит
+      - координатор каждый период планирует по последним сообщенным нагрузкам (plan_moves):
+        самые загруженные отдают избыток над средним самым легким совместимым членам. Затем
+        переносы между группами: если средняя нагрузка группы заметно выше, чем у другой группы
+        (по group_summary ее координатора), самый загруженный член отдает часть легкому члену
+        той группы из сводки. Каждый перенос - balance_order отдающему, он передает пакет обычным
+        transfer_request. Участники поручения не планируются, пока не сообщат нагрузку (или
+        SESSION_TIMEOUT); когда известны нагрузки всех членов и поручений нет (complete),
+        следующий шаг планируется сразу, не дожидаясь периода
+      - сводка группы уходит GROUP_SUMMARY_FANOUT координаторам других групп, только если она
+        заметно изменилась (summary_changed); каждому получателю - свой легкий член, и он
+        принимает один перенос. Координатор, использовавший всех легких членов более легкой
+        группы, отправляет ей свою сводку, и та отвечает свежей
+      - опрос (group_poll) получает только член, чья нагрузка координатору неизвестна: член без
+        сообщений, с истекшим поручением или после смены координатора; на первую нагрузку члена
+        координатор отвечает heartbeat, чтобы член знал, что он на связи
+    Пока координатор назначал переносы в последние HIERARCHY_IDLE_CYCLES периодов, он сам
+    не исчерпывает попытки балансировки; пассивный координатор (WorkerAgent.passive) переносов
+    не назначает. Член группы, который еще ни разу не слышал своего координатора (координатор
+    отказал, а следующий еще не занял его место), балансирует попарными переговорами.
+    """
+
+    def __init__(self, period):
+        super().__init__(period=period)
+        # Координатор: jid -> нагрузка из последнего group_load члена
+        self.loads = {}
+        # jid -> время поручения, в котором член участвует; отдающий -> (его нагрузка, получатели)
+        self.ordered = {}
+        self.orders = {}
+        self.polled = {}  # jid -> время последнего опроса
+        self.coordinating_since = None
+        # номер группы -> {"load": средняя нагрузка, "size": членов, "light": [[jid, нагрузка, специализации]], "at": время}
+        self.summaries = {}
+        self.idle_cycles = None  # периодов подряд без переносов, None - переносов еще не было
+        self.previous_plan = None
+        self.summary = None  # последняя сводка своей группы
+        self.summary_sent = None  # (сводка, время) последней рассылки другим координаторам
+        self.light_given = 0  # сколько легких членов сводки уже отдано другим координаторам
+        self.exhausted = set()  # более легкие группы, все легкие члены из сводок которых уже получили перенос
+        # Член группы: (координатор, нагрузка) последнего group_load и потоки сессий поручения
+        self.reported = None
+        self.order_threads = set()
+        self.order_pending = False
+
+    async def run(self):
+        agent = self.agent
+        await agent.ready.wait()
+        try:
+            coordinator = group_coordinator(agent, agent.groups[agent.group_index])
+            if coordinator != str(agent.jid):
+                self.coordinating_since = None
+                self.loads.clear()
+                self.ordered.clear()
+                self.orders.clear()
+                await self.report(coordinator)
+                return
+            if self.coordinating_since is None:
+                self.coordinating_since = asyncio.get_running_loop().time()
+            # Пассивный агент не начинает переносов (termination.py): поручения - только от активного
+            if not agent.passive() and not await self.plan_cycle() and self.idle_cycles is not None:
+                self.idle_cycles += 1
+        except Exception as e:
+            log.error(agent, "Ошибка: %s", e)
+
+    def active(self):
+        return self.idle_cycles is not None and self.idle_cycles < self.agent.HIERARCHY_IDLE_CYCLES
+
+    async def report(self, coordinator):
+        """Нагрузка члена группы - координатору: если изменилась или закончилось поручение"""
+        agent = self.agent
+        if coordinator is None:
+            return
+        # Пока идут переговоры по поручению, нагрузка еще меняется
+        self.order_threads &= set(agent.sessions)
+        if self.order_threads:
+            return
+        load = agent.available_time()
+        if not self.order_pending and self.reported == (coordinator, load):
+            return
+        self.order_pending = False
+        await self.send_load(coordinator, load)
+
+    async def send_load(self, to, load):
+        msg = Message(to=to)
+        msg.set_metadata("type", "group_load")
+        msg.body = json.dumps({"load": load})
+        self.reported = (to, load)
+        await self.send(msg)
+
+    def member_loads(self, now):
+        """Нагрузки членов, по которым можно планировать, и члены, которых нужно опросить"""
+        agent = self.agent
+        for jid, at in list(self.ordered.items()):
+            if now - at > agent.SESSION_TIMEOUT:
+                # Поручение не завершилось: нагрузку члена узнаем опросом
+                del self.ordered[jid]
+                self.orders.pop(jid, None)
+                self.loads.pop(jid, None)
+        loads = {str(agent.jid): agent.available_time()}
+        unknown = []
+        for info in agent.group:
+            jid = info[0]
+            if jid == str(agent.jid) or jid in self.ordered or not agent.membership.is_alive(jid):
+                continue
+            load = self.loads.get(jid)
+            if load is None:
+                # Свежая нагрузка из метаданных любого сообщения члена тоже подходит
+                load = agent.peer_loads.get(jid)
+            if load is not None:
+                loads[jid] = load
+            elif now - self.polled.get(jid, self.coordinating_since) >= agent.HEARTBEAT_INTERVAL:
+                # Члены сообщают нагрузку сами: опрашиваем только молчащих дольше HEARTBEAT_INTERVAL
+                unknown.append(jid)
+        return loads, unknown
+
+    def complete(self):
+        """Известны нагрузки всех живых членов группы, и ни одно поручение не ждет итога"""
+        agent = self.agent
+        return self.coordinating_since is not None and not self.ordered and \
+            all(info[0] in self.loads for info in agent.group
+                if info[0] != str(agent.jid) and agent.membership.is_alive(info[0]))
+
+    async def poll(self, jids, now):
+        agent = self.agent
+        for jid in jids:
+            self.polled[jid] = now
+            msg = Message(to=jid)
+            msg.set_metadata("type", "group_poll")
+            msg.body = json.dumps({"group": agent.group_index})
+            # Не ответивший на опрос попадет под подозрение, как без ответа на heartbeat
+            agent.membership.probed(jid)
+            await self.send(msg)
+
+    async def plan_cycle(self):
+        """Один шаг планирования; True, если назначены переносы"""
+        agent = self.agent
+        now = asyncio.get_running_loop().time()
+        loads, unknown = self.member_loads(now)
+        await self.poll(unknown, now)
+        masks = {info[0]: info[2] for info in agent.group}
+        specializations = {info[0]: info[1] for info in agent.group}
+
+        moves = [(src, dst, specializations[dst], amount, loads[dst])
+                 for src, dst, amount in plan_moves(loads, masks, agent.BALANCE_THRESHOLD, agent.NEGOTIATION_SESSIONS)]
+        projected = dict(loads)
+        for src, dst, _, amount, _ in moves:
+            projected[src] -= amount
+            projected[dst] += amount
+        moves += self.plan_between_groups(projected, masks)
+
+        # Нагрузки не изменились с прошлого периода, и план тот же - прошлые поручения не дали
+        # переносов, повторять их не стоит, пока что-нибудь не изменится
+        plan = (loads, [move[:2] for move in moves])
+        changed = plan != self.previous_plan
+        self.previous_plan = plan
+        agent.metrics.inc("hierarchy_cycles_total")
+        if moves and changed:
+            for move in moves:
+                self.track_order(move[0], move[1], loads, now)
+            for move in moves:
+                await self.order(*move)
+            agent.metrics.inc("hierarchy_moves_total", len(moves))
+            self.idle_cycles = 0
+            log.info(agent, "группа %s: переносов %s, средняя нагрузка %.2f", agent.group_index, len(moves),
+                     sum(loads.values()) / len(loads))
+        if self.active():
+            agent.attempts_to_balancing = 20
+        await self.send_summary(projected, specializations)
+        return bool(moves and changed)
+
+    def track_order(self, src, dst, loads, now):
+        """Участники поручения не планируются, пока отдающий не сообщит его итог"""
+        me = str(self.agent.jid)
+        for jid in (src, dst):
+            if jid != me and jid in loads:
+                self.ordered[jid] = now
+        if src != me:
+            self.orders.setdefault(src, (loads[src], []))[1].append(dst)
+
+    def load_reported(self, jid, load):
+        self.loads[jid] = load
+        self.polled.pop(jid, None)
+        self.ordered.pop(jid, None)
+        order = self.orders.pop(jid, None)
+        if order is not None and order[0] == load:
+            # Отдающий ничего не передал: получатели свободны, их нагрузка не изменилась
+            for dst in order[1]:
+                self.ordered.pop(dst, None)
+
+    def plan_between_groups(self, projected, masks):
+        """Переносы в более легкие группы: по одному на группу, от самых загруженных членов"""
+        agent = self.agent
+        now = asyncio.get_running_loop().time()
+        average = sum(projected.values()) / len(projected)
+        senders = sorted(projected, key=projected.get, reverse=True)
+        fresh = [summary for group, summary in self.summaries.items()
+                 if group != agent.group_index and now - summary["at"] <= agent.LOAD_CACHE_TTL]
+        moves = []
+        for summary in sorted(fresh, key=lambda item: item["load"]):
+            other = summary["load"]
+            if len(moves) >= agent.NEGOTIATION_SESSIONS or not senders or other >= average:
+                break
+            if not summary["light"]:
+                # Свежую сводку с новыми легкими членами группа пришлет в ответ на нашу (send_summary)
+                self.exhausted.add(summary["group"])
+                continue
+            src = senders[0]
+            # Порог - как у пары в start_transfer: самый загруженный член и легкий член другой группы
+            eligible = [light for light in summary["light"]
+                        if spec_mask(light[2]) & masks[src]
+                        and projected[src] - light[1] > agent.BALANCE_THRESHOLD * (projected[src] + light[1]) / 2]
+            if not eligible:
+                break
+            jid, load, specializations = eligible[0]
+            # Легкий член из сводки принимает один перенос: следующий - по новой сводке
+            summary["light"].remove(eligible[0])
+            # Столько, чтобы средние групп сравнялись, но не больше половины разницы пары
+            amount = min((average - other) * len(projected) * summary["size"] / (len(projected) + summary["size"]),
+                         (projected[src] - load) / 2)
+            moves.append((src, jid, specializations, amount, load))
+            projected[src] -= amount
+            senders.pop(0)
+        return moves
+
+    async def order(self, src, dst, specializations, amount, load):
+        if src == str(self.agent.jid):
+            await execute_order(self, dst, specializations, amount, load)
+            return
+        msg = Message(to=src)
+        msg.set_metadata("type", "balance_order")
+        msg.body = json.dumps({"to": dst, "specializations": specializations, "amount": amount, "load": load})
+        await self.send(msg)
+
+    async def send_summary(self, projected, specializations):
+        """Сводка группы случайным GROUP_SUMMARY_FANOUT координаторам, если она изменилась, и более легким
+        группам, легкие члены которых уже получили переносы (exhausted); они отвечают своей"""
+        agent = self.agent
+        light = sorted(projected, key=projected.get)[:agent.NEGOTIATION_SESSIONS]
+        self.summary = {
+            "group": agent.group_index,
+            "load": sum(projected.values()) / len(projected),
+            "size": len(projected),
+            "light": [[jid, projected[jid], specializations[jid]] for jid in light],
+        }
+        groups = set(self.exhausted)
+        self.exhausted.clear()
+        if self.summary_changed():
+            self.summary_sent = (self.summary, asyncio.get_running_loop().time())
+            self.light_given = 0
+            others = [group for group in range(len(agent.groups)) if group != agent.group_index]
+            groups.update(random.sample(others, min(agent.GROUP_SUMMARY_FANOUT, len(others))))
+        for group in sorted(groups):
+            await self.send_summary_to(group_coordinator(agent, agent.groups[group]), reply=False)
+
+    def summary_changed(self):
+        """Средняя нагрузка группы заметно изменилась с прошлой рассылки (на половину порога балансировки),
+        или группа еще переносит задачи, а прошлая сводка у других координаторов уже устарела"""
+        if self.summary_sent is None:
+            return True
+        sent, at = self.summary_sent
+        agent = self.agent
+        if abs(self.summary["load"] - sent["load"]) > agent.BALANCE_THRESHOLD * sent["load"] / 2:
+            return True
+        return self.active() and asyncio.get_running_loop().time() - at > agent.LOAD_CACHE_TTL
+
+    async def send_summary_to(self, jid, reply):
+        """Сводка координатору jid: легкие члены у каждого получателя свои, чтобы переносы
+        из разных групп не сходились на одном члене"""
+        light = self.summary["light"]
+        share = [light[self.light_given % len(light)]] if light else []
+        self.light_given += 1
+        msg = Message(to=jid)
+        msg.set_metadata("type", "group_summary")
+        msg.body = json.dumps({**self.summary, "light": share, "reply": reply})
+        await self.send(msg)
+
+    def receive_summary(self, data):
+        data["at"] = asyncio.get_running_loop().time()
+        self.summaries[data["group"]] = data
+
+
+def group_coordinator(agent, members):
+    """Координатор группы с точки зрения agent: первый по jid член, которого он считает живым"""
+    for jid in members:
+        if jid == str(agent.jid) or agent.membership.is_alive(jid):
+            return jid
+    return None
+
+
+def plan_moves(loads, masks, threshold, max_orders):
+    """Переносы внутри группы за один шаг: [(отдающий, получающий, трудозатраты)].
+
+    Члены с нагрузкой выше средней, начиная с самого загруженного, отдают избыток
+    самым легким членам с общей специализацией, каждый - не больше чем max_orders
+    получателям; получатель участвует в одном переносе. Пара, разница нагрузок
+    которой в пределах порога (как в start_transfer), не переносит.
+    """
+    average = sum(loads.values()) / len(loads)
+    receivers = sorted((jid for jid in loads if loads[jid] < average), key=loads.get)
+    used = set()
+    moves = []
+    for src in sorted((jid for jid in loads if loads[jid] > average), key=loads.get, reverse=True):
+        excess = loads[src] - average
+        orders = 0
+        for dst in receivers:
+            if orders >= max_orders or excess <= 0:
+                break
+            if dst in used or not masks[src] & masks[dst]:
+                continue
+            if loads[src] - loads[dst] <= threshold * (loads[src] + loads[dst]) / 2:
+                break  # остальные получатели еще тяжелее
+            amount = min(excess, average - loads[dst])
+            moves.append((src, dst, amount))
+            used.add(dst)
+            excess -= amount
+            orders += 1
+    return moves
+
+
+async def execute_order(behaviour, to, specializations, amount, load):
+    """Поручение координатора: передать соседу to (его нагрузка - load) пакет задач примерно на amount.
+
+    Если такого пакета нет (задачи крупнее), решение принимается как в попарных переговорах
+    (start_transfer): пакет на половину разницы нагрузок или обмен задачами.
+    Когда переговоры по поручению закончатся, член группы сообщит координатору нагрузку.
+    """
+    agent = behaviour.agent
+    coordinator = agent.coordinator
+    if coordinator is not None:
+        coordinator.order_pending = True
+    if to in agent.busy_peers() or len(agent.sessions) >= agent.NEGOTIATION_SESSIONS:
+        agent.metrics.inc("balance_orders_total", result="busy")
+        return
+    session = agent.open_session([to, specializations, spec_mask(specializations)])
+    if coordinator is not None:
+        coordinator.order_threads.add(session.thread)
+    if await send_batch(behaviour, session, amount):
+        agent.metrics.inc("balance_orders_total", result="transfer")
+        return
+    agent.metrics.inc("balance_orders_total", result="pairwise")
+    await start_transfer(behaviour, session, load)
+
+
+async def handle_group_poll(behaviour, msg):
+    coordinator = behaviour.agent.coordinator
+    if coordinator is not None:
+        await coordinator.send_load(str(msg.sender).split('/')[0], behaviour.agent.available_time())
+
+
+async def handle_group_load(behaviour, msg):
+    agent = behaviour.agent
+    coordinator = agent.coordinator
+    if coordinator is None:
+        return
+    sender = str(msg.sender).split('/')[0]
+    first = sender not in coordinator.loads
+    coordinator.load_reported(sender, json.loads(msg.body)["load"])
+    current = group_coordinator(agent, agent.groups[agent.group_index])
+    if current == str(agent.jid):
+        if first:
+            # Первая нагрузка члена: пусть знает, что координатор на связи, и не проверяет его heartbeat
+            reply = Message(to=sender)
+            reply.set_metadata("type", "heartbeat")
+            await behaviour.send(reply)
+        if coordinator.complete() and not agent.passive():
+            # Нагрузки всех членов известны и поручений нет: следующий шаг - сразу, не дожидаясь периода
+            await coordinator.plan_cycle()
+        return
+    # Член группы считает координатором нас: наш координатор, возможно, отказал - проверяем его
+    last_heard = agent.membership.last_heard(current)
+    if last_heard is None or asyncio.get_running_loop().time() - last_heard > agent.HEARTBEAT_INTERVAL:
+        await probe(behaviour, current)
+
+
+async def handle_balance_order(behaviour, msg):
+    data = json.loads(msg.body)
+    await execute_order(behaviour, data["to"], data["specializations"], data["amount"], data["load"])
+
+
+async def handle_group_summary(behaviour, msg):
+    agent = behaviour.agent
+    coordinator = agent.coordinator
+    if coordinator is None:
+        return
+    data = json.loads(msg.body)
+    coordinator.receive_summary(data)
+    # Сводками обмениваются обе группы: более легкая узнает о тяжелой так же быстро
+    if not data.get("reply") and coordinator.summary is not None \
+            and group_coordinator(agent, agent.groups[agent.group_index]) == str(agent.jid):
+        await coordinator.send_summary_to(str(msg.sender).split('/')[0], reply=True)
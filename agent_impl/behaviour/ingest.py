@@ -0,0 +1,247 @@
+import asyncio
+import json
+import os
+from spade.behaviour import PeriodicBehaviour
+from spade.message import Message
+from agent_impl.behaviour.piggyback import PiggybackMixin
+from common.event_log import get_log
+from common.plan_journal import new_txn_id
+from common.plan_load_save import catalog_path, write_file_atomic
+from common.plan_writer import io_executor
+from common.specializations import spec_mask
+from common.task_catalog import append_catalog, decode_ids, encode_ids
+from common.task_inbox import TaskInbox
+
+log = get_log("INGEST")
+
+
+def ingest_state_path(plan_file):
+    """plans/old/agent.json -> plans/ingest.json"""
+    return os.path.join(os.path.dirname(os.path.dirname(plan_file)), "ingest.json")
+
+
+class IngestBehaviour(PiggybackMixin, PeriodicBehaviour):
+    """Прием задач во время работы (common/task_inbox.py) на одном агенте системы.
+
+    Раз в период новые задачи из inbox дописываются в каталог (им достаются следующие ID)
+    и распределяются по LPT: по убыванию трудозатрат, каждая наименее загруженному живому
+    агенту из agents (по умолчанию - соседи) или этому агенту, если он может ее выполнить. Нагрузка соседа - из кэша
+    peer_loads, а пока он не сообщал новую, - прежняя оценка плюс уже назначенные задачи.
+    Задачи одному агенту уходят одним сообщением task_assign с txn.
+
+    Позиции чтения inbox записываются в каталог одной строкой с новыми задачами
+    (append_catalog): после перезапуска задачи не читаются и не дописываются второй раз.
+    Назначения, в том числе этому агенту, записываются в plans/ingest.json до отправки
+    и остаются там до подтверждения (своему - до fsync журнала): назначение без
+    подтверждения повторяется тому же агенту с тем же txn (повтор он не применит дважды).
+    Задачи каталога, дописанные после последней записи ingest.json, при перезапуске
+    распределяются заново. Задачи, для которых нет живого подходящего агента, ждут
+    следующего периода.
+    """
+
+    def __init__(self, inbox_path, period, agents=None, loads=None):
+        super().__init__(period=period)
+        self.agents = agents  # [jid, специализации] агентов, которым назначаются задачи
+        self.inbox_path = inbox_path
+        self.inbox = None
+        self.state_path = None
+        self.pending = {}  # txn -> {"to": jid, "ids": [...], "sent_at": время отправки или None}
+        self.unroutable = []  # задачи каталога без подходящего живого агента
+        self.loads = dict(loads or {})  # jid -> оценка нагрузки
+        self._seen = {}  # jid -> нагрузка из кэша, по которой сделана оценка
+        self.dirty = False
+
+    async def on_start(self):
+        agent = self.agent
+        self.state_path = ingest_state_path(agent.plan_file)
+        state = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, encoding='utf-8') as f:
+                state = json.load(f)
+        # Позиции из каталога записаны вместе с задачами и не отстают от них
+        offsets = agent.catalog.inbox_offsets if agent.catalog.inbox_offsets is not None else state.get("offsets")
+        self.inbox = TaskInbox(self.inbox_path, offsets)
+        if self.agents is None:
+            self.agents = agent.other_agents
+        else:
+            self.agents = [[info[0], info[1], spec_mask(info[1])] for info in self.agents]
+        self.pending = {txn: {"to": entry["to"], "ids": decode_ids(entry["ids"]), "sent_at": None}
+                        for txn, entry in state.get("pending", {}).items()}
+        if state.get("unroutable"):
+            self.unroutable = agent.catalog.decode(state["unroutable"])
+        if "catalog_size" in state:
+            # Задачи дописаны в каталог, но сбой случился раньше записи ingest.json
+            self.unroutable.extend(agent.catalog.tasks[state["catalog_size"]:])
+        agent.metrics.gauge("ingest_pending", lambda: len(self.pending))
+        agent.metrics.gauge("ingest_unroutable", lambda: len(self.unroutable))
+        log.info(agent, "прием задач из %s, неподтвержденных назначений: %s", self.inbox_path, len(self.pending))
+
+    async def on_end(self):
+        if self.inbox is not None:
+            self.inbox.close()
+
+    async def run(self):
+        agent = self.agent
+        await agent.ready.wait()
+        try:
+            loop = asyncio.get_running_loop()
+            tasks, errors = await loop.run_in_executor(io_executor, self.inbox.poll)
+            for error in errors:
+                agent.metrics.inc("ingest_rejected_total")
+                log.warning(agent, "задача пропущена: %s", error)
+
+            if tasks:
+                added = await loop.run_in_executor(io_executor, append_catalog, catalog_path(agent.plan_file),
+                                                   agent.catalog, tasks, dict(self.inbox.offsets))
+                agent.metrics.inc("ingest_received_total", len(added))
+                log.info(agent, "получено задач: %s", len(added))
+                self.unroutable.extend(added)
+
+            assignments = self.route(self.unroutable) if self.unroutable else []
+            if assignments or tasks or self.dirty:
+                await self.save_state()
+
+            for txn in assignments:
+                if self.pending[txn]["to"] == str(agent.jid):
+                    await self.accept_own(txn)
+                else:
+                    await self.send_assign(txn)
+            await self.resend_pending()
+        except Exception as e:
+            log.error(agent, "Ошибка: %s", e)
+
+    def estimate(self, jid):
+        """Оценка нагрузки агента: свежая из кэша, если она изменилась, иначе прежняя с учетом назначенного"""
+        agent = self.agent
+        if jid == str(agent.jid):
+            return agent.available_time()
+        cached = agent.peer_loads.get(jid)
+        if cached is not None and cached != self._seen.get(jid):
+            self._seen[jid] = cached
+            self.loads[jid] = cached
+        return self.loads.get(jid, 0.0)
+
+    def route(self, tasks):
+        """Распределяет задачи по LPT: новые назначения попадают в pending, возвращаются их txn;
+        остальные задачи остаются в unroutable"""
+        agent = self.agent
+        candidates = [[str(agent.jid), agent.specializations, agent.spec_mask]] + \
+            agent.membership.live(self.agents)
+        loads = {info[0]: self.estimate(info[0]) for info in candidates}
+        batches, left = {}, []
+        for task in sorted(tasks, key=lambda t: t["time"], reverse=True):
+            compatible = [info[0] for info in candidates if task["spec_mask"] & ~info[2] == 0]
+            if not compatible:
+                left.append(task)
+                continue
+            jid = min(compatible, key=loads.get)
+            loads[jid] += task["time"]
+            if jid != str(agent.jid):
+                self.loads[jid] = loads[jid]
+            batches.setdefault(jid, []).append(task)
+
+        if left and len(left) != len(self.unroutable):
+            log.warning(agent, "нет живого агента для %s задач(и), повторю позже", len(left))
+        self.unroutable = left
+
+        assignments = []
+        for jid, batch in batches.items():
+            txn = new_txn_id()
+            assignments.append(txn)
+            self.pending[txn] = {"to": jid, "ids": [task["id"] for task in batch], "sent_at": None}
+        return assignments
+
+    async def save_state(self):
+        content = json.dumps({
+            "offsets": self.inbox.offsets,
+            "pending": {txn: {"to": entry["to"], "ids": encode_ids(entry["ids"])} for txn, entry in self.pending.items()},
+            "unroutable": encode_ids(task["id"] for task in self.unroutable),
+            "catalog_size": len(self.agent.catalog),
+        }, ensure_ascii=False)
+        self.dirty = False
+        await asyncio.get_running_loop().run_in_executor(io_executor, write_file_atomic, self.state_path, content)
+
+    async def accept_own(self, txn):
+        """Назначение этому агенту: задачи остаются в pending, пока не записаны в журнал"""
+        agent = self.agent
+        if not agent.journal.has_applied(txn):
+            tasks = [agent.catalog[task_id] for task_id in self.pending[txn]["ids"]]
+            agent.accept_tasks(txn, tasks)
+            await agent.journal.sync()
+            agent.save_plan()
+            tasks_accepted(agent, tasks)
+        del self.pending[txn]
+        await self.save_state()
+
+    async def send_assign(self, txn):
+        entry = self.pending[txn]
+        msg = Message(to=entry["to"])
+        msg.set_metadata("type", "task_assign")
+        msg.body = json.dumps({"txn": txn, "ids": encode_ids(entry["ids"])})
+        entry["sent_at"] = asyncio.get_running_loop().time()
+        self.agent.metrics.start_timer("task_assign", txn)
+        await self.send(msg)
+
+    async def resend_pending(self):
+        """Повторяет назначения, не подтвержденные за SESSION_TIMEOUT, если получатель на связи"""
+        now = asyncio.get_running_loop().time()
+        for txn, entry in list(self.pending.items()):
+            if entry["to"] == str(self.agent.jid):
+                # Свое назначение из ingest.json после перезапуска
+                await self.accept_own(txn)
+                continue
+            if entry["sent_at"] is not None and now - entry["sent_at"] < self.agent.SESSION_TIMEOUT:
+                continue
+            if not self.agent.membership.is_alive(entry["to"]):
+                # Назначение осталось без ответа: повтор после возвращения агента запустит новый таймер
+                self.agent.metrics.discard_timer("task_assign", txn)
+                continue
+            if entry["sent_at"] is not None:
+                self.agent.metrics.inc("ingest_resent_total")
+                log.info(self.agent, "повторяю назначение %s агенту %s", txn, entry["to"], txn=txn)
+            await self.send_assign(txn)
+
+    def confirmed(self, txn):
+        # Подтверждение попадет в файл при следующей записи; если раньше будет сбой, повтор назначения безопасен
+        if self.pending.pop(txn, None) is not None:
+            self.agent.metrics.stop_timer("task_assign", txn)
+            self.dirty = True
+
+
+def tasks_accepted(agent, tasks):
+    """Новые задачи в плане: балансировка возобновляется, даже если агент уже считал веса сбалансированными"""
+    agent.metrics.inc("tasks_ingested_total", len(tasks))
+    agent.attempts_to_balancing = 20
+    agent.wake_balancing()
+    log.info(agent, "Приняты новые задачи (%s). Новый вес: %s", len(tasks), agent.my_total_task_time,
+             tasks=len(tasks), load=agent.my_total_task_time)
+
+
+async def handle_task_assign(behaviour, msg):
+    agent = behaviour.agent
+    data = json.loads(msg.body)
+    txn = data["txn"]
+    if not agent.journal.has_applied(txn):
+        ids = decode_ids(data["ids"])
+        if ids and ids[-1] >= len(agent.catalog):
+            # Каталог дописан в другом процессе
+            agent.refresh_catalog()
+        tasks = [agent.catalog[task_id] for task_id in ids]
+        agent.accept_tasks(txn, tasks)
+        # Подтверждаем после fsync журнала, как и передачу
+        await agent.journal.sync()
+        agent.save_plan()
+        tasks_accepted(agent, tasks)
+    else:
+        log.info(agent, "Назначение %s уже принято, повторяю подтверждение", txn, txn=txn)
+
+    # Не make_reply: он копирует тело с задачами
+    reply = Message(to=str(msg.sender).split('/')[0])
+    reply.set_metadata("type", "task_assign_confirm")
+    reply.body = json.dumps({"txn": txn})
+    await behaviour.send(reply)
+
+
+async def handle_task_assign_confirm(behaviour, msg):
+    if behaviour.agent.ingest is not None:
+        behaviour.agent.ingest.confirmed(json.loads(msg.body)["txn"])
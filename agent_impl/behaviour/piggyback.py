@@ -0,0 +1,19 @@
+import time
+
+
+class PiggybackMixin:
+    """Добавляет к каждому исходящему сообщению текущие трудозатраты агента.
+
+    Получатель сохраняет их в WorkerAgent.peer_loads и может не запрашивать вес отдельно,
+    а само сообщение служит ему heartbeat (WorkerAgent.membership).
+    """
+
+    async def send(self, msg):
+        msg.set_metadata("load", repr(self.agent.calculate_time()))
+        msg.set_metadata("load_ts", repr(time.time()))
+        self.agent.metrics.inc("messages_sent_total", type=msg.get_metadata("type"))
+        # Получатель услышит нас: отдельный heartbeat ему не нужен
+        self.agent.membership.sent(str(msg.to).split('/')[0])
+        if self.agent.termination is not None:
+            self.agent.termination.sent(msg)
+        await super().send(msg)
@@ -0,0 +1,136 @@
+import json
+from itertools import islice
+from spade.message import Message
+from common.event_log import get_log
+from agent_impl.behaviour.transfer import send_transfer_request
+from agent_impl.plan import best_swap
+from common.plan_journal import new_txn_id
+from common.specializations import spec_mask
+
+log = get_log("SWAP")
+
+# Обмен задачами в обе стороны, когда ни одна задача тяжелого агента (инициатора) не помещается
+# в половину разницы нагрузок. Весь обмен - одна транзакция txn:
+#   1. инициатор: swap_request - самые мелкие совместимые задачи (резерв в памяти), его нагрузка
+#   2. отвечающий: подбирает обмен (best_swap), prepare своей половины (swap="offer"), swap_proposal
+#   3. инициатор: add задач отвечающего, prepare своей половины (swap="accept"),
+#      transfer_request со swap="accept"
+#   4. отвечающий: commit своей половины, add задач инициатора, transfer_confirm
+#   5. инициатор: commit своей половины (обычная обработка transfer_confirm)
+# Если шаг 3 не состоялся, отвечающий повторяет свою половину как transfer_request со swap="offer";
+# инициатор, не принявший обмен, отказывает (transfer_confirm_error), и отвечающий делает abort.
+
+
+async def start_swap(behaviour, session):
+    """Предлагает напарнику сессии обмен; False, если предложить нечего"""
+    agent = behaviour.agent
+    offer = list(islice((task for task in agent.plan.iter_smallest(session.peer[2])
+                         if task["id"] not in agent.reserved), agent.SWAP_CANDIDATES))
+    if not offer:
+        return False
+    load = agent.available_time()
+    session.txn, session.offer = new_txn_id(), offer
+    agent.reserve(offer)
+
+    msg = Message(to=session.jid, thread=session.thread)
+    msg.set_metadata("type", "swap_request")
+    msg.body = json.dumps({
+        "txn": session.txn,
+        "ids": agent.catalog.encode(offer),
+        "load": load,
+        "specializations": agent.specializations,
+    })
+    agent.metrics.start_timer("swap", session.txn)
+    agent.metrics.inc("balancing_decisions_total", decision="swap")
+    await behaviour.send(msg)
+    log.debug(agent, "Предложен обмен %s агенту %s, задач: %s", session.txn, session.jid, len(offer),
+              txn=session.txn)
+    return True
+
+
+async def handle_swap_request(behaviour, msg):
+    """Подбор обмена для инициатора: какие его задачи взять и какие свои отдать"""
+    agent = behaviour.agent
+    sender = str(msg.sender).split('/')[0]
+    data = json.loads(msg.body)
+    txn = data["txn"]
+
+    # Из предложенных задач берем только те, что подходят нам по специализациям
+    offer = [task for task in agent.catalog.decode(data["ids"]) if task["spec_mask"] & ~agent.spec_mask == 0]
+    peer_mask = spec_mask(data.get("specializations"))
+    largest = max((task["time"] for task in offer), default=0)
+    mine = list(islice((task for task in agent.plan.iter_below(largest, peer_mask)
+                        if task["id"] not in agent.reserved), agent.SWAP_CANDIDATES))
+
+    diff = data["load"] - agent.available_time()
+    given, taken, new_diff = best_swap([task["time"] for task in offer], [task["time"] for task in mine],
+                                       diff, agent.TRANSFER_BATCH_LIMIT)
+    if abs(new_diff) > abs(diff) * (1 - agent.SUBSET_SUM_EPSILON):
+        reply = msg.make_reply()
+        reply.set_metadata("type", "swap_reject")
+        reply.body = json.dumps({"txn": txn})
+        await behaviour.send(reply)
+        log.debug(agent, "Обмен %s с %s не улучшает баланс", txn, sender, txn=txn)
+        return
+
+    take = [offer[i] for i in given]
+    give = [mine[j] for j in taken]
+    # Сессия с тем же thread: пока она открыта, своя половина не повторяется как обычная передача
+    session = agent.open_session([sender, data.get("specializations") or [], peer_mask], thread=msg.thread)
+    session.txn, session.tasks = txn, give
+    agent.reserve(give)
+    agent.journal.log_prepare(txn, sender, give, swap="offer")
+    await agent.journal.sync()
+
+    reply = msg.make_reply()
+    reply.set_metadata("type", "swap_proposal")
+    reply.body = json.dumps({"txn": txn, "take": agent.catalog.encode(take), "give": agent.catalog.encode(give)})
+    await behaviour.send(reply)
+    agent.metrics.inc("swaps_proposed_total")
+    log.debug(agent, "Обмен %s: беру %s задач, отдаю %s, разница %.2f -> %.2f",
+              txn, len(take), len(give), diff, new_diff, txn=txn)
+
+
+async def handle_swap_proposal(behaviour, msg):
+    """Инициатор принимает задачи отвечающего и отправляет свою половину обмена"""
+    agent = behaviour.agent
+    data = json.loads(msg.body)
+    txn = data["txn"]
+    agent.metrics.stop_timer("swap", txn, peer=str(msg.sender).split('/')[0])
+    session = agent.session_for(msg)
+    if session is None or session.txn != txn or session.offer is None:
+        return  # сессия закрыта: отвечающий повторит свою половину и получит отказ
+    session.touch()
+
+    take = agent.catalog.decode(data["take"])
+    give = agent.catalog.decode(data["give"])
+    offered = {task["id"] for task in session.offer}
+    if any(task["id"] not in offered for task in take):
+        log.warning(agent, "Обмен %s: %s просит задачи, которых не было в предложении", txn, session.jid, txn=txn)
+        agent.close_session(session)
+        return
+
+    agent.accept_tasks(txn, give)
+    agent.journal.log_prepare(txn, session.jid, take, swap="accept")
+    # Задачи предложения, которые не взяли, снова доступны; взятые остаются в резерве до commit
+    taken = {task["id"] for task in take}
+    agent.release([task for task in session.offer if task["id"] not in taken])
+    session.offer, session.tasks = None, take
+    await agent.journal.sync()
+
+    agent.save_plan()
+    await send_transfer_request(behaviour, session, txn, take, swap="accept")
+    agent.metrics.inc("swaps_accepted_total")
+    log.info(agent, "Обмен %s с %s: получено задач %s, отдаю %s", txn, session.jid, len(give), len(take),
+             txn=txn, tasks=len(give) + len(take))
+
+
+async def handle_swap_reject(behaviour, msg):
+    agent = behaviour.agent
+    session = agent.session_for(msg)
+    if session is None or session.txn != json.loads(msg.body).get("txn"):
+        return
+    agent.metrics.stop_timer("swap", session.txn, peer=session.jid)
+    agent.attempts_to_balancing -= 1
+    agent.close_session(session)
+    agent.back_off_balancing()
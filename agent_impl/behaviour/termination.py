@@ -0,0 +1,220 @@
+import asyncio
+import json
+from collections import Counter
+from spade.behaviour import PeriodicBehaviour
+from spade.message import Message
+from agent_impl.behaviour.alive import probe
+from agent_impl.behaviour.piggyback import PiggybackMixin
+from common.event_log import get_log
+
+log = get_log("TERMINATION")
+
+# Сообщения, после которых получатель может снова начать переносы задач: их учитывает маркер
+WORK_MESSAGES = ("transfer_request", "swap_request", "balance_order", "task_assign")
+
+
+def is_work(msg):
+    return msg.get_metadata("type") in WORK_MESSAGES
+
+
+class TerminationBehaviour(PiggybackMixin, PeriodicBehaviour):
+    """Обнаружение глобального завершения балансировки: маркер по кольцу всех агентов (алгоритм Сафры).
+
+    Агент пассивен (WorkerAgent.passive), когда попытки балансировки кончились и нет открытых
+    сессий; пассивный агент сам ничего не начинает, его может разбудить только рабочее
+    сообщение (WORK_MESSAGES). Каждый агент считает рабочие сообщения, отправленные каждому
+    соседу и полученные от него, и становится "черным", получив рабочее сообщение.
+
+    Инициатор - первый живой агент кольца (ring). Он отправляет белый маркер по кольцу; агент
+    передает маркер дальше, только когда пассивен: прибавляет к нему свою разность отправленных
+    и полученных сообщений, красит маркер в черный, если сам черный, и снова становится белым.
+    Если маркер вернулся белым, инициатор бел и пассивен, а сумма равна нулю, то ни одного рабочего
+    сообщения нет в пути и ни один агент не может начать перенос: инициатор рассылает terminate,
+    и все агенты останавливаются. Иначе - новая волна.
+
+    Отказы: сообщения с соседями, которых агент считает отказавшими, в разность не входят;
+    следующий в кольце подтверждает маркер (termination_ack), неподтвержденный за HEARTBEAT_INTERVAL
+    маркер уходит следующему за ним агенту. Волна без ответа дольше TERMINATION_WAVE_TIMEOUT
+    повторяется (устаревшие волны отбрасываются по номеру).
+    Инициатора, от которого нет ни маркера, ни других сообщений дольше TERMINATION_WAVE_TIMEOUT,
+    пассивный агент проверяет heartbeat: отказавший инициатор попадет под подозрение, и волны
+    начнет следующий живой агент кольца.
+    """
+
+    def __init__(self, ring, period):
+        super().__init__(period=period)
+        self.ring = ring  # jid всех агентов системы, одинаковый порядок у всех
+        self.sent_to = Counter()
+        self.received_from = Counter()
+        self.black = False
+        self.tokens = {}  # инициатор -> маркер, который ждет, пока агент станет пассивным
+        self.waves = {}  # инициатор -> номер последней увиденной волны
+        self.wave = 0  # своя волна, если агент - инициатор
+        self.wave_started = None
+        self.unacked = None  # (получатель, маркер, время отправки)
+        self.quiet_since = None  # последний полученный маркер или начало ожидания
+
+    def sent(self, msg):
+        if is_work(msg):
+            self.sent_to[str(msg.to).split('/')[0]] += 1
+
+    def received(self, msg):
+        if is_work(msg):
+            self.received_from[str(msg.sender).split('/')[0]] += 1
+            self.black = True
+
+    def count(self):
+        """Отправлено минус получено рабочих сообщений - только с соседями, которых агент считает живыми"""
+        membership = self.agent.membership
+        return sum(n for jid, n in self.sent_to.items() if membership.is_alive(jid)) - \
+            sum(n for jid, n in self.received_from.items() if membership.is_alive(jid))
+
+    def initiator(self):
+        me = str(self.agent.jid)
+        return next((jid for jid in self.ring if jid == me or self.agent.membership.is_alive(jid)), me)
+
+    def successor(self, after=None):
+        """Следующий живой агент кольца после after (по умолчанию - после себя)"""
+        me = str(self.agent.jid)
+        index = self.ring.index(after or me)
+        for jid in self.ring[index + 1:] + self.ring[:index]:
+            if jid == me:
+                break
+            if self.agent.membership.is_alive(jid):
+                return jid
+        return None
+
+    async def run(self):
+        agent = self.agent
+        await agent.ready.wait()
+        try:
+            if agent.terminated:
+                return
+            await self.check_ack()
+            if not agent.passive():
+                return
+            await self.pass_tokens()
+            if agent.terminated:
+                return
+            now = asyncio.get_running_loop().time()
+            if self.quiet_since is None:
+                self.quiet_since = now
+            if self.initiator() != str(agent.jid):
+                await self.check_initiator(now)
+                return
+            if self.wave_started is None or now - self.wave_started > agent.TERMINATION_WAVE_TIMEOUT:
+                await self.start_wave()
+        except Exception as e:
+            log.error(agent, "Ошибка: %s", e)
+
+    async def check_initiator(self, now):
+        """heartbeat инициатору, если давно нет ни его маркеров, ни других его сообщений"""
+        agent = self.agent
+        initiator = self.initiator()
+        last_heard, last_sent = agent.membership.last_heard(initiator), agent.membership.last_sent(initiator)
+        timeout = agent.TERMINATION_WAVE_TIMEOUT
+        if now - self.quiet_since > timeout and (last_heard is None or now - last_heard > timeout) \
+                and (last_sent is None or now - last_sent > agent.HEARTBEAT_INTERVAL):
+            await probe(self, initiator)
+
+    async def start_wave(self):
+        agent = self.agent
+        self.wave += 1
+        self.wave_started = asyncio.get_running_loop().time()
+        self.black = False
+        agent.metrics.inc("termination_waves_total")
+        token = {"initiator": str(agent.jid), "wave": self.wave, "count": 0, "black": False}
+        await self.send_token(token, self.successor())
+
+    async def pass_tokens(self):
+        """Передает дальше маркеры, которые ждали, пока агент станет пассивным"""
+        me = str(self.agent.jid)
+        for initiator, token in list(self.tokens.items()):
+            del self.tokens[initiator]
+            if initiator == me:
+                await self.finish_wave(token)
+            else:
+                token["count"] += self.count()
+                token["black"] = token["black"] or self.black
+                self.black = False
+                await self.send_token(token, self.successor())
+
+    async def send_token(self, token, to):
+        if to is None:
+            # Агент в кольце один: волна сразу вернулась
+            await self.finish_wave(token)
+            return
+        msg = Message(to=to)
+        msg.set_metadata("type", "termination_token")
+        msg.body = json.dumps(token)
+        self.unacked = (to, token, asyncio.get_running_loop().time())
+        await self.send(msg)
+
+    async def check_ack(self):
+        """Маркер, не подтвержденный следующим агентом, уходит агенту после него"""
+        if self.unacked is None:
+            return
+        to, token, sent_at = self.unacked
+        if asyncio.get_running_loop().time() - sent_at <= self.agent.HEARTBEAT_INTERVAL:
+            return
+        self.agent.membership.failed(to)
+        log.warning(self.agent, "%s не подтвердил маркер, передаю следующему", to)
+        await self.send_token(token, self.successor(after=to))
+
+    async def finish_wave(self, token):
+        agent = self.agent
+        if token["wave"] != self.wave:
+            return  # устаревшая волна
+        self.wave_started = None  # новая волна - на следующем шаге
+        if token["black"] or self.black or token["count"] + self.count() != 0:
+            return
+        log.info(agent, "Балансировка завершена во всей системе (волна %s), рассылаю остановку", self.wave)
+        for jid in self.ring:
+            if jid != str(agent.jid):
+                msg = Message(to=jid)
+                msg.set_metadata("type", "terminate")
+                msg.body = json.dumps({"wave": self.wave})
+                await self.send(msg)
+        await terminate(agent)
+
+
+async def terminate(agent):
+    agent.terminated = True
+    agent.metrics.inc("terminations_total")
+    await agent.stop()
+
+
+async def handle_termination_token(behaviour, msg):
+    agent = behaviour.agent
+    sender = str(msg.sender).split('/')[0]
+    ack = Message(to=sender)
+    ack.set_metadata("type", "termination_ack")
+    await behaviour.send(ack)
+
+    termination = agent.termination
+    if termination is None or agent.terminated:
+        return
+    token = json.loads(msg.body)
+    initiator = token["initiator"]
+    if token["wave"] < termination.waves.get(initiator, 0):
+        return  # маркер прошлой волны, новая уже прошла
+    termination.waves[initiator] = token["wave"]
+    termination.quiet_since = None
+    termination.tokens[initiator] = token
+    if agent.passive():
+        await termination.pass_tokens()
+
+
+async def handle_termination_ack(behaviour, msg):
+    termination = behaviour.agent.termination
+    if termination is not None and termination.unacked is not None \
+            and termination.unacked[0] == str(msg.sender).split('/')[0]:
+        termination.unacked = None
+
+
+async def handle_terminate(behaviour, msg):
+    agent = behaviour.agent
+    if agent.terminated:
+        return
+    log.info(agent, "Получена остановка от %s: балансировка завершена во всей системе", msg.sender)
+    await terminate(agent)
@@ -1,116 +1,144 @@
 import json
-from spade.behaviour import CyclicBehaviour
-from common.get_time import get_time
-from spade.message import Message
+from common.event_log import get_log
+from agent_impl.behaviour.transfer import send_transfer_request
+from agent_impl.behaviour.swap import start_swap
+from common.plan_journal import new_txn_id
 
+log = get_log("TIME")
 
-class TimeRequestBehaviour(CyclicBehaviour):
-    """Обработка запросов веса от других агентов"""
-
-    async def run(self):
-        msg = await self.receive(timeout=10)
-        if msg and msg.get_metadata("type") == "time_request":
-            try:
-                # Отправляем наш текущий вес
-                reply = msg.make_reply()
-                reply.set_metadata("type", "time_reply")
-                self.agent.calculate_time()
-                reply.body = json.dumps({"time": self.agent.my_total_task_time})
-                await self.send(reply)
-                print(
-                    f"{get_time()} [TimeRequestBehaviour] {self.agent.jid}: Отправлен вес {self.agent.my_total_task_time} для {msg.sender}")
-            except Exception as e:
-                print(f"{get_time()} [TimeRequestBehaviour] {self.agent.jid}: Ошибка обработки запроса веса: {e}")
-                error_reply = msg.make_reply()
-                error_reply.set_metadata("type", "time_reply_error")
-                error_reply.body = json.dumps({"error": str(e)})
-                await self.send(error_reply)
-
-
-class TimeReplyBehaviour(CyclicBehaviour):
-    """Обработка запросов веса от других агентов"""
 
-    async def run(self):
-        msg = await self.receive(timeout=10)
-        if (msg and
-                msg.get_metadata("type") == "time_reply" and
-                self.agent.neighbor_choice and
-                str(msg.sender).split('/')[0] == self.agent.neighbor_choice[0]):
-            try:
-                neighbor_data = json.loads(msg.body)
-                neighbor_time = neighbor_data["time"]
-                print(f"{get_time()} [TimeReplyBehaviour] {self.agent.jid}:"
-                      f" Трудозатраты соседа {self.agent.neighbor_choice} = {neighbor_time}")
-
-                # Шаг 4: Принятие решения
-                average_time = (self.agent.my_total_task_time + neighbor_time) / 2
-                time_diff = abs(self.agent.my_total_task_time - neighbor_time)
-                threshold_value = self.agent.BALANCE_THRESHOLD * average_time
-
-                print(
-                    f"{get_time()} [TimeReplyBehaviour] {self.agent.jid}:"
-                    f" Мой вес = {self.agent.my_total_task_time:.2f}, вес соседа = {neighbor_time:.2f}, порог = {threshold_value:.2f}")
-
-                # Проверка сбалансированности
-                if time_diff <= threshold_value:
-                    print(
-                        f"{get_time()} [TimeReplyBehaviour] {self.agent.jid}: Задачи сбалансированы, завершаю раунд")
-                    self.agent.attempts_to_balancing -= 1
-                    return
-
-                # Если мой вес значительно больше
-                if self.agent.my_total_task_time > neighbor_time + threshold_value:
-                    print(
-                        f"{get_time()} [TimeReplyBehaviour] {self.agent.jid}:"
-                        f" У меня задач больше, инициирую передачу задачи")
-
-                    # Шаг 5: Выбор объекта для передачи
-                    target_time = average_time
-                    time_to_shed = self.agent.my_total_task_time - target_time + threshold_value
-
-                    self.agent.transfer_object = self.agent.find_best_object_to_transfer(time_to_shed)
-
-                    if not self.agent.transfer_object:
-                        print(f"{get_time()} [TimeReplyBehaviour] {self.agent.jid}: Нет задач для передачи")
-                        self.agent.neighbor_choice = None
-                        return
-
-                    print(
-                        f"{get_time()} [TimeReplyBehaviour] {self.agent.jid}: Выбрана задача для передачи: {self.agent.transfer_object}")
-
-                    # Шаг 6: Транзакция передачи
-                    transfer_msg = Message(to=self.agent.neighbor_choice[0])
-                    transfer_msg.set_metadata("type", "transfer_request")
-                    transfer_msg.body = json.dumps({
-                        "object": self.agent.transfer_object,
-                        "expected_time": self.agent.my_total_task_time - self.agent.transfer_object["time"]
-                    })
-
-                    await self.send(transfer_msg)
-                    print(f"{get_time()} [TimeReplyBehaviour] {self.agent.jid}: Отправлен запрос на передачу задачи")
-                else:
-                    self.agent.attempts_to_balancing -= 1
-                    self.agent.neighbor_choice = None
-                    self.agent.transfer_object = None
-
-            except Exception as e:
-                self.agent.neighbor_choice = None
-                self.agent.transfer_object = None
-                print(f"{get_time()} [TimeReplyBehaviour] {self.agent.jid}: Ошибка: {e}")
-
-
-class TimeReplyErrorBehaviour(CyclicBehaviour):
+async def handle_time_request(behaviour, msg):
     """Обработка запросов веса от других агентов"""
-
-    async def run(self):
-        msg = await self.receive(timeout=10)
-        if (msg and
-                msg.get_metadata("type") == "time_reply_error" and
-                self.agent.neighbor_choice and
-                str(msg.sender).split('/')[0] == self.agent.neighbor_choice[0]):
-            neighbor_data = json.loads(msg.body)
-            neighbor_error = neighbor_data["error"]
-            print(f"{get_time()} [TimeReplyErrorBehaviour] {self.agent.jid}:"
-                  f" {self.agent.neighbor_choice} ответил ошибкой {neighbor_error}")
-            self.agent.neighbor_choice = None
-            self.agent.transfer_object = None
\ No newline at end of file
+    agent = behaviour.agent
+    try:
+        # Отправляем наш текущий вес
+        reply = msg.make_reply()
+        reply.set_metadata("type", "time_reply")
+        agent.calculate_time()
+        reply.body = json.dumps({"time": agent.my_total_task_time})
+        await behaviour.send(reply)
+        log.debug(agent, "Отправлен вес %s для %s", agent.my_total_task_time, msg.sender)
+    except Exception as e:
+        log.error(agent, "Ошибка обработки запроса веса: %s", e)
+        error_reply = msg.make_reply()
+        error_reply.set_metadata("type", "time_reply_error")
+        error_reply.body = json.dumps({"error": str(e)})
+        await behaviour.send(error_reply)
+
+
+async def handle_time_reply(behaviour, msg):
+    """Обработка веса, присланного соседом в ответ на запрос сессии"""
+    agent = behaviour.agent
+    agent.metrics.stop_timer("time", msg.thread, peer=str(msg.sender).split('/')[0])
+    session = agent.session_for(msg)
+    if session is None:
+        return
+    session.touch()
+    try:
+        neighbor_data = json.loads(msg.body)
+        neighbor_time = neighbor_data["time"]
+        log.debug(agent, "Трудозатраты соседа %s = %s", session.jid, neighbor_time)
+
+        await start_transfer(behaviour, session, neighbor_time)
+
+    except Exception as e:
+        agent.close_session(session)
+        log.error(agent, "Ошибка: %s", e)
+
+
+async def handle_time_reply_error(behaviour, msg):
+    """Обработка ошибки, которой сосед ответил на запрос веса"""
+    agent = behaviour.agent
+    sender = str(msg.sender).split('/')[0]
+    agent.metrics.stop_timer("time", msg.thread, peer=sender)
+    agent.metrics.inc("time_errors_total", peer=sender)
+    session = agent.session_for(msg)
+    if session is None:
+        return
+    neighbor_data = json.loads(msg.body)
+    neighbor_error = neighbor_data["error"]
+    log.warning(agent, "%s ответил ошибкой %s", session.jid, neighbor_error)
+    agent.close_session(session)
+
+
+async def start_transfer(behaviour, session, neighbor_time):
+    """Шаги 4-6 балансировки в сессии session: решение по весу соседа и отправка пакета задач.
+
+    Вызывается по time_reply или сразу из BalancingBehaviour, если вес соседа
+    известен из кэша agent.peer_loads. Свой вес считается без задач, которые уже
+    передаются в других сессиях.
+    """
+    agent = behaviour.agent
+    my_time = agent.available_time()
+
+    # Шаг 4: Принятие решения
+    average_time = (my_time + neighbor_time) / 2
+    time_diff = abs(my_time - neighbor_time)
+    threshold_value = agent.BALANCE_THRESHOLD * average_time
+
+    log.debug(agent, "Мой вес = %.2f, вес соседа = %.2f, порог = %.2f",
+              my_time, neighbor_time, threshold_value)
+
+    # Проверка сбалансированности
+    if time_diff <= threshold_value:
+        log.debug(agent, "Задачи сбалансированы, завершаю раунд")
+        agent.metrics.inc("balancing_decisions_total", decision="balanced")
+        agent.attempts_to_balancing -= 1
+        agent.close_session(session)
+        agent.back_off_balancing()
+        return
+
+    # Если мой вес значительно больше
+    if my_time > neighbor_time + threshold_value:
+        log.debug(agent, "У меня задач больше, инициирую передачу задачи")
+
+        # Шаг 5: Выбор объектов для передачи
+        # Пакет подбирается к половине разницы, без запаса threshold_value, как было для одной задачи:
+        # иначе после передачи нескольких задач пара "переворачивается" и перекидывает их обратно
+        target_time = average_time
+        time_to_shed = my_time - target_time
+
+        if await send_batch(behaviour, session, time_to_shed):
+            return
+        # Все задачи крупнее половины разницы: пробуем обменяться задачами с соседом
+        if await start_swap(behaviour, session):
+            return
+        log.debug(agent, "Нет задач для передачи")
+        agent.metrics.inc("balancing_decisions_total", decision="no_batch")
+        agent.attempts_to_balancing -= 1
+        agent.close_session(session)
+        agent.back_off_balancing()
+    else:
+        agent.metrics.inc("balancing_decisions_total", decision="neighbor_heavier")
+        agent.attempts_to_balancing -= 1
+        agent.close_session(session)
+        agent.back_off_balancing()
+
+
+async def send_batch(behaviour, session, time_to_shed):
+    """Шаги 5-6: пакет задач с суммой, ближайшей к time_to_shed, - напарнику сессии.
+
+    False, если подходящих задач нет (сессия остается открытой).
+    """
+    agent = behaviour.agent
+    transfer_objects = agent.find_best_objects_to_transfer(time_to_shed, session.peer)
+    if not transfer_objects:
+        return False
+
+    transfer_time = sum(item["time"] for item in transfer_objects)
+    log.debug(agent, "Выбрано задач для передачи: %s, трудозатраты %.2f",
+              len(transfer_objects), transfer_time)
+
+    # Шаг 6: Транзакция передачи - весь пакет одним запросом.
+    # Намерение передать пакет фиксируется в журнале до отправки: после сбоя передача
+    # будет повторена с тем же txn, а не потеряна или задублирована.
+    # Задачи резервируются сразу, до ожидания fsync: другие сессии их уже не выберут
+    txn, to = new_txn_id(), session.jid
+    agent.metrics.inc("balancing_decisions_total", decision="transfer")
+    session.txn, session.tasks = txn, transfer_objects
+    agent.reserve(transfer_objects)
+    agent.journal.log_prepare(txn, to, transfer_objects)
+    await agent.journal.sync()
+    await send_transfer_request(behaviour, session, txn, transfer_objects)
+    log.debug(agent, "Отправлен запрос на передачу задач %s", txn, txn=txn, to=to)
+    return True
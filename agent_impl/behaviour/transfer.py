@@ -1,107 +1,215 @@
 import json
-from spade.behaviour import CyclicBehaviour
-from common.get_time import get_time
-
-
-class TransferRequestBehaviour(CyclicBehaviour):
-    """Обработка запросов на передачу объектов"""
-
-    async def run(self):
-        msg = await self.receive(timeout=10)
-        if msg and msg.get_metadata("type") == "transfer_request":
-            try:
-                data = json.loads(msg.body)
-                transfer_object = data["object"]
-                expected_time = data.get("expected_time", 0)
-
-                print(f"{get_time()} [TransferRequestBehaviour] {self.agent.jid}:"
-                      f" Получен запрос на задачу {transfer_object}")
-
-                # Добавляем объект в свой план
-                self.agent.plan.append(transfer_object)
-                self.agent.calculate_time()
-
-                # Сохраняем план после получения объекта
-                save_success = self.agent.save_plan()
-
-                # Отправляем подтверждение
-                confirm_msg = msg.make_reply()
-                confirm_msg.set_metadata("type", "transfer_confirm")
-                confirm_msg.body = json.dumps({
-                    "received": True,
-                    "new_time": self.agent.my_total_task_time,
-                    "save_success": save_success
-                })
-                await self.send(confirm_msg)
-
-                if save_success:
-                    print(
-                        f"{get_time()} [TransferRequestBehaviour] {self.agent.jid}:"
-                        f" Задача принята. Новый вес: {self.agent.my_total_task_time}. Рюкзак сохранен.")
-                else:
-                    print(
-                        f"{get_time()} [TransferRequestBehaviour] {self.agent.jid}:"
-                        f" Задача принята. Новый вес: {self.agent.my_total_task_time}. Ошибка сохранения рюкзака.")
-
-            except Exception as e:
-                print(
-                    f"{get_time()} [TransferRequestBehaviour] {self.agent.jid}:"
-                    f" Ошибка обработки запроса передачи: {e}")
-                # Отправляем отказ
-                error_reply = msg.make_reply()
-                error_reply.set_metadata("type", "transfer_confirm_error")
-                error_reply.body = json.dumps({"error": str(e)})
-                await self.send(error_reply)
-
-
-class TransferConfirmBehaviour(CyclicBehaviour):
+from spade.message import Message
+from common.event_log import get_log
+
+log = get_log("TRANSFER")
+
+
+async def send_transfer_request(behaviour, session, txn, transfer_objects, swap=None):
+    """Запрос на передачу пакета задач txn напарнику сессии (повторная отправка того же txn безопасна).
+
+    swap - половина обмена задачами (см. agent_impl/behaviour/swap.py): "accept" или "offer".
+    """
+    agent = behaviour.agent
+    transfer_time = sum(item["time"] for item in transfer_objects)
+    transfer_msg = Message(to=session.jid, thread=session.thread)
+    transfer_msg.set_metadata("type", "transfer_request")
+    # Задачи передаются списком ID общего каталога
+    body = {
+        "txn": txn,
+        "ids": agent.catalog.encode(transfer_objects),
+        "expected_time": agent.calculate_time() - transfer_time
+    }
+    if swap:
+        body["swap"] = swap
+    transfer_msg.body = json.dumps(body)
+    agent.metrics.start_timer("transfer", txn)
+    await behaviour.send(transfer_msg)
+
+
+async def handle_transfer_request(behaviour, msg):
     """Обработка запросов на передачу объектов"""
-
-    async def run(self):
-        confirm = await self.receive(timeout=10)
-        if (confirm and
-            confirm.get_metadata("type") == "transfer_confirm" and
-            self.agent.neighbor_choice and
-            str(confirm.sender).split('/')[0] == self.agent.neighbor_choice[0]):
-            try:
-                # Удаляем объект из своего плана
-                self.agent.plan.remove(self.agent.transfer_object)
-                print(
-                    f"{get_time()} [TransferConfirmBehaviour] {self.agent.jid}:"
-                    f" Объект удален: {self.agent.transfer_object}.")
-                self.agent.calculate_time()
-
-                # Сохраняем план после успешной передачи
-                if self.agent.save_plan():
-                    print(
-                        f"{get_time()} [TransferConfirmBehaviour] {self.agent.jid}:"
-                        f" Задача передана. Новые трудозатраты: {self.agent.my_total_task_time}. План сохранен.")
-                else:
-                    print(
-                        f"{get_time()} [TransferConfirmBehaviour] {self.agent.jid}:"
-                        f" Задача передана. Новые трудозатраты: {self.agent.my_total_task_time}. Ошибка сохранения плана.")
-            except Exception as e:
-                print(
-                    f"{get_time()} [TransferConfirmBehaviour] {self.agent.jid}:"
-                    f" Ошибка обработки подтверждения передачи: {e}")
-            self.agent.neighbor_choice = None
-            self.agent.transfer_object = None
-            self.agent.attempts_to_balancing = 20
-
-
-class TransferConfirmErrorBehaviour(CyclicBehaviour):
-    """Обработка запросов на передачу объектов"""
-
-    async def run(self):
-        confirm = await self.receive(timeout=10)
-        if (confirm and
-                confirm.get_metadata("type") == "transfer_confirm_error" and
-                self.agent.neighbor_choice and
-                str(confirm.sender).split('/')[0] == self.agent.neighbor_choice[0]):
-            neighbor_data = json.loads(confirm.body)
-            neighbor_error = neighbor_data["error"]
-            print(
-                f"{get_time()} [TransferConfirmErrorBehaviour] {self.agent.jid}:"
-                f"{self.agent.neighbor_choice} ответил ошибкой {neighbor_error}")
-            self.agent.neighbor_choice = None
-            self.agent.transfer_object = None
\ No newline at end of file
+    agent = behaviour.agent
+    txn = None
+    try:
+        data = json.loads(msg.body)
+        if "ids" in data:
+            transfer_objects = agent.catalog.decode(data["ids"])
+        else:
+            # Агенты прежней версии присылают полные задачи: "objects" или одну в "object" и без txn
+            transfer_objects = agent.catalog.resolve_all(data["objects"] if "objects" in data else [data["object"]])
+        expected_time = data.get("expected_time", 0)
+        txn = data.get("txn")
+
+        log.debug(agent, "Получен запрос на %s задач(и)", len(transfer_objects))
+
+        if agent.journal.has_applied(txn):
+            # Отправитель не получил подтверждение (потеря ответа или его перезапуск) - задачи уже у нас
+            log.info(agent, "Пакет %s уже принят, повторяю подтверждение", txn, txn=txn)
+            agent.metrics.inc("transfers_duplicate_total")
+            await send_transfer_confirm(behaviour, msg, txn, True)
+            return
+
+        if data.get("swap") == "offer":
+            # Половина обмена, которую мы не приняли (предложение потерялось или сессия закрыта):
+            # отказываем, и больше этот обмен не примем
+            decline_swap(agent, txn)
+            raise ValueError(f"обмен {txn} не принят")
+        if data.get("swap") == "accept":
+            # Напарник принял нашу половину обмена: сначала фиксируем ее, затем принимаем его задачи
+            commit_swap_half(agent, txn, str(msg.sender).split('/')[0])
+
+        # Добавляем объекты в свой план: принимается весь пакет или ничего
+        agent.accept_tasks(txn, transfer_objects)
+
+    except Exception as e:
+        log.error(agent, "Ошибка обработки запроса передачи: %s", e)
+        agent.metrics.inc("transfers_rejected_total")
+        # Отправляем отказ
+        error_reply = msg.make_reply()
+        error_reply.set_metadata("type", "transfer_confirm_error")
+        error_reply.body = json.dumps({"txn": txn, "error": str(e)})
+        await behaviour.send(error_reply)
+        return
+
+    # Подтверждаем только после fsync журнала: принятые задачи переживут сбой.
+    # Если fsync не удался, ответа нет - отправитель повторит тот же txn
+    await agent.journal.sync()
+
+    # Сохраняем план после получения объекта (запись в фоне, серия изменений - одна запись)
+    save_success = agent.save_plan()
+    await send_transfer_confirm(behaviour, msg, txn, save_success)
+    agent.metrics.inc("transfers_received_total")
+    agent.metrics.inc("tasks_received_total", len(transfer_objects))
+    # Новые задачи могли нарушить баланс с другими соседями
+    agent.wake_balancing()
+
+    if save_success:
+        log.info(agent, "Задачи приняты (%s). Новый вес: %s. Рюкзак будет сохранен.",
+                 len(transfer_objects), agent.my_total_task_time,
+                 txn=txn, tasks=len(transfer_objects), load=agent.my_total_task_time)
+    else:
+        log.warning(agent, "Задачи приняты (%s). Новый вес: %s. Ошибка сохранения рюкзака.",
+                    len(transfer_objects), agent.my_total_task_time)
+
+
+async def send_transfer_confirm(behaviour, msg, txn, save_success):
+    confirm_msg = msg.make_reply()
+    confirm_msg.set_metadata("type", "transfer_confirm")
+    confirm_msg.body = json.dumps({
+        "txn": txn,
+        "received": True,
+        "new_time": behaviour.agent.calculate_time(),
+        "save_success": save_success
+    })
+    await behaviour.send(confirm_msg)
+
+
+def commit_swap_half(agent, txn, sender):
+    """Снимает с плана нашу половину обмена txn, если она еще не зафиксирована"""
+    entry = agent.journal.pending.get(txn)
+    if entry is None or entry.get("swap") != "offer" or entry["to"] != sender:
+        return
+    for task in entry["tasks"]:
+        agent.plan.remove(task)
+    agent.journal.log_commit(txn)
+    agent.release(entry["tasks"])
+    session = next((s for s in agent.sessions.values() if s.txn == txn), None)
+    if session is not None:
+        agent.close_session(session)
+    agent.metrics.inc("swaps_committed_total")
+    log.info(agent, "Обмен %s: отдано задач %s", txn, len(entry["tasks"]), txn=txn, tasks=len(entry["tasks"]))
+
+
+def decline_swap(agent, txn):
+    """Отказ от обмена txn, предложенного нами: сессия закрывается, предложенные задачи освобождаются"""
+    session = next((s for s in agent.sessions.values() if s.txn == txn and s.offer is not None), None)
+    if session is not None:
+        agent.close_session(session)
+
+
+def _pending_transfer(agent, confirm):
+    """txn и запись журнала передачи, к которой относится ответ получателя, или (txn, None)"""
+    data = json.loads(confirm.body) if confirm.body else {}
+    txn = data.get("txn")
+    if txn is None:
+        # Агенты прежней версии отвечают без txn - передача определяется по сессии
+        session = agent.session_for(confirm)
+        txn = session.txn if session is not None else None
+    entry = agent.journal.pending.get(txn)
+    if entry is None or entry["to"] != str(confirm.sender).split('/')[0]:
+        return txn, None
+    return txn, entry
+
+
+def _finish_session(agent, confirm, txn):
+    session = agent.session_for(confirm)
+    if session is None:
+        # Ответ пришел после таймаута сессии или на повторную отправку
+        session = next((s for s in agent.sessions.values() if s.txn == txn), None)
+    if session is not None:
+        agent.close_session(session)
+
+
+async def handle_transfer_confirm(behaviour, confirm):
+    """Обработка подтверждения передачи объектов.
+
+    Подтверждение фиксирует передачу, даже если сессия уже закрыта по таймауту:
+    получатель задачи принял, и они снимаются с плана и с резерва.
+    """
+    agent = behaviour.agent
+    sender = str(confirm.sender).split('/')[0]
+    txn, entry = _pending_transfer(agent, confirm)
+    agent.metrics.stop_timer("transfer", txn, peer=sender)
+    _finish_session(agent, confirm, txn)
+    if entry is None:
+        return  # запоздавшее подтверждение уже завершенной передачи
+    transfer_objects = entry["tasks"]
+    try:
+        # Удаляем переданные объекты из своего плана: все или ни одного, как accept_tasks,
+        # иначе план разойдется с журналом, в котором передача еще не зафиксирована
+        removed = []
+        try:
+            for transfer_object in transfer_objects:
+                agent.plan.remove(transfer_object)
+                removed.append(transfer_object)
+        except Exception:
+            for transfer_object in removed:
+                agent.plan.append(transfer_object)
+            raise
+        agent.journal.log_commit(txn)
+        agent.release(transfer_objects)
+        log.debug(agent, "Удалено объектов: %s.", len(transfer_objects))
+        agent.metrics.inc("transfers_committed_total")
+        agent.metrics.inc("tasks_sent_total", len(transfer_objects))
+        agent.calculate_time()
+
+        # Сохраняем план после успешной передачи
+        if agent.save_plan():
+            log.info(agent, "Задачи переданы (%s). Новые трудозатраты: %s. План будет сохранен.",
+                     len(transfer_objects), agent.my_total_task_time,
+                     txn=txn, tasks=len(transfer_objects), load=agent.my_total_task_time)
+        else:
+            log.warning(agent, "Задачи переданы (%s). Новые трудозатраты: %s. Ошибка сохранения плана.",
+                        len(transfer_objects), agent.my_total_task_time)
+    except Exception as e:
+        log.error(agent, "Ошибка обработки подтверждения передачи: %s", e)
+    agent.attempts_to_balancing = 20
+    agent.wake_balancing()
+
+
+async def handle_transfer_confirm_error(behaviour, confirm):
+    """Обработка отказа в передаче объектов"""
+    agent = behaviour.agent
+    sender = str(confirm.sender).split('/')[0]
+    txn, entry = _pending_transfer(agent, confirm)
+    agent.metrics.stop_timer("transfer", txn, peer=sender)
+    agent.metrics.inc("transfers_failed_total", peer=sender)
+    _finish_session(agent, confirm, txn)
+    if entry is None:
+        return
+    neighbor_error = json.loads(confirm.body)["error"]
+    log.warning(agent, "%s ответил ошибкой %s", sender, neighbor_error)
+    # Получатель откатил пакет целиком - задачи остаются у нас и снова доступны для передачи
+    agent.journal.log_abort(txn)
+    agent.release(entry["tasks"])
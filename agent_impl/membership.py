@@ -0,0 +1,152 @@
+import asyncio
+import math
+from collections import deque
+
+
+class Membership:
+    """Таблица соседей с оценкой подозрения в отказе (phi accrual failure detector).
+
+    Каждое сообщение соседа - сигнал, что он жив (с нагрузкой в метаданных, см. PiggybackMixin);
+    отдельные heartbeat получают только соседи, от которых агент ждет ответа (CheckAgentAlive).
+    По интервалам между сигналами оценивается их среднее, и phi = -log10 P(пауза не меньше текущей)
+    при экспоненциальном распределении интервалов: phi = пауза / среднее * log10(e).
+
+    Под подозрение в отказе попадает сосед, не ответивший за probe_timeout на heartbeat (probed),
+    с неудачным обменом после последнего сигнала (failed) или с phi > threshold, пока агент ждет
+    от него ответа (update). Молчание соседа, с которым нет обмена, отказом не считается: когда
+    все сбалансированы, сообщений нет. Подозреваемый сосед не выбирается для балансировки;
+    первое же его сообщение возвращает его в число живых.
+    """
+
+    def __init__(self, threshold, min_interval, expected_interval, probe_timeout, window=100):
+        self.threshold = threshold
+        self.probe_timeout = probe_timeout
+        # Сообщения одного обмена идут пачкой: сигналы чаще min_interval не дают новых интервалов
+        self.min_interval = min_interval
+        # Пока идет обмен, сообщения чаще, но пауза не длиннее этого интервала (через него
+        # молчащему напарнику уходит heartbeat) - не признак отказа, поэтому среднее не бывает меньше
+        self.expected_interval = expected_interval
+        self.window = window
+        self._peers = {}  # jid -> _PeerState
+        self._suspected = set()
+
+    @staticmethod
+    def _now():
+        return asyncio.get_running_loop().time()
+
+    def heard(self, jid):
+        """Сообщение от соседа; True, если он был под подозрением и вернулся"""
+        now = self._now()
+        state = self._peers.get(jid)
+        if state is None:
+            state = self._peers[jid] = _PeerState(self.window)
+        state.heard(now, self.min_interval)
+        state.probe_at = None
+        state.probes = 0
+        if jid in self._suspected:
+            self._suspected.discard(jid)
+            return True
+        return False
+
+    def sent(self, jid):
+        state = self._peers.get(jid)
+        if state is None:
+            state = self._peers[jid] = _PeerState(self.window)
+        state.last_sent = self._now()
+
+    def probed(self, jid):
+        """Отправлен heartbeat с просьбой ответить; ответ ждем probe_timeout секунд"""
+        state = self._peers.get(jid)
+        if state is None:
+            state = self._peers[jid] = _PeerState(self.window)
+        if state.probe_at is None:
+            state.probe_at = self._now()
+        if jid in self._suspected:
+            state.probes += 1
+
+    def failed(self, jid):
+        """Сосед не ответил (сессия закрыта по таймауту): подозревается до следующего сообщения"""
+        self._suspected.add(jid)
+
+    def phi(self, jid):
+        state = self._peers.get(jid)
+        if state is None or state.last_heard is None:
+            return 0.0
+        mean = max(state.mean_interval(), self.expected_interval)
+        return (self._now() - state.last_heard) / mean * math.log10(math.e)
+
+    def is_alive(self, jid):
+        return jid not in self._suspected
+
+    def update(self, waiting):
+        """Пересчитывает подозрения: проверки без ответа и phi соседей, от которых ждем ответа (waiting).
+
+        Возвращает соседей, попавших под подозрение сейчас.
+        """
+        now = self._now()
+        waiting = set(waiting)
+        newly = []
+        for jid, state in self._peers.items():
+            if jid in self._suspected:
+                continue
+            unanswered = state.probe_at is not None and now - state.probe_at > self.probe_timeout
+            if unanswered or (jid in waiting and self.phi(jid) > self.threshold):
+                self._suspected.add(jid)
+                newly.append(jid)
+        return newly
+
+    def live(self, agents_info):
+        """Соседи из списка [jid, ...], не подозреваемые в отказе"""
+        if not self._suspected:
+            return list(agents_info)
+        return [info for info in agents_info if info[0] not in self._suspected]
+
+    def suspected(self):
+        return set(self._suspected)
+
+    def due_for_probe(self, jids, interval):
+        """Подозреваемые из jids, которых пора проверить снова: пауза после k-й проверки - interval * 2^k (не больше 32)"""
+        now = self._now()
+        due = []
+        for jid in self._suspected & set(jids):
+            state = self._peers.get(jid)
+            if state is None or state.last_sent is None \
+                    or now - state.last_sent >= interval * 2 ** min(state.probes, 5):
+                due.append(jid)
+        return due
+
+    def last_heard(self, jid):
+        state = self._peers.get(jid)
+        return state.last_heard if state is not None else None
+
+    def last_sent(self, jid):
+        state = self._peers.get(jid)
+        return state.last_sent if state is not None else None
+
+
+class _PeerState:
+    def __init__(self, window):
+        self.intervals = deque(maxlen=window)
+        self.interval_sum = 0.0
+        self.last_heard = None
+        self.last_counted = None
+        self.last_sent = None
+        self.probe_at = None  # время heartbeat без ответа
+        self.probes = 0  # проверок подряд, пока сосед под подозрением
+
+    def heard(self, now, min_interval):
+        self.last_heard = now
+        if self.last_counted is None:
+            self.last_counted = now
+            return
+        interval = now - self.last_counted
+        if interval < min_interval:
+            return
+        if len(self.intervals) == self.intervals.maxlen:
+            self.interval_sum -= self.intervals[0]
+        self.intervals.append(interval)
+        self.interval_sum += interval
+        self.last_counted = now
+
+    def mean_interval(self):
+        return self.interval_sum / len(self.intervals) if self.intervals else 0.0
@@ -0,0 +1,52 @@
+import asyncio
+
+
+class PeerLoadCache:
+    """Трудозатраты соседей, полученные из метаданных их сообщений (load, load_ts).
+
+    Запись считается свежей ttl секунд с момента получения; время берется из event loop,
+    поэтому в симуляции с виртуальными часами TTL тоже идет по виртуальному времени.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._loads = {}  # jid -> (трудозатраты, отметка времени отправителя, время получения)
+
+    @staticmethod
+    def _now():
+        return asyncio.get_running_loop().time()
+
+    def update(self, jid, load, stamp):
+        current = self._loads.get(jid)
+        # Сообщения могут прийти не по порядку: более старые данные не затирают новые
+        if current is not None and current[1] > stamp:
+            return
+        self._loads[jid] = (load, stamp, self._now())
+
+    def update_from_message(self, msg):
+        load, stamp = msg.get_metadata("load"), msg.get_metadata("load_ts")
+        if load is None or stamp is None:
+            return
+        try:
+            self.update(str(msg.sender).split('/')[0], float(load), float(stamp))
+        except ValueError:
+            pass
+
+    def get(self, jid):
+        """Свежие трудозатраты соседа или None"""
+        entry = self._loads.get(jid)
+        if entry is None:
+            return None
+        if self._now() - entry[2] > self.ttl:
+            del self._loads[jid]
+            return None
+        return entry[0]
+
+    def least_loaded(self, agents_info):
+        """Наименее загруженный сосед из списка [jid, специализации] среди тех, чья нагрузка известна"""
+        best = None
+        for agent_info in agents_info:
+            load = self.get(agent_info[0])
+            if load is not None and (best is None or load < best[1]):
+                best = (agent_info, load)
+        return best
@@ -0,0 +1,198 @@
+from bisect import bisect_left, insort
+from heapq import merge
+from itertools import count, islice
+from common.specializations import spec_mask
+
+
+class Plan:
+    """План агента с индексом для быстрого выбора задач на передачу.
+
+    Задачи сгруппированы по маске специализаций (common/specializations.py), внутри группы
+    отсортированы по time; совместимость группы с соседом - одна проверка маски.
+    Общие трудозатраты пересчитываются при append/remove, а не суммированием всего плана.
+    """
+
+    def __init__(self, tasks=None):
+        self._tasks = {}  # порядковый номер -> задача, в порядке добавления
+        self._groups = {}  # маска специализаций -> отсортированный список (time, номер)
+        self._seq = count()
+        self._total = 0.0
+        self._compensation = 0.0  # поправка Неймайера, чтобы сумма не "плыла" после append/remove
+        for task in tasks or []:
+            self.append(task)
+
+    @staticmethod
+    def _key(task):
+        # У задач каталога маска уже посчитана
+        mask = task.get("spec_mask")
+        return mask if mask is not None else spec_mask(task["specializations"])
+
+    def _add_to_total(self, value):
+        total = self._total + value
+        if abs(self._total) >= abs(value):
+            self._compensation += (self._total - total) + value
+        else:
+            self._compensation += (value - total) + self._total
+        self._total = total
+
+    @property
+    def total_time(self):
+        return self._total + self._compensation
+
+    def append(self, task):
+        task_time, key = task["time"], self._key(task)
+        seq = next(self._seq)
+        self._tasks[seq] = task
+        insort(self._groups.setdefault(key, []), (task_time, seq))
+        self._add_to_total(task_time)
+
+    def remove(self, task):
+        """Удаляет задачу, как list.remove: сначала тот же объект, иначе равная задача"""
+        key = self._key(task)
+        group = self._groups.get(key, [])
+        start = bisect_left(group, (task["time"],))
+        end = start
+        while end < len(group) and group[end][0] == task["time"]:
+            end += 1
+
+        candidates = range(start, end)
+        index = next((i for i in candidates if self._tasks[group[i][1]] is task), None)
+        if index is None:
+            index = next((i for i in candidates if self._tasks[group[i][1]] == task), None)
+        if index is None:
+            raise ValueError("Plan.remove(x): x not in plan")
+
+        _, seq = group.pop(index)
+        if not group:
+            del self._groups[key]
+        del self._tasks[seq]
+        self._add_to_total(-task["time"])
+
+    def iter_below(self, time_limit, accepted_mask):
+        """Задачи с time < time_limit, совместимые с маской специализаций, по убыванию time"""
+        rejected = ~accepted_mask
+        groups = [
+            _descending(group, bisect_left(group, (time_limit,)))
+            for key, group in self._groups.items() if not key & rejected
+        ]
+        for _, seq in merge(*groups, reverse=True):
+            yield self._tasks[seq]
+
+    def iter_smallest(self, accepted_mask):
+        """Задачи, совместимые с маской специализаций, по возрастанию time"""
+        rejected = ~accepted_mask
+        groups = [group for key, group in self._groups.items() if not key & rejected]
+        for _, seq in merge(*groups):
+            yield self._tasks[seq]
+
+    def find_batch(self, time_to_shed, accepted_mask, limit, epsilon, exclude=()):
+        """Не более limit задач с суммой time не больше time_to_shed и как можно ближе к нему.
+
+        Сначала жадно берется самая крупная задача, которая еще помещается в остаток.
+        Если остаток больше epsilon * time_to_shed, жадный набор вместе со следующими
+        по величине задачами уточняется приближенным subset-sum.
+        Задачи с ID из exclude (уже отданные в другие передачи) не выбираются.
+        """
+        chosen, chosen_ids, gap = [], set(), time_to_shed
+        while len(chosen) < limit:
+            task = next((t for t in self.iter_below(gap, accepted_mask)
+                         if id(t) not in chosen_ids and t["id"] not in exclude), None)
+            if task is None:
+                break
+            chosen.append(task)
+            chosen_ids.add(id(task))
+            gap -= task["time"]
+
+        if gap <= epsilon * time_to_shed or len(chosen) == limit:
+            return chosen
+
+        extra = (t for t in self.iter_below(time_to_shed, accepted_mask)
+                 if id(t) not in chosen_ids and t["id"] not in exclude)
+        candidates = chosen + list(islice(extra, limit - len(chosen)))
+        indices = closest_subset_sum([task["time"] for task in candidates], time_to_shed, epsilon)
+        refined = [candidates[i] for i in indices]
+        if sum(task["time"] for task in refined) > time_to_shed - gap:
+            return refined
+        return chosen
+
+    def specialization_mask(self):
+        """Маска всех специализаций, которые встречаются в задачах плана"""
+        result = 0
+        for key in self._groups:
+            result |= key
+        return result
+
+    def to_list(self):
+        return list(self._tasks.values())
+
+    def __iter__(self):
+        return iter(self._tasks.values())
+
+    def __len__(self):
+        return len(self._tasks)
+
+
+def _descending(group, end):
+    for i in range(end - 1, -1, -1):
+        yield group[i]
+
+
+def closest_subset_sum(values, target, epsilon):
+    """Индексы подмножества values с суммой строго меньше target, максимально близкой к нему.
+
+    Схема приближения с усечением списка сумм: суммы, отличающиеся меньше чем на
+    epsilon * target / len(values), склеиваются, поэтому ошибка не больше epsilon * target.
+    """
+    if not values:
+        return []
+    delta = epsilon * target / len(values)
+    sums = [(0, 0)]  # (сумма, битовая маска выбранных индексов), по возрастанию суммы
+    for index, value in enumerate(values):
+        added = [(total + value, mask | (1 << index)) for total, mask in sums if total + value < target]
+        trimmed = []
+        for total, mask in merge(sums, added):
+            if not trimmed or total > trimmed[-1][0] + delta:
+                trimmed.append((total, mask))
+        sums = trimmed
+    best_mask = sums[-1][1]
+    return [index for index in range(len(values)) if best_mask >> index & 1]
+
+
+def best_swap(mine, theirs, diff, limit):
+    """Обмен задачами между двумя агентами, который сильнее всего сокращает разницу нагрузок.
+
+    mine, theirs - трудозатраты задач, которые можно отдать соседу и получить от него,
+    diff - моя нагрузка минус нагрузка соседа. Жадный поиск: на каждом шаге выбирается
+    лучший из ходов "отдать одну задачу", "взять одну задачу" и "обменять пару задач"
+    (попарная разность, как в методе Кармаркара-Карпа), пока ход уменьшает |diff|
+    и задействовано не больше limit задач. Каждая задача переходит не больше одного раза.
+    Возвращает (индексы mine, индексы theirs, итоговая разница).
+    """
+    given, taken = [], []
+    free_mine, free_theirs = set(range(len(mine))), set(range(len(theirs)))
+    while len(given) + len(taken) < limit:
+        best = None  # (|новая разница|, новая разница, отдаем, берем)
+        for i in free_mine:
+            d = diff - 2 * mine[i]
+            if best is None or abs(d) < best[0]:
+                best = (abs(d), d, i, None)
+        for j in free_theirs:
+            d = diff + 2 * theirs[j]
+            if best is None or abs(d) < best[0]:
+                best = (abs(d), d, None, j)
+        if len(given) + len(taken) + 2 <= limit:
+            for i in free_mine:
+                for j in free_theirs:
+                    d = diff - 2 * (mine[i] - theirs[j])
+                    if abs(d) < best[0]:
+                        best = (abs(d), d, i, j)
+        if best is None or best[0] >= abs(diff):
+            break
+        _, diff, i, j = best
+        if i is not None:
+            given.append(i)
+            free_mine.discard(i)
+        if j is not None:
+            taken.append(j)
+            free_theirs.discard(j)
+    return given, taken, diff
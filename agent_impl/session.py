@@ -0,0 +1,32 @@
+import asyncio
+import uuid
+
+
+class NegotiationSession:
+    """Переговоры агента с одним соседом: запрос веса, решение, передача пакета задач.
+
+    thread - идентификатор разговора: он ставится в msg.thread всех сообщений сессии,
+    а make_reply сохраняет его в ответе, поэтому ответ соседа находит свою сессию.
+    Сессия, по которой timeout секунд нет продвижения, закрывается (см. CheckAgentAlive).
+    """
+
+    def __init__(self, peer, timeout, thread=None):
+        self.thread = thread or uuid.uuid4().hex
+        self.peer = peer  # [jid, специализации, маска специализаций]
+        self.timeout = timeout
+        self.txn = None  # пакет, переданный в этой сессии
+        self.tasks = None
+        self.offer = None  # задачи, предложенные соседу для обмена (зарезервированы, в журнал не попали)
+        self.deadline = None
+        self.touch()
+
+    @property
+    def jid(self):
+        return self.peer[0]
+
+    def touch(self):
+        """Сосед ответил: срок сессии отсчитывается заново"""
+        self.deadline = asyncio.get_running_loop().time() + self.timeout
+
+    def expired(self):
+        return asyncio.get_running_loop().time() > self.deadline
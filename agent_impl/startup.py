@@ -0,0 +1,42 @@
+import asyncio
+import random
+from common.event_log import get_log
+
+log = get_log("STARTUP")
+
+
+async def start_agents(workers, concurrency=50, retries=3, backoff=1.0, barrier=None):
+    """Запускает агентов параллельно, не больше concurrency подключений одновременно.
+
+    Неудачный запуск повторяется до retries раз с экспоненциальной паузой и разбросом.
+    Балансировка у всех запущенных агентов начинается одновременно - после того, как
+    запуск закончили все (и, если задан, после await barrier()), чтобы первые раунды
+    не уходили на соседей, которые еще не в сети.
+    Возвращает (запущенные агенты, агенты, которые запустить не удалось).
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def start_one(w):
+        async with semaphore:
+            for attempt in range(retries + 1):
+                try:
+                    await w.start()
+                    return True
+                except Exception as e:
+                    if attempt == retries:
+                        log.error(w, "Не удалось запустить агента: %s", e)
+                        return False
+                    delay = backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                    log.warning(w, "Ошибка запуска (%s), повтор через %.1f с", e, delay)
+                    await asyncio.sleep(delay)
+
+    results = await asyncio.gather(*(start_one(w) for w in workers))
+    started = [w for w, ok in zip(workers, results) if ok]
+    failed = [w for w, ok in zip(workers, results) if not ok]
+    log.info(None, "Запущено агентов: %s, не удалось: %s", len(started), len(failed))
+
+    if barrier is not None:
+        await barrier()
+    for w in started:
+        w.ready.set()
+    return started, failed
@@ -0,0 +1,69 @@
+import asyncio
+from collections import Counter
+from slixmpp import JID
+
+
+class LocalBus:
+    """Внутрипроцессная шина сообщений: доставляет Message между агентами без XMPP-сервера.
+
+    Подключается к агенту вместо контейнера spade, поэтому поведения продолжают
+    вызывать обычный self.send(msg), а шина передает сообщение в agent.dispatch получателя.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.agents = {}
+        self.messages_sent = 0
+        self.messages_dropped = 0
+        self.bytes_sent = 0
+        self.messages_by_type = Counter()
+        # loop.time() последней отправки каждого типа сообщений
+        self.last_sent_at = {}
+
+    def register(self, agent):
+        """Регистрирует агента на шине. Вызывается внутри работающего event loop"""
+        jid = str(agent.jid.bare)
+        agent.container.unregister(str(agent.jid))
+        agent.set_container(self)
+        agent.set_loop(asyncio.get_running_loop())
+        self.agents[jid] = agent
+
+    def unregister(self, jid):
+        self.agents.pop(str(JID(str(jid)).bare), None)
+
+    def has_agent(self, jid):
+        return str(JID(str(jid)).bare) in self.agents
+
+    async def send(self, msg, behaviour):
+        """Та же сигнатура, что у spade Container.send: доставка сообщения получателю"""
+        self.messages_sent += 1
+        self.bytes_sent += len(msg.body.encode("utf-8")) if msg.body else 0
+        self.bytes_sent += sum(len(key) + len(value) for key, value in msg.metadata.items())
+        msg_type = msg.get_metadata("type")
+        self.messages_by_type[msg_type] += 1
+        self.last_sent_at[msg_type] = asyncio.get_running_loop().time()
+
+        agent = self.agents.get(str(JID(str(msg.to)).bare))
+        if agent is None or not agent.is_alive():
+            self.messages_dropped += 1
+            return
+
+        if self.latency > 0:
+            asyncio.get_running_loop().call_later(self.latency, self._deliver, agent, msg)
+        else:
+            agent.dispatch(msg)
+
+    def _deliver(self, agent, msg):
+        if agent.is_alive():
+            agent.dispatch(msg)
+        else:
+            self.messages_dropped += 1
+
+    def stats(self):
+        return {
+            "messages_sent": self.messages_sent,
+            "messages_dropped": self.messages_dropped,
+            "bytes_sent": self.bytes_sent,
+            "messages_by_type": dict(self.messages_by_type),
+            "last_sent_at": dict(self.last_sent_at),
+        }
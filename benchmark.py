@@ -0,0 +1,196 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+from datetime import datetime
+from itertools import product
+from common.assignment import STRATEGIES
+from common.solver import lower_bound, gap
+from common.topology import TOPOLOGIES, DEFAULT_DEGREE, DEFAULT_GROUP_SIZE
+from simulate import simulate
+
+
+def generate_workload(n_agents, n_tasks, n_specializations=3, overlap=0.5, task_specializations=1,
+                      distribution='uniform', min_time=1.0, max_time=10.0, seed=None, host='localhost'):
+    """Синтетические agents.json/tasks.json.
+
+    overlap - доля всех специализаций, которой владеет каждый агент (не меньше одной),
+    task_specializations - сколько специализаций требует каждая задача.
+    """
+    rng = random.Random(seed)
+    specializations = [f"spec{i}" for i in range(n_specializations)]
+    per_agent = max(1, min(n_specializations, round(overlap * n_specializations)))
+    per_task = max(1, min(n_specializations, task_specializations))
+
+    agents = [
+        {"jid": f"worker{i + 1}@{host}", "specializations": rng.sample(specializations, per_agent)}
+        for i in range(n_agents)
+    ]
+
+    tasks = []
+    for i in range(n_tasks):
+        if distribution == 'uniform':
+            task_time = rng.uniform(min_time, max_time)
+        elif distribution == 'exponential':
+            task_time = min_time + rng.expovariate(1 / (max_time - min_time))
+        elif distribution == 'lognormal':
+            task_time = min_time + rng.lognormvariate(0, 1)
+        elif distribution == 'pareto':
+            task_time = min_time * rng.paretovariate(1.5)
+        else:
+            raise ValueError(f"Unknown time distribution: {distribution}")
+        tasks.append({
+            "name": f"task{i + 1}",
+            "time": round(task_time, 2),
+            "specializations": rng.sample(specializations, per_task)
+        })
+
+    return agents, tasks
+
+
+def makespan_ratio(times):
+    """Отношение максимальной нагрузки к средней: 1.0 - идеальный баланс"""
+    average = sum(times) / len(times) if times else 0
+    return max(times) / average if average else 0.0
+
+
+def time_to_balance(history, final_ratio, tolerance=0.01):
+    """Первый момент, после которого отношение max/среднее не выше final_ratio * (1 + tolerance)"""
+    reached = 0.0
+    for elapsed, ratio in history:
+        if ratio > final_ratio * (1 + tolerance):
+            reached = elapsed
+    return reached
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def run_case(case, strategy, plans_dir, time_limit, agent_settings, overlay=None, hierarchy=None):
+    agents, tasks = generate_workload(**case)
+    result = simulate(agents, tasks,
+                      plans_dir=plans_dir,
+                      time_limit=time_limit,
+                      agent_settings=agent_settings,
+                      strategy=strategy,
+                      overlay=overlay,
+                      hierarchy=hierarchy)
+
+    bus = result["bus"]
+    transfers = bus["messages_by_type"].get("transfer_confirm", 0)
+    final_ratio = makespan_ratio(result["final_times"])
+    # optimality_gap - разрыв итоговой максимальной нагрузки до нижней границы (оптимум не меньше границы)
+    bound = lower_bound(agents, tasks)
+    return {
+        "case": case,
+        "strategy": strategy,
+        "overlay": overlay,
+        "hierarchy": hierarchy,
+        "finished": result["finished"],
+        "assigned_tasks": result["assigned_tasks"],
+        "simulated_time": result["elapsed"],
+        "convergence_time": result["convergence_time"],
+        "time_to_balance": time_to_balance(result["balance_history"], final_ratio),
+        "wall_time": result["wall_time"],
+        "transfers": transfers,
+        "transfers_per_agent": transfers / result["agents"],
+        "messages": bus["messages_sent"],
+        "messages_dropped": bus["messages_dropped"],
+        "bytes": bus["bytes_sent"],
+        "messages_per_transfer": bus["messages_sent"] / transfers if transfers else None,
+        "bytes_per_transfer": bus["bytes_sent"] / transfers if transfers else None,
+        "messages_by_type": bus["messages_by_type"],
+        "initial_makespan_ratio": makespan_ratio(result["initial_times"]),
+        "final_makespan_ratio": final_ratio,
+        "final_max_time": max(result["final_times"]) if result["final_times"] else 0.0,
+        "lower_bound": bound,
+        "optimality_gap": gap(max(result["final_times"], default=0.0), bound),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark balancing convergence, message cost and final imbalance')
+    parser.add_argument('--agents', type=int, nargs='+', default=[10, 50])
+    parser.add_argument('--tasks', type=int, nargs='+', default=[1000])
+    parser.add_argument('--specializations', type=int, default=3)
+    parser.add_argument('--overlap', type=float, nargs='+', default=[0.5])
+    parser.add_argument('--task-specializations', type=int, default=1)
+    parser.add_argument('--distribution', nargs='+', default=['uniform'],
+                        choices=['uniform', 'exponential', 'lognormal', 'pareto'])
+    parser.add_argument('--strategy', nargs='+', default=['lpt'], choices=STRATEGIES)
+    parser.add_argument('--topology', nargs='+', default=['full'], choices=TOPOLOGIES)
+    parser.add_argument('--degree', type=int, default=DEFAULT_DEGREE, help='neighbours per agent (except full)')
+    parser.add_argument('--balancing', nargs='+', default=['gossip'], choices=('gossip', 'hierarchical'))
+    parser.add_argument('--group-size', type=int, default=DEFAULT_GROUP_SIZE, help='agents per group (hierarchical)')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--time-limit', type=float, default=3600.0, help='seconds of virtual time per run')
+    parser.add_argument('--balance-threshold', type=float, help='override WorkerAgent.BALANCE_THRESHOLD')
+    parser.add_argument('--communication-interval', type=float, help='override WorkerAgent.COMMUNICATION_INTERVAL')
+    parser.add_argument('--plans-dir', default='plans/bench')
+    parser.add_argument('--save-workload', help='directory to store generated agents/tasks json files')
+    parser.add_argument('--output', default='bench_results.json')
+    args = parser.parse_args()
+
+    agent_settings = {}
+    if args.balance_threshold is not None:
+        agent_settings["BALANCE_THRESHOLD"] = args.balance_threshold
+    if args.communication_interval is not None:
+        agent_settings["COMMUNICATION_INTERVAL"] = args.communication_interval
+
+    results = []
+    combinations = product(args.agents, args.tasks, args.overlap, args.distribution, args.strategy, args.topology,
+                           args.balancing, range(args.repeat))
+    for n_agents, n_tasks, overlap, distribution, strategy, topology, balancing, run in combinations:
+        case = {
+            "n_agents": n_agents,
+            "n_tasks": n_tasks,
+            "n_specializations": args.specializations,
+            "overlap": overlap,
+            "task_specializations": args.task_specializations,
+            "distribution": distribution,
+            "seed": args.seed + run,
+        }
+        # distribute_tasks и BalancingBehaviour используют глобальный random
+        random.seed(case["seed"])
+
+        if args.save_workload:
+            agents, tasks = generate_workload(**case)
+            name = f"{n_agents}a_{n_tasks}t_{overlap}o_{distribution}_{case['seed']}"
+            os.makedirs(args.save_workload, exist_ok=True)
+            with open(os.path.join(args.save_workload, f"agents_{name}.json"), 'w', encoding='utf-8') as f:
+                json.dump(agents, f, ensure_ascii=False, indent=2)
+            with open(os.path.join(args.save_workload, f"tasks_{name}.json"), 'w', encoding='utf-8') as f:
+                json.dump(tasks, f, ensure_ascii=False, indent=2)
+
+        row = run_case(case, strategy, args.plans_dir, args.time_limit, agent_settings,
+                       overlay={"kind": topology, "degree": args.degree},
+                       hierarchy={"size": args.group_size} if balancing == 'hierarchical' else None)
+        results.append(row)
+        print(f"{n_agents} agents, {n_tasks} tasks, overlap {overlap}, {distribution}, {strategy}, {topology}, {balancing}: "
+              f"balanced in {row['time_to_balance']:.1f} s (last transfer {row['convergence_time']:.1f} s), "
+              f"{row['transfers']} transfers, "
+              f"{row['messages_per_transfer'] or 0:.1f} msg/transfer, "
+              f"makespan ratio {row['initial_makespan_ratio']:.3f} -> {row['final_makespan_ratio']:.3f}, "
+              f"gap to lower bound {row['optimality_gap'] * 100:.2f}%, "
+              f"wall {row['wall_time']:.2f} s")
+
+    report = {
+        "revision": git_revision(),
+        "created": datetime.now().isoformat(timespec='seconds'),
+        "agent_settings": agent_settings,
+        "results": results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Results saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
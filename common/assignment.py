@@ -0,0 +1,108 @@
+import heapq
+import random
+from common.solver import solve, format_report
+from common.specializations import spec_mask, task_mask
+
+STRATEGIES = ('lpt', 'capacity', 'random', 'optimize')
+
+
+def assign_tasks(agents_data, tasks, strategy='lpt'):
+    """Начальное распределение задач между агентами.
+
+    Стратегии:
+      lpt      - задачи по убыванию time, каждая достается наименее загруженному совместимому агенту
+      capacity - то же, но загрузка считается относительно поля "capacity" агента (по умолчанию 1)
+      random   - прежний алгоритм: первый совместимый агент в случайном порядке
+      optimize - LPT и локальный поиск минимума максимальной нагрузки (common/solver.py)
+
+    Возвращает {jid: {'agent': ..., 'tasks': [...], 'total_task_time': ...}}.
+    """
+    if strategy == 'optimize':
+        agent_map, report = solve(agents_data, tasks)
+        print(f"Распределение: {format_report(report)}")
+        return agent_map
+
+    agent_map = {}
+    for a in agents_data:
+        agent_map[a['jid']] = {
+            'agent': a,
+            'tasks': [],
+            'total_task_time': 0.0
+        }
+
+    if strategy == 'random':
+        unassigned = _assign_random(agent_map, tasks)
+    elif strategy in ('lpt', 'capacity'):
+        unassigned = _assign_lpt(agent_map, tasks, capacity_aware=strategy == 'capacity')
+    else:
+        raise ValueError(f"Unknown assignment strategy: {strategy}")
+
+    if unassigned:
+        print(f"Не удалось распределить задач: {unassigned} (нет агентов с нужными специализациями)")
+    return agent_map
+
+
+def _assign_random(agent_map, tasks):
+    unassigned = 0
+    agents = [(agent_data, spec_mask(agent_data["agent"].get('specializations'))) for agent_data in agent_map.values()]
+    for t in tasks:
+        task_spec = t.get('specializations')
+        if task_spec:
+            # Перемешиваем агентов в случайном порядке
+            agent_items = agents[:]
+            random.shuffle(agent_items)
+
+            mask = task_mask(t)
+            for agent_data, agent_mask in agent_items:
+                if mask & ~agent_mask == 0:
+                    agent_data['tasks'].append(t)
+                    agent_data['total_task_time'] += t.get('time', 0)
+                    break
+            else:
+                unassigned += 1
+    return unassigned
+
+
+def _assign_lpt(agent_map, tasks, capacity_aware):
+    # Агенты с одинаковым набором специализаций (и capacity) образуют класс с общей кучей нагрузок,
+    # поэтому задача сравнивает только минимумы совместимых классов, а не всех агентов
+    classes = {}
+    for order, (jid, agent_data) in enumerate(agent_map.items()):
+        agent = agent_data['agent']
+        capacity = float(agent.get('capacity', 1.0)) if capacity_aware else 1.0
+        if capacity <= 0:
+            raise ValueError(f"Agent {jid}: capacity must be positive")
+        key = (spec_mask(agent.get('specializations')), capacity)
+        # Нагрузки нулевые, порядок возрастает - список уже является кучей
+        classes.setdefault(key, []).append((0.0, order, jid))
+
+    compatible = {}
+    unassigned = 0
+    for t in sorted(tasks, key=lambda task: task.get('time', 0), reverse=True):
+        mask = task_mask(t)
+        candidates = compatible.get(mask)
+        if candidates is None:
+            candidates = compatible[mask] = [
+                (heap, key[1]) for key, heap in classes.items() if mask & ~key[0] == 0
+            ]
+        if not candidates:
+            unassigned += 1
+            continue
+
+        task_time = t.get('time', 0)
+        if len(candidates) == 1:
+            heap = candidates[0][0]
+        else:
+            heap, best_finish = None, None
+            for class_heap, capacity in candidates:
+                finish = (class_heap[0][0] + task_time) / capacity
+                if heap is None or finish < best_finish or (finish == best_finish and class_heap[0][1] < heap[0][1]):
+                    heap, best_finish = class_heap, finish
+        load, order, jid = heap[0]
+        heapq.heapreplace(heap, (load + task_time, order, jid))
+
+        agent_data = agent_map[jid]
+        agent_data['tasks'].append(t)
+        agent_data['total_task_time'] += task_time
+    return unassigned
+
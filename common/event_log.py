@@ -0,0 +1,191 @@
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+ROOT = "mas"
+
+
+class EventLog:
+    """Логгер категории (BALANCE, TRANSFER, ...) для сообщений агентов.
+
+    Форматирование отложено: строка и аргументы собираются в сообщение только
+    в потоке обработчика, а отключенный уровень стоит одну проверку isEnabledFor.
+    Именованные аргументы попадают в JSONL как поля события.
+    """
+
+    def __init__(self, category):
+        self.category = category
+        self.logger = logging.getLogger(f"{ROOT}.{category}")
+
+    def _log(self, level, agent, msg, args, fields):
+        if self.logger.isEnabledFor(level):
+            extra = {"category": self.category, "agent": str(agent.jid) if agent is not None else "-", "fields": fields}
+            self.logger.log(level, msg, *args, extra=extra)
+
+    def debug(self, agent, msg, *args, **fields):
+        self._log(logging.DEBUG, agent, msg, args, fields)
+
+    def info(self, agent, msg, *args, **fields):
+        self._log(logging.INFO, agent, msg, args, fields)
+
+    def warning(self, agent, msg, *args, **fields):
+        self._log(logging.WARNING, agent, msg, args, fields)
+
+    def error(self, agent, msg, *args, **fields):
+        self._log(logging.ERROR, agent, msg, args, fields)
+
+
+def get_log(category):
+    return EventLog(category)
+
+
+class SamplingFilter(logging.Filter):
+    """Из записей ниже WARNING пропускает каждую N-ю в категории: {"BALANCE": 10, ...}.
+
+    Счетчик, а не random: выборка не сдвигает генератор, которым пользуется балансировка.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates)
+        self._counters = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        category = getattr(record, "category", None)
+        rate = self.rates.get(category)
+        if not rate or rate <= 1:
+            return True
+        count = self._counters.get(category, 0)
+        self._counters[category] = count + 1
+        return count % rate == 0
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """Кладет запись в очередь без форматирования; если очередь полна - запись отбрасывается"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Форматирует QueueListener в своем потоке
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonLinesHandler(logging.Handler):
+    """Событие на строку: ts, level, category, agent, msg и поля, переданные в вызов"""
+
+    def __init__(self, path):
+        super().__init__()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def emit(self, record):
+        try:
+            event = {
+                "ts": record.created,
+                "level": record.levelname,
+                "category": getattr(record, "category", record.name),
+                "agent": str(getattr(record, "agent", "-")),
+                "msg": record.getMessage(),
+            }
+            event.update(getattr(record, "fields", None) or {})
+            self._file.write(json.dumps(event, ensure_ascii=False, default=str) + "\n")
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+class _ConsoleFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s.%(msecs)03d [%(category)s]%(source)s %(message)s", datefmt="%H:%M:%S")
+
+    def format(self, record):
+        if not hasattr(record, "category"):
+            record.category, record.agent = record.name, "-"
+        record.source = f" {record.agent}:" if record.agent != "-" else ""
+        return super().format(record)
+
+
+_listener = None
+_queue_handler = None
+
+
+def configure_logging(level="INFO", console=True, jsonl_path=None, sample=None, queue_size=100000):
+    """Подключает обработчики к логгеру "mas" через очередь: вывод и запись идут в отдельном потоке.
+
+    level - минимальный уровень, sample - {категория: N}, jsonl_path - файл событий JSONL.
+    """
+    global _listener, _queue_handler
+    shutdown_logging()
+
+    handlers = []
+    if console:
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(_ConsoleFormatter())
+        handlers.append(console_handler)
+    if jsonl_path:
+        handlers.append(JsonLinesHandler(jsonl_path))
+
+    root = logging.getLogger(ROOT)
+    root.setLevel(level)
+    root.propagate = False
+    if not handlers:
+        # Иначе записи WARNING и выше ушли бы в logging.lastResort (stderr)
+        root.addHandler(logging.NullHandler())
+        return
+
+    log_queue = queue.Queue(queue_size)
+    _queue_handler = _NonBlockingQueueHandler(log_queue)
+    if sample:
+        _queue_handler.addFilter(SamplingFilter(sample))
+    root.addHandler(_queue_handler)
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def shutdown_logging():
+    """Дописывает очередь и отключает обработчики"""
+    global _listener, _queue_handler
+    root = logging.getLogger(ROOT)
+    for handler in [h for h in root.handlers if isinstance(h, logging.NullHandler)]:
+        root.removeHandler(handler)
+    if _queue_handler is not None:
+        root.removeHandler(_queue_handler)
+        _queue_handler = None
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def add_logging_arguments(parser):
+    parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'])
+    parser.add_argument('--log-jsonl', help='also write agent events to this JSON Lines file')
+    parser.add_argument('--log-sample', nargs='*', metavar='CATEGORY=N',
+                        help='keep every N-th record below WARNING in a category, e.g. BALANCE=10')
+
+
+def parse_sample(values):
+    """["BALANCE=10", "TRANSFER=2"] -> {"BALANCE": 10, "TRANSFER": 2}"""
+    rates = {}
+    for value in values or []:
+        category, _, rate = value.partition("=")
+        rates[category] = int(rate)
+    return rates
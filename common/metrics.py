@@ -0,0 +1,238 @@
+import asyncio
+import bisect
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from common.plan_load_save import write_file_atomic
+
+PREFIX = "mas_"
+# Границы корзин гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+class Histogram:
+    """Распределение значений по фиксированным корзинам: count, sum и число значений в каждой корзине"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя корзина - больше всех границ (+Inf)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class MetricsRegistry:
+    """Метрики одного агента: счетчики, показатели (gauge) и гистограммы задержек.
+
+    Серия метрики - имя и метки, например messages_sent_total{type="time_request"}.
+    Показатель задается функцией и вычисляется только при снятии снимка.
+    Задержка запрос-ответ считается таймерами: start_timer при отправке запроса,
+    stop_timer при ответе, discard_timer - если ответа уже не будет; время берется
+    из event loop (в симуляции - виртуальное).
+    """
+
+    def __init__(self, **labels):
+        self.labels = labels  # общие метки всех серий, например agent
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._timers = {}
+
+    def inc(self, name, value=1, **labels):
+        key = _key(name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, fn, **labels):
+        self.gauges[_key(name, labels)] = fn
+
+    def observe(self, name, value, **labels):
+        key = _key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def start_timer(self, request, key):
+        self._timers[(request, key)] = asyncio.get_running_loop().time()
+
+    def stop_timer(self, request, key, **labels):
+        """Задержка запроса request с ключом key в request_latency_seconds; None, если запрос не отправлялся"""
+        started = self._timers.pop((request, key), None)
+        if started is None:
+            return None
+        latency = asyncio.get_running_loop().time() - started
+        self.observe("request_latency_seconds", latency, request=request, **labels)
+        return latency
+
+    def discard_timer(self, request, key):
+        """Запрос остался без ответа (таймаут, отказ соседа): его задержка не учитывается"""
+        self._timers.pop((request, key), None)
+
+    def snapshot(self):
+        """Все серии в виде, пригодном для JSON и передачи между процессами"""
+        series = []
+        for (name, labels), value in self.counters.items():
+            series.append({"name": name, "type": "counter", "labels": {**self.labels, **dict(labels)},
+                           "value": value})
+        for (name, labels), fn in self.gauges.items():
+            series.append({"name": name, "type": "gauge", "labels": {**self.labels, **dict(labels)},
+                           "value": fn()})
+        for (name, labels), histogram in self.histograms.items():
+            series.append({"name": name, "type": "histogram", "labels": {**self.labels, **dict(labels)},
+                           "buckets": list(histogram.buckets), "counts": list(histogram.counts),
+                           "count": histogram.count, "sum": histogram.sum})
+        return series
+
+
+def aggregate(series, drop=("agent",)):
+    """Сводит серии разных агентов: метки drop отбрасываются, счетчики и гистограммы складываются,
+    для показателей - сумма и максимум (max_value)"""
+    merged = {}
+    for s in series:
+        labels = {k: v for k, v in s["labels"].items() if k not in drop}
+        key = _key(s["name"], labels)
+        total = merged.get(key)
+        if total is None:
+            total = merged[key] = {"name": s["name"], "type": s["type"], "labels": labels}
+            if s["type"] == "histogram":
+                total.update(buckets=s["buckets"], counts=[0] * len(s["counts"]), count=0, sum=0.0)
+            else:
+                total["value"] = 0
+                if s["type"] == "gauge":
+                    total["max_value"] = s["value"]
+        if s["type"] == "histogram":
+            total["counts"] = [a + b for a, b in zip(total["counts"], s["counts"])]
+            total["count"] += s["count"]
+            total["sum"] += s["sum"]
+        else:
+            total["value"] += s["value"]
+            if s["type"] == "gauge":
+                total["max_value"] = max(total["max_value"], s["value"])
+    return list(merged.values())
+
+
+def quantile(histogram, q):
+    """Оценка квантиля q по корзинам гистограммы (верхняя граница корзины)"""
+    if not histogram["count"]:
+        return None
+    rank = q * histogram["count"]
+    seen = 0
+    for bound, count in zip(histogram["buckets"], histogram["counts"]):
+        seen += count
+        if seen >= rank:
+            return bound
+    return float("inf")
+
+
+def summary(series):
+    """Сводка по всем агентам: итоговые серии и p50/p95/p99 гистограмм"""
+    totals = aggregate(series)
+    for s in totals:
+        if s["type"] == "histogram":
+            s.update({f"p{int(q * 100)}": quantile(s, q) for q in (0.5, 0.95, 0.99)})
+            s["mean"] = s["sum"] / s["count"] if s["count"] else None
+    return totals
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in labels.values())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+
+def format_text(series):
+    """Текстовый формат экспозиции Prometheus"""
+    lines = []
+    typed = set()
+    for s in sorted(series, key=lambda s: s["name"]):
+        name = PREFIX + s["name"]
+        if name not in typed:
+            lines.append(f"# TYPE {name} {s['type']}")
+            typed.add(name)
+        if s["type"] == "histogram":
+            cumulative = 0
+            for bound, count in zip(list(s["buckets"]) + ["+Inf"], s["counts"]):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels({**s['labels'], 'le': bound})} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(s['labels'])} {s['sum']}")
+            lines.append(f"{name}_count{_format_labels(s['labels'])} {s['count']}")
+        else:
+            lines.append(f"{name}{_format_labels(s['labels'])} {s['value']}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsExporter:
+    """Последний собранный снимок метрик всех агентов: HTTP-эндпоинт и периодический JSON-файл.
+
+    update() вызывается раз в интервал из event loop или процесса-супервизора; HTTP-сервер
+    работает в своем потоке и отдает готовый снимок, не обращаясь к агентам:
+      GET /metrics      - текстовый формат Prometheus, серии с меткой agent
+      GET /metrics.json - снимок в JSON: серии агентов и сводка по всем агентам
+    """
+
+    def __init__(self, json_path=None):
+        self.json_path = json_path
+        self._series = []
+        self._updated_at = None
+        self._server = None
+
+    def update(self, series):
+        self._series = list(series)
+        self._updated_at = time.time()
+        if self.json_path:
+            write_file_atomic(self.json_path, json.dumps(self.to_json(), ensure_ascii=False))
+
+    def to_json(self):
+        return {"ts": self._updated_at, "series": self._series, "summary": summary(self._series)}
+
+    def start(self, port, host="127.0.0.1"):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                if path == "/metrics":
+                    body, content_type = format_text(exporter._series), "text/plain; version=0.0.4"
+                elif path == "/metrics.json":
+                    body, content_type = json.dumps(exporter.to_json(), ensure_ascii=False), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                data = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True).start()
+        return self._server.server_address[1]
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def collect(workers):
+    """Снимки метрик агентов процесса одним списком серий"""
+    series = []
+    for w in workers:
+        series.extend(w.metrics.snapshot())
+    return series
@@ -0,0 +1,246 @@
+import asyncio
+import json
+import os
+import uuid
+from collections import deque
+from common.plan_writer import io_executor
+
+
+def new_txn_id():
+    return uuid.uuid4().hex
+
+
+class PlanJournal:
+    """Журнал изменений плана (write-ahead log) в формате JSON Lines.
+
+    Записи с возрастающим seq:
+      add     - получатель принял пакет задач txn
+      prepare - отправитель отдает пакет задач txn агенту to (задачи еще в плане);
+                "swap" - половина обмена под тем же txn: "offer" - половина отвечающего,
+                "accept" - половина инициатора, который уже принял задачи отвечающего
+      commit  - получатель подтвердил txn, задачи удалены из плана
+      abort   - получатель отказал, задачи остаются у отправителя
+    Снимок плана (plans/new) хранит seq, до которого он учитывает журнал, поэтому
+    при старте читается снимок и повторяется только хвост журнала.
+
+    Задачи в записях и снимке хранятся списком ID каталога (TaskCatalog.encode).
+
+    Сжатие: при записи снимка текущий сегмент переименовывается в <path>.1,
+    новые записи идут в новый сегмент, а <path>.1 удаляется, когда снимок записан.
+    """
+
+    def __init__(self, path, catalog, compact_every=100, keep_txns=1000):
+        self.path = path
+        self.catalog = catalog
+        self.old_path = path + ".1"
+        self.compact_every = compact_every
+        self.journal_id = None
+        self.seq = 0
+        self.pending = {}  # txn -> {"to": jid получателя, "tasks": [...]}, еще без commit/abort
+        self._applied = deque(maxlen=keep_txns)  # принятые txn: повторный запрос не добавит задачи дважды
+        self._applied_set = set()
+        self._records_in_segment = 0
+        self._rotated_seq = None  # последний seq в <path>.1
+        self._file = None
+        self._written = 0
+        self._synced = 0
+        self._sync_task = None
+
+    def recover(self, plan, load_base_tasks, snapshot=None):
+        """Восстанавливает plan: снимок (если он сделан по этому журналу) или начальные задачи, затем хвост журнала.
+
+        load_base_tasks вызывается, только если подходящего снимка нет.
+        """
+        old_records = _read_records(self.old_path)
+        segment_records = _read_records(self.path)
+        records = old_records + segment_records
+        headers = [r["journal"] for r in records if "journal" in r]
+        self.journal_id = headers[0] if headers else uuid.uuid4().hex
+
+        base_seq = 0
+        journal_state = (snapshot or {}).get("journal")
+        if headers and journal_state and journal_state.get("journal_id") == self.journal_id:
+            base_seq = journal_state["journal_seq"]
+            for task in self._snapshot_tasks(snapshot):
+                plan.append(task)
+            self.pending = {txn: self._pending_entry(entry) for txn, entry in journal_state.get("pending", {}).items()}
+            for txn in journal_state.get("txns", []):
+                self._mark_applied(txn)
+        else:
+            for task in load_base_tasks():
+                plan.append(task)
+
+        self.seq = base_seq
+        for record in records:
+            if record.get("seq", 0) <= base_seq:
+                continue
+            self._replay(plan, record)
+            self.seq = record["seq"]
+        self._written = self._synced = self.seq
+        if any("seq" in r for r in old_records):
+            self._rotated_seq = max(r["seq"] for r in old_records if "seq" in r)
+
+        self._open_segment(new=not headers)
+        self._records_in_segment = sum(1 for r in segment_records if "seq" in r)
+        return len(records)
+
+    def _tasks(self, record):
+        # Записи прежнего формата содержат полные задачи вместо ID
+        if "ids" in record:
+            return self.catalog.decode(record["ids"])
+        return self.catalog.resolve_all(record.get("tasks", []))
+
+    def _pending_entry(self, record):
+        entry = {"to": record["to"], "tasks": self._tasks(record)}
+        if record.get("swap"):
+            entry["swap"] = record["swap"]
+        return entry
+
+    def _pending_record(self, entry):
+        record = {"to": entry["to"], "ids": self.catalog.encode(entry["tasks"])}
+        if entry.get("swap"):
+            record["swap"] = entry["swap"]
+        return record
+
+    def _snapshot_tasks(self, snapshot):
+        if "ids" in snapshot:
+            # Двоичный снимок (common/plan_load_save.py, read_plan_binary)
+            return [self.catalog[task_id] for task_id in snapshot["ids"]]
+        if "task_ids" in snapshot:
+            return self.catalog.decode(snapshot["task_ids"])
+        return self.catalog.resolve_all(snapshot.get("plan", []))
+
+    def _replay(self, plan, record):
+        op, txn = record["op"], record.get("txn")
+        if op == "add":
+            for task in self._tasks(record):
+                plan.append(task)
+            self._mark_applied(txn)
+        elif op == "prepare":
+            self.pending[txn] = self._pending_entry(record)
+        elif op == "commit":
+            entry = self.pending.pop(txn, None)
+            for task in entry["tasks"] if entry else []:
+                try:
+                    plan.remove(task)
+                except ValueError:
+                    pass
+        elif op == "abort":
+            self.pending.pop(txn, None)
+
+    def _open_segment(self, new):
+        exists = os.path.exists(self.path)
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._file = open(self.path, 'a', encoding='utf-8')
+        if exists and os.path.getsize(self.path) > 0:
+            # Последняя строка могла оборваться при сбое - новая запись начнется с новой строки
+            with open(self.path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self._file.write("\n")
+        if new or not exists:
+            self._file.write(json.dumps({"journal": self.journal_id}) + "\n")
+            self._records_in_segment = 0
+
+    def _mark_applied(self, txn):
+        if txn is None or txn in self._applied_set:
+            return
+        if len(self._applied) == self._applied.maxlen:
+            self._applied_set.discard(self._applied[0])
+        self._applied.append(txn)
+        self._applied_set.add(txn)
+
+    def has_applied(self, txn):
+        return txn in self._applied_set
+
+    def _append(self, record):
+        self.seq += 1
+        record["seq"] = self.seq
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n")
+        self._records_in_segment += 1
+        self._written = self.seq
+
+    def log_add(self, txn, tasks):
+        self._append({"op": "add", "txn": txn, "ids": self.catalog.encode(tasks)})
+        self._mark_applied(txn)
+
+    def log_prepare(self, txn, to, tasks, swap=None):
+        entry = {"to": to, "tasks": tasks}
+        if swap:
+            entry["swap"] = swap
+        self._append({"op": "prepare", "txn": txn, **self._pending_record(entry)})
+        self.pending[txn] = entry
+
+    def log_commit(self, txn):
+        self._append({"op": "commit", "txn": txn})
+        self.pending.pop(txn, None)
+
+    def log_abort(self, txn):
+        self._append({"op": "abort", "txn": txn})
+        self.pending.pop(txn, None)
+
+    async def sync(self):
+        """Дожидается fsync всех уже добавленных записей.
+
+        Один fsync обслуживает всех, кто ждет в этот момент (групповая фиксация).
+        """
+        target = self._written
+        while self._synced < target:
+            if self._sync_task is None:
+                self._sync_task = asyncio.ensure_future(self._fsync())
+            await asyncio.shield(self._sync_task)
+
+    async def _fsync(self):
+        upto = self._written
+        try:
+            self._file.flush()
+            await asyncio.get_running_loop().run_in_executor(io_executor, os.fsync, self._file.fileno())
+            self._synced = max(self._synced, upto)
+        finally:
+            self._sync_task = None
+
+    def checkpoint(self):
+        """Состояние журнала для снимка плана; при необходимости начинает новый сегмент"""
+        if (self._records_in_segment >= self.compact_every and
+                self._sync_task is None and self._rotated_seq is None):
+            self._file.close()
+            os.replace(self.path, self.old_path)
+            self._rotated_seq = self.seq
+            self._open_segment(new=True)
+        return {
+            "journal_id": self.journal_id,
+            "journal_seq": self.seq,
+            "pending": {txn: self._pending_record(entry) for txn, entry in self.pending.items()},
+            "txns": list(self._applied),
+        }
+
+    def release(self, state):
+        """Снимок с состоянием state записан: старый сегмент больше не нужен для восстановления"""
+        if self._rotated_seq is not None and self._rotated_seq <= state["journal_seq"]:
+            try:
+                os.remove(self.old_path)
+            except FileNotFoundError:
+                pass
+            self._rotated_seq = None
+
+    async def close(self):
+        if self._file is None:
+            return
+        await self.sync()
+        self._file.close()
+        self._file = None
+
+
+def _read_records(path):
+    records = []
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # Оборванная при сбое запись: ее txn не был подтвержден
+                    continue
+    except FileNotFoundError:
+        pass
+    return records
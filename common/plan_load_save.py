@@ -1,35 +1,169 @@
 import json
+import mmap
 import os
-from common.get_time import get_time
+import struct
+import sys
+import uuid
+from array import array
+from common.event_log import get_log
+from common.task_catalog import encode_ids
 
+log = get_log("SAVE")
 
-def load_plan_from_file(file_path):
+PLAN_FORMATS = ('json', 'binary')
+# Файл плана в двоичном формате (write_plan_binary) - по расширению
+BINARY_PLAN_SUFFIX = '.plan'
+_PLAN_MAGIC = b"MASPLAN1"
+_HEADER_SIZE = struct.Struct('<I')
+
+
+def plan_file_name(jid, plan_format='json'):
+    """Имя файла плана агента: worker1@localhost -> worker1.json или worker1.plan"""
+    suffix = BINARY_PLAN_SUFFIX if plan_format == 'binary' else '.json'
+    return f"{jid.split('@')[0]}{suffix}"
+
+
+def is_binary_plan(file_path):
+    return file_path.endswith(BINARY_PLAN_SUFFIX)
+
+
+def encode_plan_binary(tasks, header=None):
+    """План в двоичном формате: заголовок JSON и два столбца - ID задач (int64) и их трудозатраты (float64).
+
+    MASPLAN1 | длина заголовка (uint32 LE) | заголовок | выравнивание до 8 байт | ID | трудозатраты.
+    Столбцы записаны в порядке байтов машины (поле "byteorder" заголовка).
+    """
+    ids = array('q', (task["id"] for task in tasks))
+    times = array('d', (task["time"] for task in tasks))
+    header = {**(header or {}), "count": len(ids), "total_weight": sum(times), "byteorder": sys.byteorder}
+    header_bytes = json.dumps(header, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    offset = len(_PLAN_MAGIC) + _HEADER_SIZE.size + len(header_bytes)
+    padding = b" " * (-offset % 8)
+    return b"".join((_PLAN_MAGIC, _HEADER_SIZE.pack(len(header_bytes) + len(padding)), header_bytes, padding,
+                     ids.tobytes(), times.tobytes()))
+
+
+def read_plan_binary(file_path, columns=True):
+    """(заголовок, ID задач, трудозатраты) из двоичного файла плана.
+
+    Файл отображается в память (mmap) и столбцы берутся из него без разбора; с columns=False
+    читается только заголовок, столбцы - None.
+    """
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < len(_PLAN_MAGIC) + _HEADER_SIZE.size:
+            raise ValueError(f"{file_path}: не двоичный план")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if mapped[:len(_PLAN_MAGIC)] != _PLAN_MAGIC:
+                raise ValueError(f"{file_path}: не двоичный план")
+            start = len(_PLAN_MAGIC) + _HEADER_SIZE.size
+            size, = _HEADER_SIZE.unpack_from(mapped, len(_PLAN_MAGIC))
+            header = json.loads(mapped[start:start + size])
+            if not columns:
+                return header, None, None
+            count = header["count"]
+            start += size
+            ids, times = array('q'), array('d')
+            with memoryview(mapped) as view:
+                ids.frombytes(view[start:start + 8 * count])
+                times.frombytes(view[start + 8 * count:start + 16 * count])
+    if header.get("byteorder", sys.byteorder) != sys.byteorder:
+        ids.byteswap()
+        times.byteswap()
+    return header, ids, times
+
+
+def write_plan_binary(file_path, tasks, header=None):
+    write_file_atomic(file_path, encode_plan_binary(tasks, header))
+
+
+def load_plan_from_file(file_path, catalog):
+    """Задачи каталога по списку ID из файла плана (в файлах прежнего формата - полные задачи)"""
     try:
+        if is_binary_plan(file_path):
+            _, ids, _ = read_plan_binary(file_path)
+            return [catalog[task_id] for task_id in ids]
         with open(file_path, 'r', encoding='utf-8') as f:
             data = json.load(f)
-        return data.get("tasks", [])
+        if "task_ids" in data:
+            return catalog.decode(data["task_ids"])
+        return catalog.resolve_all(data.get("tasks", []))
     except Exception as e:
-        print(f"Ошибка загрузки {file_path}: {e}")
+        log.error(None, "Ошибка загрузки %s: %s", file_path, e)
         return []
 
 
-def save_plan_to_file(old_file_path, plan):
-    directory = os.path.dirname(old_file_path)
-    parent_dir = os.path.dirname(directory)
-    new_file_path = os.path.join(parent_dir, "new", os.path.basename(old_file_path))
-    if not os.path.exists(parent_dir):
-        os.makedirs(parent_dir)
-    if not os.path.exists(os.path.join(parent_dir, "new")):
-        os.makedirs(os.path.join(parent_dir, "new"))
+def new_plan_path(old_file_path):
+    """plans/old/workerN.json -> plans/new/workerN.json"""
+    parent_dir = os.path.dirname(os.path.dirname(old_file_path))
+    return os.path.join(parent_dir, "new", os.path.basename(old_file_path))
+
+
+def journal_path(old_file_path):
+    """plans/old/workerN.json -> plans/journal/workerN.jsonl"""
+    parent_dir = os.path.dirname(os.path.dirname(old_file_path))
+    name = os.path.splitext(os.path.basename(old_file_path))[0]
+    return os.path.join(parent_dir, "journal", f"{name}.jsonl")
+
+
+def catalog_path(old_file_path):
+    """plans/old/workerN.json -> plans/catalog.json"""
+    parent_dir = os.path.dirname(os.path.dirname(old_file_path))
+    return os.path.join(parent_dir, "catalog.json")
+
+
+def load_snapshot(old_file_path):
+    """Последний сохраненный план из plans/new или None"""
+    try:
+        if is_binary_plan(old_file_path):
+            header, ids, _ = read_plan_binary(new_plan_path(old_file_path))
+            return {**header, "ids": ids}
+        with open(new_plan_path(old_file_path), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_file_atomic(file_path, content):
+    """Запись через временный файл в той же папке и os.replace: файл либо старый, либо новый целиком"""
+    directory = os.path.dirname(file_path) or "."
+    # Временный файл создается с правами 0666, и umask процесса применяет ядро - как к обычному файлу;
+    # mkstemp создал бы его с правами 0600
+    temp_path = os.path.join(directory, f".{uuid.uuid4().hex}.tmp")
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+    try:
+        with (os.fdopen(fd, 'wb') if isinstance(content, bytes) else os.fdopen(fd, 'w', encoding='utf-8')) as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, file_path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def save_plan_to_file(old_file_path, plan, journal_state=None):
+    new_file_path = new_plan_path(old_file_path)
     try:
+        os.makedirs(os.path.dirname(new_file_path), exist_ok=True)
+        if is_binary_plan(old_file_path):
+            # Снимок в том же формате, что и начальный план
+            write_plan_binary(new_file_path, plan, {"journal": journal_state} if journal_state is not None else None)
+            log.debug(None, "План сохранен в %s, задач: %s", new_file_path, len(plan))
+            return True
         data = {
-            "plan": plan,
+            "task_ids": encode_ids(item["id"] for item in plan),
             "total_weight": sum(item["time"] for item in plan)
         }
-        with open(new_file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-        print(f"{get_time()} [SAVE] План сохранен в {new_file_path}, вес: {data['total_weight']}")
+        if journal_state is not None:
+            # До какой записи журнала снимок учитывает изменения плана
+            data["journal"] = journal_state
+        # Компактная запись без отступов: план на тысячи задач пишется в разы быстрее
+        write_file_atomic(new_file_path, json.dumps(data, ensure_ascii=False, separators=(',', ':')))
+        log.debug(None, "План сохранен в %s, вес: %s", new_file_path, data["total_weight"])
         return True
     except Exception as e:
-        print(f"{get_time()} [SAVE] Ошибка сохранения {new_file_path}: {e}")
-        return False
\ No newline at end of file
+        log.error(None, "Ошибка сохранения %s: %s", new_file_path, e)
+        return False
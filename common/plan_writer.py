@@ -0,0 +1,56 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from common.plan_load_save import save_plan_to_file
+
+# Общий пул для всех агентов процесса: сериализация и запись не блокируют event loop
+io_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="plan-writer")
+
+
+class PlanWriter:
+    """Отложенное сохранение плана агента (write-behind).
+
+    mark_dirty() только отмечает, что план изменился; запись выполняется через delay
+    секунд, поэтому серия передач подряд дает одну запись. flush() пишет сразу,
+    если есть несохраненные изменения, и ничего не делает для неизменного плана.
+    """
+
+    def __init__(self, plan_file, snapshot, delay=1.0, journal=None):
+        self.plan_file = plan_file
+        self.snapshot = snapshot  # функция, возвращающая список задач плана
+        self.delay = delay
+        self.journal = journal  # PlanJournal: снимок становится точкой сжатия журнала
+        self.dirty = False
+        self.writes = 0
+        self._timer = None
+        self._lock = asyncio.Lock()
+
+    def mark_dirty(self):
+        self.dirty = True
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.delay, self._flush_later)
+
+    def _flush_later(self):
+        self._timer = None
+        asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        """Записывает план, если он изменился. Возвращает False только при ошибке записи"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        async with self._lock:
+            if not self.dirty:
+                return True
+            # Снимок берется в event loop, дальше план может меняться независимо от записи
+            plan = self.snapshot()
+            journal_state = self.journal.checkpoint() if self.journal is not None else None
+            self.dirty = False
+            loop = asyncio.get_running_loop()
+            success = await loop.run_in_executor(io_executor, save_plan_to_file, self.plan_file, plan, journal_state)
+            if success:
+                self.writes += 1
+                if self.journal is not None:
+                    self.journal.release(journal_state)
+            else:
+                self.dirty = True
+            return success
@@ -0,0 +1,257 @@
+import bisect
+import heapq
+import random
+import time
+from collections import Counter
+from common.specializations import spec_mask, task_mask
+
+# Время поиска по умолчанию, секунды
+DEFAULT_TIME_LIMIT = 10.0
+# Если классов агентов (разных наборов специализаций) не больше, нижняя граница перебирает
+# все их объединения и совпадает с оптимумом дробного распределения
+EXACT_BOUND_CLASSES = 12
+# Поиск останавливается, когда makespan хуже нижней границы не больше чем в (1 + TOLERANCE) раз:
+# точное равенство с дробной границей при вещественных временах почти не достигается
+TOLERANCE = 1e-4
+EPS = 1e-9
+
+
+def lower_bound(agents_data, tasks):
+    """Нижняя граница makespan (максимальной нагрузки агента) при ограничениях по специализациям.
+
+    Для множества агентов S все задачи, которые могут выполнить только агенты из S, дают
+    нагрузку не меньше их суммы / |S|; если таких задач больше |S|, какой-то агент получит две,
+    то есть не меньше суммы |S|-й и (|S|+1)-й по величине. Плюс самая большая задача.
+    S перебираются как объединения классов агентов с одинаковыми специализациями.
+    """
+    sizes = Counter(spec_mask(a.get('specializations')) for a in agents_data)
+    classes = list(sizes)
+    # Задачи по множеству совместимых классов (бит i - класс classes[i])
+    groups = {}
+    class_sets = {}
+    for t in tasks:
+        mask = task_mask(t)
+        class_set = class_sets.get(mask)
+        if class_set is None:
+            class_set = class_sets[mask] = sum(1 << i for i, agent_mask in enumerate(classes)
+                                               if mask & ~agent_mask == 0)
+        if class_set:
+            groups.setdefault(class_set, []).append(t.get('time', 0))
+    if not groups:
+        return 0.0
+
+    bound = max(max(times) for times in groups.values())
+    totals = {class_set: sum(times) for class_set, times in groups.items()}
+
+    def agents_in(class_set):
+        return sum(sizes[agent_mask] for i, agent_mask in enumerate(classes) if class_set >> i & 1)
+
+    if len(classes) <= EXACT_BOUND_CLASSES:
+        candidates = range(1, 1 << len(classes))
+    else:
+        candidates = list(groups) + [(1 << len(classes)) - 1]
+    for union in candidates:
+        total = sum(value for class_set, value in totals.items() if class_set & ~union == 0)
+        if total:
+            bound = max(bound, total / agents_in(union))
+
+    for union in groups:
+        n = agents_in(union)
+        largest = heapq.nlargest(n + 1, (value for class_set, times in groups.items()
+                                         if class_set & ~union == 0 for value in times))
+        if len(largest) > n:
+            bound = max(bound, largest[n - 1] + largest[n])
+    return bound
+
+
+class _LocalSearch:
+    """Распределение задач по номерам: нагрузки агентов и задачи каждого агента,
+    разложенные по маске задачи и отсортированные по времени (для поиска пары к обмену)"""
+
+    def __init__(self, agent_masks, times, masks):
+        self.agent_masks = agent_masks
+        self.times = times
+        self.masks = masks
+        self.loads = [0.0] * len(agent_masks)
+        self.owner = [None] * len(times)
+        self.items = [{} for _ in agent_masks]  # агент -> маска задачи -> [(time, номер задачи)]
+        self._compatible = {}
+
+    def agents_for(self, mask):
+        agents = self._compatible.get(mask)
+        if agents is None:
+            agents = self._compatible[mask] = [i for i, agent_mask in enumerate(self.agent_masks)
+                                               if mask & ~agent_mask == 0]
+        return agents
+
+    def place(self, j, i):
+        self.owner[j] = i
+        self.loads[i] += self.times[j]
+        bisect.insort(self.items[i].setdefault(self.masks[j], []), (self.times[j], j))
+
+    def unplace(self, j):
+        i = self.owner[j]
+        entries = self.items[i][self.masks[j]]
+        del entries[bisect.bisect_left(entries, (self.times[j], j))]
+        self.loads[i] -= self.times[j]
+        self.owner[j] = None
+
+    def move(self, j, i):
+        self.unplace(j)
+        self.place(j, i)
+
+    def lpt(self):
+        """Задачи по убыванию времени - наименее загруженному совместимому агенту; число нераспределенных"""
+        classes = {}
+        for i, agent_mask in enumerate(self.agent_masks):
+            classes.setdefault(agent_mask, []).append((0.0, i))
+        candidates = {}
+        unassigned = 0
+        for j in sorted(range(len(self.times)), key=lambda j: self.times[j], reverse=True):
+            heaps = candidates.get(self.masks[j])
+            if heaps is None:
+                heaps = candidates[self.masks[j]] = [heap for agent_mask, heap in classes.items()
+                                                     if self.masks[j] & ~agent_mask == 0]
+            if not heaps:
+                unassigned += 1
+                continue
+            heap = min(heaps, key=lambda h: h[0])
+            load, i = heap[0]
+            heapq.heapreplace(heap, (load + self.times[j], i))
+            self.place(j, i)
+        return unassigned
+
+    def best_step(self, c):
+        """Лучший перенос задачи с агента c или обмен задачами с ним, после которого нагрузка c
+        уменьшается и оба агента остаются ниже прежней нагрузки c: (новый максимум пары, j, b, u)"""
+        load_c = self.loads[c]
+        best = None
+        for mask, entries in self.items[c].items():
+            for b in self.agents_for(mask):
+                gap = load_c - self.loads[b]
+                if b == c or gap <= EPS:
+                    continue
+                # Перенос: лучше всего задача около gap/2, подходит любая меньше gap
+                k = bisect.bisect_left(entries, (gap / 2, -1))
+                for t, j in entries[max(0, k - 1):k + 1]:
+                    if EPS < t < gap - EPS:
+                        new_max = max(self.loads[b] + t, load_c - t)
+                        if best is None or new_max < best[0]:
+                            best = (new_max, j, b, None)
+        if best is not None:
+            return best
+
+        agent_mask_c = self.agent_masks[c]
+        for mask, entries in self.items[c].items():
+            for b in self.agents_for(mask):
+                gap = load_c - self.loads[b]
+                if b == c or gap <= EPS:
+                    continue
+                for other_mask, other_entries in self.items[b].items():
+                    if other_mask & ~agent_mask_c:
+                        continue
+                    for t, j in entries:
+                        # Обмен j на u: разность t - u лучше всего около gap/2, подходит любая в (0, gap)
+                        k = bisect.bisect_left(other_entries, (t - gap / 2, -1))
+                        for u_time, u in other_entries[max(0, k - 1):k + 1]:
+                            d = t - u_time
+                            if EPS < d < gap - EPS:
+                                new_max = max(self.loads[b] + d, load_c - d)
+                                if best is None or new_max < best[0]:
+                                    best = (new_max, j, b, u)
+        return best
+
+    def kick(self, c, rng):
+        """Случайный перенос задачи с агента c: выход из локального минимума"""
+        movable = [(j, agents) for entries in self.items[c].values() for _, j in entries
+                   for agents in [self.agents_for(self.masks[j])] if len(agents) > 1]
+        if not movable:
+            return False
+        j, agents = rng.choice(movable)
+        self.move(j, rng.choice([b for b in agents if b != c]))
+        return True
+
+    def search(self, bound, deadline, rng):
+        """Улучшает распределение до deadline или до нижней границы; возвращает (шагов, улучшений)"""
+        steps = improvements = 0
+        best_makespan = max(self.loads, default=0.0)
+        best_owner = self.owner[:]
+        while best_makespan > bound * (1 + TOLERANCE) + EPS and time.perf_counter() < deadline:
+            c = max(range(len(self.loads)), key=self.loads.__getitem__)
+            step = self.best_step(c)
+            if step is None:
+                if not self.kick(c, rng):
+                    break
+            else:
+                _, j, b, u = step
+                self.move(j, b)
+                if u is not None:
+                    self.move(u, c)
+            steps += 1
+            makespan = max(self.loads)
+            if makespan < best_makespan - EPS:
+                best_makespan, best_owner = makespan, self.owner[:]
+                improvements += 1
+        if best_owner != self.owner:
+            for j, i in enumerate(best_owner):
+                if i is not None and self.owner[j] != i:
+                    self.move(j, i)
+        return steps, improvements
+
+
+def solve(agents_data, tasks, time_limit=DEFAULT_TIME_LIMIT, seed=None):
+    """Распределение задач, минимизирующее максимальную нагрузку агента (makespan).
+
+    Начальное решение - LPT, затем до исчерпания time_limit секунд локальный поиск:
+    переносы задач и обмены парами задач с самого загруженного агента, из локального
+    минимума - случайный перенос; сохраняется лучшее найденное решение. Поиск
+    останавливается раньше, если makespan достиг нижней границы (lower_bound).
+
+    Возвращает (agent_map в формате assign_tasks, отчет) - в отчете makespan, нижняя
+    граница и относительный разрыв gap = makespan / lower_bound - 1.
+    """
+    started = time.perf_counter()
+    rng = random.Random(seed if seed is not None else random.random())
+    agent_masks = [spec_mask(a.get('specializations')) for a in agents_data]
+    search = _LocalSearch(agent_masks, [t.get('time', 0) for t in tasks], [task_mask(t) for t in tasks])
+    unassigned = search.lpt()
+    lpt_makespan = max(search.loads, default=0.0)
+    bound = lower_bound(agents_data, tasks)
+    steps, improvements = search.search(bound, started + time_limit, rng)
+
+    agent_map = {a['jid']: {'agent': a, 'tasks': [], 'total_task_time': 0.0} for a in agents_data}
+    for j, i in enumerate(search.owner):
+        if i is not None:
+            agent_data = agent_map[agents_data[i]['jid']]
+            agent_data['tasks'].append(tasks[j])
+            agent_data['total_task_time'] += tasks[j].get('time', 0)
+    # Нагрузки пересчитываются заново: после тысяч переносов в search.loads накапливается ошибка округления
+    makespan = max((agent_data['total_task_time'] for agent_data in agent_map.values()), default=0.0)
+
+    report = {
+        "agents": len(agents_data),
+        "tasks": len(tasks),
+        "unassigned": unassigned,
+        "lower_bound": bound,
+        "lpt_makespan": lpt_makespan,
+        "makespan": makespan,
+        "gap": gap(makespan, bound),
+        "optimal": makespan <= bound * (1 + TOLERANCE) + EPS,
+        "steps": steps,
+        "improvements": improvements,
+        "elapsed": time.perf_counter() - started,
+    }
+    return agent_map, report
+
+
+def gap(makespan, bound):
+    """Относительный разрыв до нижней границы: 0.05 - не больше чем на 5% хуже оптимума"""
+    return makespan / bound - 1 if bound else 0.0
+
+
+def format_report(report):
+    return (f"makespan {report['makespan']:.2f} (LPT {report['lpt_makespan']:.2f}), "
+            f"нижняя граница {report['lower_bound']:.2f}, разрыв {report['gap'] * 100:.2f}%"
+            f"{' - достигнута нижняя граница' if report['optimal'] else ''}, "
+            f"{report['improvements']} улучшений за {report['elapsed']:.2f} с"
+            f"{', не распределено задач: %d' % report['unassigned'] if report['unassigned'] else ''}")
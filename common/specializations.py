@@ -0,0 +1,58 @@
+class SpecializationRegistry:
+    """Специализации процесса как биты: первой встреченной - бит 0, следующей - бит 1 и т.д.
+
+    Набор специализаций - целое число (маска). Задача с маской task совместима с агентом
+    с маской agent, если task & ~agent == 0. Номера битов зависят от порядка регистрации,
+    поэтому маски не покидают процесс: в сообщениях и файлах остаются названия.
+    """
+
+    def __init__(self):
+        self._bits = {}  # название -> маска из одного бита
+        self._names = []  # номер бита -> название
+        self._masks = {}  # кортеж названий -> маска
+
+    def bit(self, name):
+        bit = self._bits.get(name)
+        if bit is None:
+            bit = self._bits[name] = 1 << len(self._names)
+            self._names.append(name)
+        return bit
+
+    def mask(self, names):
+        key = tuple(names or ())
+        mask = self._masks.get(key)
+        if mask is None:
+            mask = 0
+            for name in key:
+                mask |= self.bit(name)
+            self._masks[key] = mask
+        return mask
+
+    def names(self, mask):
+        return [name for index, name in enumerate(self._names) if mask >> index & 1]
+
+
+registry = SpecializationRegistry()
+
+
+def spec_mask(names):
+    """Маска набора специализаций в общем реестре процесса"""
+    return registry.mask(names)
+
+
+def task_mask(task):
+    """Маска задачи: у задач каталога она уже посчитана, у задач из tasks.json - только названия"""
+    mask = task.get("spec_mask")
+    return mask if mask is not None else spec_mask(task.get("specializations"))
+
+
+def compatible(task_mask, agent_mask):
+    return task_mask & ~agent_mask == 0
+
+
+def single_bits(mask):
+    """Маски отдельных специализаций, входящих в mask"""
+    while mask:
+        bit = mask & -mask
+        yield bit
+        mask ^= bit
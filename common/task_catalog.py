@@ -0,0 +1,295 @@
+import base64
+import gc
+import json
+import os
+import re
+from common.specializations import spec_mask
+
+# Размер блока, которым читается файл задач
+READ_CHUNK = 1 << 20
+# Начало файла каталога: {"tasks": [
+_CATALOG_PREFIX = re.compile(r'\{\s*"tasks"\s*:\s*\[')
+
+
+def encode_ids(ids):
+    """Список ID задач -> короткая ASCII-строка для JSON.
+
+    ID сортируются, записываются разности соседних значений в varint (7 бит на байт)
+    и кодируются в base64. Порядок задач не сохраняется - плану он не нужен.
+    """
+    out = bytearray()
+    previous = 0
+    for task_id in sorted(ids):
+        delta = task_id - previous
+        previous = task_id
+        while delta >= 0x80:
+            out.append(delta & 0x7F | 0x80)
+            delta >>= 7
+        out.append(delta)
+    return base64.b64encode(bytes(out)).decode("ascii")
+
+
+def decode_ids(text):
+    """Обратное к encode_ids: ID по возрастанию"""
+    ids = []
+    value = shift = previous = 0
+    for byte in base64.b64decode(text):
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        previous += value
+        ids.append(previous)
+        value = shift = 0
+    return ids
+
+
+class TaskCatalog:
+    """Общий каталог задач: ID задачи - ее номер в tasks.json.
+
+    Задачи каталога - словари с добавленными полями "id" и "spec_mask" (маска
+    специализаций, действует только внутри процесса); агенты одного процесса
+    держат в планах ссылки на одни и те же объекты, а в сообщения, снимки и журнал
+    попадают только ID (encode/decode). Задачи каталога не изменяются, а сам каталог
+    только дополняется (extend): задачи, поступившие во время работы, получают следующие ID.
+    """
+
+    def __init__(self, tasks):
+        self.tasks = []
+        self._by_content = None
+        self._specializations = {}  # набор специализаций -> общий для задач список и маска
+        # Дополнения каталога (append_catalog): прочитано байт из файла дополнений и позиции
+        # чтения inbox из последней записи
+        self.appended_bytes = 0
+        self.inbox_offsets = None
+        self.extend(tasks)
+
+    def extend(self, tasks):
+        """Добавляет задачи в конец каталога; возвращает их задачи каталога.
+
+        tasks может быть итератором (iter_tasks). Задачи с одинаковыми специализациями
+        держат один и тот же список: на миллионе задач это сотни мегабайт.
+        """
+        start = len(self.tasks)
+        # Сборщик мусора на время загрузки выключен: задачи не образуют циклов, а на миллионе
+        # новых словарей его проходы занимают половину времени загрузки
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            added = [self._entry(task, start + offset) for offset, task in enumerate(tasks)]
+        finally:
+            if enabled:
+                gc.enable()
+        self.tasks.extend(added)
+        self._by_content = None
+        return added
+
+    def _entry(self, task, task_id):
+        names = task.get("specializations")
+        if not isinstance(names, list):
+            return {**task, "id": task_id, "spec_mask": spec_mask(names)}
+        key = tuple(names)
+        shared = self._specializations.get(key)
+        if shared is None:
+            shared = self._specializations[key] = (names, spec_mask(names))
+        return {**task, "id": task_id, "specializations": shared[0], "spec_mask": shared[1]}
+
+    def __getitem__(self, task_id):
+        return self.tasks[task_id]
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def encode(self, tasks):
+        return encode_ids(task["id"] for task in tasks)
+
+    def decode(self, text):
+        return [self.tasks[task_id] for task_id in decode_ids(text)] if text else []
+
+    def resolve_all(self, tasks):
+        """Задачи каталога для полных объектов задач (файлы и сообщения прежнего формата).
+
+        Одинаковые задачи получают разные ID; задача, которой нет в каталоге, - ValueError.
+        """
+        if self._by_content is None:
+            self._by_content = {}
+            for task in self.tasks:
+                self._by_content.setdefault(_content_key(task), []).append(task["id"])
+        used = {}
+        resolved = []
+        for task in tasks:
+            key = _content_key(task)
+            ids = self._by_content.get(key, [])
+            index = used.get(key, 0)
+            if index >= len(ids):
+                raise ValueError(f"Задачи нет в каталоге: {task.get('name')}")
+            used[key] = index + 1
+            resolved.append(self.tasks[ids[index]])
+        return resolved
+
+
+def _content_key(task):
+    return json.dumps({k: v for k, v in task.items() if k not in ("id", "spec_mask")},
+                      sort_keys=True, ensure_ascii=False)
+
+
+# Каталоги, уже загруженные процессом: путь -> (отметка файла, каталог)
+_catalogs = {}
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def iter_tasks(path):
+    """Задачи из файла по одной, без чтения файла целиком.
+
+    Форматы: JSON-массив задач (tasks.json), каталог {"tasks": [...]} (catalog.json)
+    и JSONL - одна задача на строку. Файл читается блоками по READ_CHUNK, в памяти -
+    только текущий блок и еще не выданная задача.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        buffer = f.read(READ_CHUNK)
+        eof = not buffer
+        start = len(buffer) - len(buffer.lstrip())
+        match = _CATALOG_PREFIX.match(buffer, start)
+        if match:
+            position = match.end()
+        elif buffer.startswith('[', start):
+            position = start + 1
+        else:
+            # JSONL
+            f.seek(0)
+            yield from (json.loads(line) for line in f if line.strip())
+            return
+
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer) and buffer[position] == ']':
+                return
+            try:
+                task, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                task, end = None, len(buffer)
+            # Задача на границе блока (или конец файла без "]"): дочитываем следующий блок
+            if end >= len(buffer) and not eof:
+                chunk = f.read(READ_CHUNK)
+                eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            if task is None:
+                raise ValueError(f"{path}: некорректный JSON: {buffer[position:position + 80]!r}")
+            yield task
+            position = end
+
+
+def _plain(tasks):
+    # Задачи каталога без полей, которые добавляет TaskCatalog
+    return ({k: v for k, v in task.items() if k not in ("id", "spec_mask")} for task in tasks)
+
+
+def _write_tasks(path, tasks):
+    # Через временный файл: агенты других процессов перечитывают каталог, пока он дополняется.
+    # По одной задаче: весь каталог одной строкой в памяти не нужен
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write('{"tasks":[')
+        for index, task in enumerate(tasks):
+            if index:
+                f.write(',')
+            f.write(json.dumps(task, ensure_ascii=False, separators=(',', ':')))
+        f.write(']}')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def append_path(path):
+    """plans/catalog.json -> plans/catalog.append.jsonl: задачи, дописанные во время работы"""
+    return os.path.splitext(path)[0] + ".append.jsonl"
+
+
+def save_catalog(path, tasks):
+    """Записывает каталог (задачи в порядке tasks, ID - позиция) и возвращает его.
+
+    tasks может быть итератором (iter_tasks): задачи сразу попадают в каталог, без
+    промежуточного списка. Дополнения прежнего каталога удаляются.
+    """
+    catalog = TaskCatalog(tasks)
+    try:
+        os.remove(append_path(path))
+    except FileNotFoundError:
+        pass
+    _write_tasks(path, _plain(catalog.tasks))
+    _catalogs[os.path.abspath(path)] = (_stamp(path), catalog)
+    return catalog
+
+
+def _read_appended(path, catalog):
+    """Добавляет в каталог записи файла дополнений, прочитанные с прошлого раза.
+
+    Неполная последняя строка (запись еще идет или оборвана сбоем) не читается.
+    """
+    try:
+        f = open(append_path(path), 'rb')
+    except FileNotFoundError:
+        return
+    with f:
+        f.seek(catalog.appended_bytes)
+        data = f.read()
+    complete = data.rfind(b"\n") + 1
+    for line in data[:complete].splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        catalog.extend(record["tasks"])
+        if record.get("inbox") is not None:
+            catalog.inbox_offsets = record["inbox"]
+    catalog.appended_bytes += complete
+
+
+def append_catalog(path, catalog, tasks, inbox_offsets=None):
+    """Дописывает новые задачи в конец файла дополнений каталога одной строкой; возвращает задачи каталога.
+
+    Стоимость не зависит от размера каталога. inbox_offsets - позиции чтения inbox после этих
+    задач: они записываются той же строкой, и после сбоя задачи не будут прочитаны и дописаны
+    второй раз (TaskCatalog.inbox_offsets).
+    """
+    _read_appended(path, catalog)
+    record = json.dumps({"tasks": list(_plain(tasks)), "inbox": inbox_offsets},
+                        ensure_ascii=False, separators=(',', ':')) + "\n"
+    data = record.encode('utf-8')
+    with open(append_path(path), 'ab') as f:
+        # Оборванная сбоем строка отбрасывается, новая запись начинается с начала строки
+        f.truncate(catalog.appended_bytes)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    added = catalog.extend(tasks)
+    catalog.appended_bytes += len(data)
+    if inbox_offsets is not None:
+        catalog.inbox_offsets = dict(inbox_offsets)
+    return added
+
+
+def load_catalog(path):
+    """Каталог из файла и его дополнений; все агенты процесса получают один и тот же объект.
+
+    Если каталог дополнен (append_catalog в другом процессе), читаются только новые записи
+    файла дополнений, и ссылки на задачи каталога в планах остаются действительными.
+    """
+    key = os.path.abspath(path)
+    stamp = _stamp(path)
+    cached = _catalogs.get(key)
+    if cached is not None and cached[0] == stamp:
+        catalog = cached[1]
+    else:
+        catalog = TaskCatalog(iter_tasks(path))
+        _catalogs[key] = (stamp, catalog)
+    _read_appended(path, catalog)
+    return catalog
@@ -0,0 +1,101 @@
+import errno
+import json
+import os
+import stat
+
+
+class TaskInbox:
+    """Входящие задачи в формате JSON Lines: одна задача tasks.json на строку.
+
+    path - каталог (читаются все *.jsonl по имени), отдельный дописываемый файл
+    или именованный канал (FIFO). poll() возвращает задачи, появившиеся с прошлого
+    вызова; неполная последняя строка ждет следующего вызова. Для файлов позиции
+    чтения (offsets) можно сохранить и передать при перезапуске, чтобы не читать
+    задачи второй раз; из канала прочитанное не возвращается.
+    """
+
+    def __init__(self, path, offsets=None):
+        self.path = path
+        self.offsets = dict(offsets or {})  # имя файла -> число прочитанных байт
+        self._fifo = None
+        self._buffer = b""
+
+    def poll(self):
+        """(задачи, ошибки): ошибки - описания пропущенных строк (источник, причина, начало строки)"""
+        tasks, errors = [], []
+        if os.path.isdir(self.path):
+            for name in sorted(os.listdir(self.path)):
+                if name.endswith(".jsonl"):
+                    self._read_file(os.path.join(self.path, name), name, tasks, errors)
+        elif os.path.exists(self.path) and stat.S_ISFIFO(os.stat(self.path).st_mode):
+            self._read_fifo(tasks, errors)
+        elif os.path.exists(self.path):
+            self._read_file(self.path, os.path.basename(self.path), tasks, errors)
+        return tasks, errors
+
+    def close(self):
+        if self._fifo is not None:
+            os.close(self._fifo)
+            self._fifo = None
+
+    def _read_file(self, path, name, tasks, errors):
+        offset = self.offsets.get(name, 0)
+        size = os.path.getsize(path)
+        if size < offset:
+            offset = 0  # файл перезаписан заново
+        if size == offset:
+            return
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(size - offset)
+        complete = data.rfind(b"\n") + 1
+        self._parse(data[:complete], name, tasks, errors)
+        self.offsets[name] = offset + complete
+
+    def _read_fifo(self, tasks, errors):
+        if self._fifo is None:
+            # Без O_NONBLOCK open ждал бы, пока канал не откроет пишущий
+            self._fifo = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        chunks = [self._buffer]
+        while True:
+            try:
+                chunk = os.read(self._fifo, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not chunk:
+                break  # пишущих нет
+            chunks.append(chunk)
+        data = b"".join(chunks)
+        complete = data.rfind(b"\n") + 1
+        self._buffer = data[complete:]
+        self._parse(data[:complete], os.path.basename(self.path), tasks, errors)
+
+    @staticmethod
+    def _parse(data, source, tasks, errors):
+        for line in data.split(b"\n"):
+            if not line.strip():
+                continue
+            try:
+                task = json.loads(line)
+                error = validate_task(task)
+            except ValueError as e:
+                error = str(e)
+            if error:
+                errors.append(f"{source}: {error}: {line[:80].decode('utf-8', 'replace')}")
+            else:
+                tasks.append(task)
+
+
+def validate_task(task):
+    """Причина, по которой задача не подходит, или None"""
+    if not isinstance(task, dict):
+        return "задача должна быть объектом"
+    task_time = task.get("time")
+    if isinstance(task_time, bool) or not isinstance(task_time, (int, float)) or task_time < 0:
+        return "нет неотрицательного поля time"
+    specializations = task.get("specializations", [])
+    if not isinstance(specializations, list) or not all(isinstance(name, str) for name in specializations):
+        return "specializations должен быть списком строк"
+    return None
@@ -0,0 +1,113 @@
+import random
+import zlib
+
+TOPOLOGIES = ('full', 'ring', 'regular', 'small-world', 'clusters')
+DEFAULT_DEGREE = 8
+# small-world: доля ребер кольца, переставленных к случайному агенту
+REWIRE_PROBABILITY = 0.1
+GROUPINGS = ('specializations', 'hash')
+DEFAULT_GROUP_SIZE = 10
+
+
+def build_topology(agents, kind='full', degree=DEFAULT_DEGREE, seed=0):
+    """Соседи каждого агента в оверлее, в котором идет балансировка.
+
+    agents - [(jid, специализации)]. При --shards каждый процесс строит оверлей сам, поэтому
+    результат зависит только от порядка agents и seed.
+
+    Виды:
+      full        - все со всеми (прежнее поведение), степень N - 1
+      ring        - кольцо: по degree / 2 ближайших по списку агентов с каждой стороны
+      regular     - объединение degree / 2 случайных циклов через всех агентов: случайный граф
+                    степени не больше degree
+      small-world - кольцо, ребра которого с вероятностью REWIRE_PROBABILITY ведут к случайному
+                    агенту (Уоттс - Строгац); ребро к следующему по кольцу остается на месте
+      clusters    - кольцо через всех и случайные циклы внутри групп агентов с общей
+                    специализацией: задачи специализации передаются по ребрам ее группы
+
+    Граф неориентированный и связный (в каждом виде есть цикл через всех агентов).
+    Возвращает {jid: [jid соседей]}.
+    """
+    jids = [agent[0] for agent in agents]
+    n = len(jids)
+    if kind not in TOPOLOGIES:
+        raise ValueError(f"Unknown topology: {kind}")
+    if kind == 'full' or degree >= n - 1:
+        return {jid: [other for other in jids if other != jid] for jid in jids}
+
+    rng = random.Random(seed)
+    edges = [set() for _ in range(n)]
+
+    def link(a, b):
+        if a != b:
+            edges[a].add(b)
+            edges[b].add(a)
+
+    half = max(1, degree // 2)
+    if kind == 'ring':
+        for i in range(n):
+            for step in range(1, half + 1):
+                link(i, (i + step) % n)
+    elif kind == 'regular':
+        for _ in range(half):
+            _random_cycle(list(range(n)), rng, link)
+    elif kind == 'small-world':
+        for i in range(n):
+            link(i, (i + 1) % n)
+            for step in range(2, half + 1):
+                j = (i + step) % n
+                if rng.random() < REWIRE_PROBABILITY:
+                    j = rng.randrange(n)
+                    # Не больше n попыток найти нового соседа, иначе ребро остается в кольце
+                    for _ in range(n):
+                        if j != i and j not in edges[i]:
+                            break
+                        j = rng.randrange(n)
+                    else:
+                        j = (i + step) % n
+                link(i, j)
+    else:
+        for i in range(n):
+            link(i, (i + 1) % n)
+        groups = {}
+        for i, agent in enumerate(agents):
+            for name in agent[1] or []:
+                groups.setdefault(name, []).append(i)
+        # Агент с m специализациями входит в m групп: на каждую приходится поровну оставшейся степени
+        per_agent = max((len(agent[1] or []) for agent in agents), default=1) or 1
+        cycles = max(1, (degree - 2) // (2 * per_agent))
+        for name in sorted(groups):
+            if len(groups[name]) > 1:
+                for _ in range(cycles):
+                    _random_cycle(list(groups[name]), rng, link)
+
+    return {jids[i]: [jids[j] for j in sorted(edges[i])] for i in range(n)}
+
+
+def _random_cycle(members, rng, link):
+    rng.shuffle(members)
+    for index, member in enumerate(members):
+        link(member, members[index - 1])
+
+
+def build_groups(agents, size=DEFAULT_GROUP_SIZE, key='specializations'):
+    """Группы агентов для иерархической балансировки (agent_impl/behaviour/hierarchy.py).
+
+    key:
+      specializations - подряд идут агенты с одинаковым набором специализаций: переносы внутри
+                        группы почти всегда совместимы
+      hash            - по crc32 jid: в группах смесь специализаций, группы обмениваются чаще
+    Группы не больше size агентов, их размеры отличаются не больше чем на одного; внутри
+    группы jid по возрастанию - в этом порядке выбирается координатор. Возвращает [[jid, ...], ...].
+    """
+    if key not in GROUPINGS:
+        raise ValueError(f"Unknown grouping: {key}")
+    if key == 'specializations':
+        ordered = sorted(agents, key=lambda agent: (sorted(agent[1] or []), agent[0]))
+    else:
+        ordered = sorted(agents, key=lambda agent: (zlib.crc32(agent[0].encode('utf-8')), agent[0]))
+    count = max(1, -(-len(ordered) // max(1, size)))
+    groups = [[] for _ in range(count)]
+    for index, agent in enumerate(ordered):
+        groups[index * count // len(ordered)].append(agent[0])
+    return [sorted(group) for group in groups if group]
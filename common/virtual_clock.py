@@ -0,0 +1,80 @@
+import asyncio
+import selectors
+import time
+from contextlib import contextmanager
+from datetime import datetime
+import spade.behaviour
+
+
+class VirtualClock:
+    """Виртуальные часы для симуляции: время сдвигается скачком, когда event loop простаивает"""
+
+    def __init__(self, start=None):
+        # Время loop считается от нуля, как monotonic: к большим значениям epoch
+        # asyncio не сможет прибавить разрешение часов и таймеры перестанут срабатывать
+        self.epoch = time.time() if start is None else start
+        self._time = 0.0
+        # Задачи в пуле потоков (run_in_executor): пока они идут, время не сдвигается
+        self.pending_io = 0
+
+    def time(self):
+        return self._time
+
+    def now(self):
+        return datetime.fromtimestamp(self.epoch + self._time)
+
+    def elapsed(self):
+        return self._time
+
+    def advance(self, seconds):
+        if seconds > 0:
+            self._time += seconds
+
+    def new_event_loop(self):
+        """Создает event loop, таймеры которого идут по виртуальному времени"""
+        return _VirtualTimeEventLoop(self)
+
+    @contextmanager
+    def patch_spade(self):
+        """PeriodicBehaviour считает активации через spade.behaviour.now — подменяем его на время часов"""
+        original_now = spade.behaviour.now
+        spade.behaviour.now = self.now
+        try:
+            yield self
+        finally:
+            spade.behaviour.now = original_now
+
+
+class _VirtualSelector(selectors.DefaultSelector):
+    def __init__(self, clock):
+        super().__init__()
+        self._clock = clock
+
+    def select(self, timeout=None):
+        # Без таймеров ждать нечего, кроме реального ввода-вывода
+        # или завершения задачи из пула: поток разбудит loop, когда закончит
+        if timeout is None or (self._clock.pending_io and timeout > 0):
+            return super().select(None)
+        events = super().select(0)
+        if not events:
+            self._clock.advance(timeout)
+        return events
+
+
+class _VirtualTimeEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self, clock):
+        super().__init__(_VirtualSelector(clock))
+        self._virtual_clock = clock
+
+    def time(self):
+        return self._virtual_clock.time()
+
+    def run_in_executor(self, executor, func, *args):
+        # Запись в потоке занимает ноль виртуального времени: loop ждет ее по-настоящему
+        future = super().run_in_executor(executor, func, *args)
+        self._virtual_clock.pending_io += 1
+        future.add_done_callback(self._io_done)
+        return future
+
+    def _io_done(self, future):
+        self._virtual_clock.pending_io -= 1
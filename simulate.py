@@ -0,0 +1,171 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from contextlib import nullcontext, redirect_stdout
+from pathlib import Path
+from agent_impl.startup import start_agents
+from agent_impl.transport import LocalBus
+from common.assignment import STRATEGIES
+from common.event_log import configure_logging, shutdown_logging, add_logging_arguments, parse_sample
+from common.metrics import collect, summary
+from common.plan_load_save import PLAN_FORMATS
+from common.task_catalog import iter_tasks
+from common.topology import TOPOLOGIES, DEFAULT_DEGREE, GROUPINGS, DEFAULT_GROUP_SIZE
+from common.virtual_clock import VirtualClock
+from start import load_json, distribute_tasks, create_workers, attach_ingest
+
+
+async def run_simulation(agents, tasks, plans_dir='plans/sim', time_limit=3600.0, latency=0.0, poll_interval=1.0,
+                         agent_settings=None, strategy='lpt', inbox=None, overlay=None,
+                         hierarchy=None, plan_format='json'):
+    """Запускает балансировку на локальной шине и ждет, пока все агенты не остановятся.
+
+    agent_settings - атрибуты WorkerAgent, которые нужно переопределить перед стартом,
+    например {"BALANCE_THRESHOLD": 0.1, "COMMUNICATION_INTERVAL": 2}
+    overlay - оверлей соседей ({"kind": ..., "degree": ...}, см. common/topology.py),
+    hierarchy - группы иерархической балансировки ({"size": ..., "key": ...}, None - попарная),
+    inbox - прием новых задач во время работы (см. start.py --inbox); агенты тогда
+    не останавливаются сами, симуляция идет time_limit секунд,
+    tasks - список или итератор задач (common/task_catalog.py, iter_tasks),
+    plan_format - формат файлов планов (см. start.py --plan-format)
+    """
+    bus = LocalBus(latency=latency)
+    result_dict = distribute_tasks(agents, tasks, os.path.join(plans_dir, 'old'), strategy, plan_format)
+    workers = create_workers(result_dict, transport=bus, overlay=overlay, hierarchy=hierarchy)
+    for w in workers:
+        for name, value in (agent_settings or {}).items():
+            setattr(w, name, value)
+    if inbox:
+        attach_ingest(workers, result_dict, inbox)
+    initial_times = [agent_info[3] for agent_info in result_dict.values()]
+
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    await start_agents(workers)
+
+    # (время от старта, максимальная нагрузка / средняя) на каждом опросе
+    balance_history = []
+    while any(w.is_alive() for w in workers) and loop.time() - started < time_limit:
+        await asyncio.sleep(poll_interval)
+        times = [w.calculate_time() for w in workers]
+        average = sum(times) / len(times)
+        balance_history.append((loop.time() - started, max(times) / average if average else 0.0))
+    elapsed = loop.time() - started
+
+    for w in workers:
+        if w.is_alive():
+            await w.stop()
+
+    final_times = [w.calculate_time() for w in workers]
+    # Сходимость - момент последней успешной передачи задачи
+    last_confirm = bus.last_sent_at.get("transfer_confirm")
+    return {
+        "agents": len(workers),
+        "tasks": len(workers[0].catalog) if workers else 0,
+        "assigned_tasks": sum(len(w.plan) for w in workers),
+        "elapsed": elapsed,
+        "convergence_time": last_confirm - started if last_confirm is not None else 0.0,
+        "finished": not any(w.is_alive() for w in workers),
+        # Остановлены по обнаружении глобального завершения (agent_impl/behaviour/termination.py)
+        "terminated": any(w.terminated for w in workers),
+        "initial_times": initial_times,
+        "final_times": final_times,
+        "balance_history": balance_history,
+        "bus": bus.stats(),
+        "metrics": collect(workers),
+    }
+
+
+def simulate(agents, tasks, virtual_time=True, quiet=True, log_level='INFO', log_jsonl=None, log_sample=None,
+             **kwargs):
+    """Синхронная обертка над run_simulation: свой event loop, при необходимости виртуальное время"""
+    clock = VirtualClock() if virtual_time else None
+    loop = clock.new_event_loop() if clock else asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    spade_logger = logging.getLogger("spade")
+    spade_level = spade_logger.level
+    if quiet:
+        spade_logger.setLevel(logging.ERROR)
+
+    configure_logging(log_level, console=not quiet, jsonl_path=log_jsonl, sample=log_sample)
+
+    wall_started = time.perf_counter()
+    try:
+        with open(os.devnull, 'w', encoding='utf-8') as devnull, \
+                (clock.patch_spade() if clock else nullcontext()), \
+                (redirect_stdout(devnull) if quiet else nullcontext()):
+            result = loop.run_until_complete(run_simulation(agents, tasks, **kwargs))
+            # Добиваем поведения, которые еще ждут receive(timeout) после остановки агентов
+            pending = asyncio.all_tasks(loop)
+            for task in pending:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+    finally:
+        shutdown_logging()
+        spade_logger.setLevel(spade_level)
+        asyncio.set_event_loop(None)
+        loop.close()
+
+    result["wall_time"] = time.perf_counter() - wall_started
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate balancing on an in-process bus without the XMPP server')
+    parser.add_argument('--agents-file', default='agents.json')
+    parser.add_argument('--tasks-file', default='tasks.json')
+    parser.add_argument('--plans-dir', default='plans/sim')
+    parser.add_argument('--time-limit', type=float, default=3600.0, help='seconds of (virtual) time')
+    parser.add_argument('--strategy', default='lpt', choices=STRATEGIES, help='initial task assignment')
+    parser.add_argument('--plan-format', default='json', choices=PLAN_FORMATS, help='initial plans and snapshots')
+    parser.add_argument('--latency', type=float, default=0.0, help='message delivery delay, seconds')
+    parser.add_argument('--real-time', action='store_true', help='use wall clock instead of the virtual clock')
+    parser.add_argument('--verbose', action='store_true', help='keep agent output')
+    parser.add_argument('--metrics-json', help='write agent metrics and their summary to this file')
+    parser.add_argument('--topology', default='full', choices=TOPOLOGIES, help='neighbours of each agent')
+    parser.add_argument('--degree', type=int, default=DEFAULT_DEGREE, help='neighbours per agent (except full)')
+    parser.add_argument('--balancing', default='gossip', choices=('gossip', 'hierarchical'))
+    parser.add_argument('--group-size', type=int, default=DEFAULT_GROUP_SIZE, help='agents per group (hierarchical)')
+    parser.add_argument('--group-by', default='specializations', choices=GROUPINGS)
+    parser.add_argument('--inbox', help='accept new tasks from this JSONL directory, file or named pipe')
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+
+    agents = load_json(Path(args.agents_file))
+    tasks = iter_tasks(Path(args.tasks_file))
+
+    result = simulate(agents, tasks,
+                      virtual_time=not args.real_time,
+                      quiet=not args.verbose,
+                      log_level=args.log_level,
+                      log_jsonl=args.log_jsonl,
+                      log_sample=parse_sample(args.log_sample),
+                      plans_dir=args.plans_dir,
+                      time_limit=args.time_limit,
+                      latency=args.latency,
+                      strategy=args.strategy,
+                      plan_format=args.plan_format,
+                      inbox=args.inbox,
+                      overlay={"kind": args.topology, "degree": args.degree},
+                      hierarchy={"size": args.group_size, "key": args.group_by}
+                      if args.balancing == 'hierarchical' else None)
+
+    initial, final = result["initial_times"], result["final_times"]
+    print(f"Agents: {result['agents']}, tasks: {result['tasks']}, finished: {result['finished']}, "
+          f"terminated: {result['terminated']}")
+    print(f"Simulated time: {result['elapsed']:.1f} s, wall time: {result['wall_time']:.2f} s")
+    print(f"Load before: min {min(initial):.2f}, max {max(initial):.2f}")
+    print(f"Load after:  min {min(final):.2f}, max {max(final):.2f}")
+    print(f"Messages: {result['bus']['messages_sent']} "
+          f"(dropped {result['bus']['messages_dropped']}), bytes: {result['bus']['bytes_sent']}")
+    if args.metrics_json:
+        with open(args.metrics_json, 'w', encoding='utf-8') as f:
+            json.dump({"series": result["metrics"], "summary": summary(result["metrics"])}, f, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import argparse
+import json
+import os
+from pathlib import Path
+from common.plan_load_save import write_file_atomic, read_plan_binary, is_binary_plan, PLAN_FORMATS
+from common.solver import solve, format_report, gap, DEFAULT_TIME_LIMIT
+from common.task_catalog import TaskCatalog, save_catalog, iter_tasks
+from start import load_json, write_old_plans
+
+
+def score_plans(plans_dir):
+    """Максимальная нагрузка и число агентов по сохраненным планам (например plans/new после балансировки)"""
+    loads = []
+    for name in sorted(os.listdir(plans_dir)):
+        if name.endswith('.json'):
+            data = load_json(Path(plans_dir) / name)
+            loads.append(data.get("total_weight", data.get("total_task_time", 0.0)))
+        elif is_binary_plan(name):
+            header, _, _ = read_plan_binary(os.path.join(plans_dir, name), columns=False)
+            loads.append(header["total_weight"])
+    return max(loads, default=0.0), len(loads)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Offline assignment minimizing the maximum agent load: writes plans/old and an optimality gap report')
+    parser.add_argument('--agents-file', default='common/agents.json')
+    parser.add_argument('--tasks-file', default='common/tasks.json')
+    parser.add_argument('--time-limit', type=float, default=DEFAULT_TIME_LIMIT, help='search time budget, seconds')
+    parser.add_argument('--seed', type=int, help='seed of the random moves of the local search')
+    parser.add_argument('--plans-dir', default='plans', help='plans/old and catalog.json are written here')
+    parser.add_argument('--plan-format', default='json', choices=PLAN_FORMATS, help='format of the written plans')
+    parser.add_argument('--report', help='report file (default: <plans-dir>/solver_report.json)')
+    parser.add_argument('--score', metavar='DIR',
+                        help='compare the balanced plans in DIR (e.g. plans/new) with the lower bound')
+    parser.add_argument('--dry-run', action='store_true', help='only print the report, do not write plans')
+    args = parser.parse_args()
+
+    agents_path = Path(args.agents_file)
+    tasks_path = Path(args.tasks_file)
+    if not agents_path.exists():
+        print(f'Agents file not found: {agents_path}')
+        agents_path = "agents.json"
+    if not tasks_path.exists():
+        print(f'Tasks file not found: {tasks_path}')
+        tasks_path = "tasks.json"
+    agents = load_json(agents_path)
+    # Задачи каталога: в планы записываются их ID
+    catalog = TaskCatalog(iter_tasks(tasks_path))
+
+    agent_map, report = solve(agents, catalog.tasks, time_limit=args.time_limit, seed=args.seed)
+    print(f"{len(agents)} агентов, {len(catalog)} задач: {format_report(report)}")
+    report.update(time_limit=args.time_limit, seed=args.seed)
+
+    if args.score:
+        makespan, n_agents = score_plans(args.score)
+        report["distributed"] = {
+            "plans_dir": args.score,
+            "agents": n_agents,
+            "makespan": makespan,
+            "gap": gap(makespan, report["lower_bound"]),
+            "vs_solver": makespan / report["makespan"] - 1 if report["makespan"] else 0.0,
+        }
+        print(f"Планы {args.score}: makespan {makespan:.2f}, разрыв до нижней границы "
+              f"{report['distributed']['gap'] * 100:.2f}%, до решения {report['distributed']['vs_solver'] * 100:.2f}%")
+
+    if args.dry_run:
+        return
+    save_catalog(os.path.join(args.plans_dir, 'catalog.json'), catalog.tasks)
+    write_old_plans(agent_map, os.path.join(args.plans_dir, 'old'), args.plan_format)
+    report_path = args.report or os.path.join(args.plans_dir, 'solver_report.json')
+    write_file_atomic(report_path, json.dumps(report, ensure_ascii=False, indent=2))
+    print(f"Планы записаны в {os.path.join(args.plans_dir, 'old')}, отчет - {report_path}")
+
+
+if __name__ == '__main__':
+    main()
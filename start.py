@@ -2,10 +2,22 @@ import sys
 import argparse
 import json
 import asyncio
+import multiprocessing
+import queue
+import signal
+import time
 from pathlib import Path
 from agent_impl.agent import WorkerAgent
+from agent_impl.behaviour.ingest import IngestBehaviour, ingest_state_path
+from agent_impl.startup import start_agents
+from common.assignment import assign_tasks, STRATEGIES
 from common.get_time import get_time
-import random
+from common.event_log import configure_logging, shutdown_logging, add_logging_arguments, parse_sample
+from common.metrics import MetricsExporter, collect
+from common.plan_load_save import PLAN_FORMATS, plan_file_name, is_binary_plan, write_plan_binary
+from common.plan_writer import io_executor
+from common.task_catalog import save_catalog, load_catalog, encode_ids, iter_tasks
+from common.topology import build_topology, build_groups, TOPOLOGIES, DEFAULT_DEGREE, GROUPINGS, DEFAULT_GROUP_SIZE
 import json
 import os
 import shutil
@@ -16,36 +28,23 @@ def load_json(p: Path):
         return json.load(f)
 
 
-def distribute_tasks(agents_data, tasks):
-    # Prepare per-agent backpacks and current total weights
-    agent_map = {}
-    for a in agents_data:
-        agent_map[a['jid']] = {
-            'agent': a,
-            'tasks': [],
-            'total_task_time': 0.0
-        }
-
-    # For each task, try to assign to an agent whose specialization is allowed
-    for t in tasks:
-        task_spec = t.get('specializations')
-        if task_spec:
-            # Получаем все элементы agent_map и перемешиваем их в случайном порядке
-            agent_items = list(agent_map.items())
-            random.shuffle(agent_items)
-
-            for jid, agent_data in agent_items:
-                agent_spec = agent_data["agent"].get('specializations')
-                if all(spec in agent_spec for spec in task_spec):
-                    # Добавляем задачу агенту
-                    agent_map[jid]['tasks'].append(t)
-                    # Обновляем общее время задач агента
-                    task_time = t.get('time', 0)  # предполагаем, что у задачи есть поле 'time'
-                    agent_map[jid]['total_task_time'] += task_time
-                    break
+def distribute_tasks(agents_data, tasks, old_plans_dir='plans/old', strategy='lpt', plan_format='json'):
+    # Общий каталог задач рядом с plans/old: ID задачи - ее номер в tasks.
+    # tasks может быть итератором (iter_tasks): задачи сразу попадают в каталог
+    catalog = save_catalog(os.path.join(os.path.dirname(old_plans_dir), 'catalog.json'), tasks)
 
+    # Per-agent backpacks and total weights, see common/assignment.py for the strategies
+    agent_map = assign_tasks(agents_data, catalog.tasks, strategy)
+    return write_old_plans(agent_map, old_plans_dir, plan_format)
+
+
+def write_old_plans(agent_map, old_plans_dir='plans/old', plan_format='json'):
+    """Записывает начальные планы агентов (задачи - ID каталога) и возвращает result_dict для create_workers.
+
+    plan_format: json - ID в base64 (encode_ids), binary - столбцы ID и трудозатрат (файлы *.plan,
+    common/plan_load_save.py), которые агент при старте читает через mmap без разбора JSON.
+    """
     # Очищаем папку plans/old/ и сохраняем данные агентов
-    old_plans_dir = 'plans/old'
 
     # Создаем папку, если она не существует
     if not os.path.exists(old_plans_dir):
@@ -62,15 +61,30 @@ def distribute_tasks(agents_data, tasks):
         except Exception as e:
             print(f"Ошибка при удалении {file_path}: {e}")
 
+    # Журналы передач прошлого запуска к новому распределению не относятся
+    shutil.rmtree(os.path.join(os.path.dirname(old_plans_dir), 'journal'), ignore_errors=True)
+    # Как и состояние приема задач (позиции чтения inbox)
+    ingest_state = ingest_state_path(os.path.join(old_plans_dir, 'agent.json'))
+    if os.path.exists(ingest_state):
+        os.unlink(ingest_state)
+
     # Сохраняем информацию каждого агента в отдельный JSON файл
     result_dict = {}
     for jid, agent_data in agent_map.items():
-        filename = f"{jid.split('@')[0]}.json"
+        filename = plan_file_name(jid, plan_format)
         file_path = os.path.join(old_plans_dir, filename)
 
         try:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(agent_data, f, ensure_ascii=False, indent=2)
+            if is_binary_plan(file_path):
+                write_plan_binary(file_path, agent_data['tasks'], {"agent": agent_data['agent']})
+            else:
+                # Без отступов: на миллионе задач файлы с indent=2 пишутся и читаются заметно дольше
+                with open(file_path, 'w', encoding='utf-8') as f:
+                    json.dump({
+                        "agent": agent_data['agent'],
+                        "task_ids": encode_ids(task["id"] for task in agent_data['tasks']),
+                        "total_task_time": agent_data['total_task_time'],
+                    }, f, ensure_ascii=False, separators=(',', ':'))
 
             total_task_time = agent_data['total_task_time']
             # Добавляем информацию в результирующий словарь
@@ -86,72 +100,389 @@ def distribute_tasks(agents_data, tasks):
     return result_dict
 
 
-async def main():
-    parser = argparse.ArgumentParser(description='Start all agents from data files and distribute tasks')
-    parser.add_argument('--agents-file', default='common/agents.json')
-    parser.add_argument('--tasks-file', default='common/tasks.json')
-    args = parser.parse_args()
-
-    agents_path = Path(args.agents_file)
-    tasks_path = Path(args.tasks_file)
-
-    if not agents_path.exists():
-        print(f'Agents file not found: {agents_path}')
-        agents_path = "agents.json"
-    if not tasks_path.exists():
-        print(f'Tasks file not found: {tasks_path}')
-        tasks_path = "tasks.json"
-
-    agents = load_json(agents_path)
-    tasks = load_json(tasks_path)
-
-    result_dict = distribute_tasks(agents, tasks)
-
-    print(f"{get_time()} Loaded {len(agents)} agents and {len(tasks)} tasks")
+def create_workers(result_dict, transport=None, jids=None, overlay=None, hierarchy=None):
+    """WorkerAgent для каждого агента из result_dict (или только для jids).
 
-    # Instantiate and start all agents
+    Соседи агента - по оверлею common/topology.py: overlay - параметры build_topology
+    ({"kind": ..., "degree": ...}), по умолчанию все остальные агенты.
+    hierarchy - параметры build_groups ({"size": ..., "key": ...}) для иерархической
+    балансировки; члены группы добавляются к соседям.
+    Все агенты result_dict образуют кольцо, по которому ходит маркер обнаружения
+    завершения (agent_impl/behaviour/termination.py).
+    """
     workers = []
+    agents = [(agent_info[0], agent_info[1]) for agent_info in result_dict.values()]
+    ring = [agent_info[0] for agent_info in result_dict.values()]
+    neighbors = build_topology(agents, **(overlay or {}))
+    groups, group_of = None, {}
+    if hierarchy is not None:
+        groups = build_groups(agents, **hierarchy)
+        group_of = {jid: index for index, group in enumerate(groups) for jid in group}
+        for jid, index in group_of.items():
+            known = set(neighbors[jid])
+            neighbors[jid] = neighbors[jid] + [member for member in groups[index]
+                                               if member != jid and member not in known]
 
     for jid, agent_info in result_dict.items():
+        if jids is not None and jid not in jids:
+            continue
         current_jid = agent_info[0]  # jid текущего агента
         current_specializations = agent_info[1]  # специализации текущего агента
-        other_agents = []
-        for other_jid, other_agent_info in result_dict.items():
-            if other_jid != jid:  # исключаем текущего агента
-                other_agents.append([
-                    other_agent_info[0],  # jid другого агента
-                    other_agent_info[1]  # специализации другого агента
-                ])
+        other_agents = [[
+            result_dict[other_jid][0],  # jid соседа
+            result_dict[other_jid][1]  # специализации соседа
+        ] for other_jid in neighbors[jid]]
         w = WorkerAgent(
             jid=current_jid,
             password=current_jid.split('@')[0],
             plan_file=agent_info[2],
             other_agents=other_agents,
             specializations=current_specializations,
-            my_total_task_time=agent_info[3]
+            my_total_task_time=agent_info[3],
+            transport=transport
         )
+        w.ring = ring
+        if groups is not None:
+            w.join_group(groups, group_of[jid])
         workers.append(w)
 
+    return workers
+
+
+def attach_ingest(workers, result_dict, inbox):
+    """Прием задач из inbox во время работы: агенты не останавливаются после балансировки,
+    новые задачи распределяет первый агент result_dict (при --shards - в шарде 0) между всеми агентами,
+    а не только своими соседями по оверлею"""
+    first_jid = next(iter(result_dict), None)
+    for w in workers:
+        w.STOP_WHEN_BALANCED = False
+        if str(w.jid) == first_jid:
+            w.ingest = IngestBehaviour(inbox, w.INGEST_POLL_INTERVAL,
+                                       agents=[agent_info[:2] for jid, agent_info in result_dict.items()
+                                               if jid != first_jid],
+                                       loads={jid: agent_info[3] for jid, agent_info in result_dict.items()})
+
+
+async def run_workers(workers, should_stop=None, on_tick=None, startup=None, barrier=None):
+    """Запускает агентов и сохраняет изменившиеся планы, пока агенты работают или не запрошена остановка.
+
+    Работа заканчивается и тогда, когда один из агентов обнаружил глобальное завершение
+    балансировки: остальные получили от него terminate, а до не получивших дойдет остановка ниже.
+
+    startup - параметры start_agents (concurrency, retries), barrier - см. start_agents.
+    on_tick(workers, lag) вызывается каждый интервал, lag - запаздывание event loop в секундах.
+    """
+    loop = asyncio.get_running_loop()
     try:
-        # start all
-        for w in workers:
-            await w.start()
-            print(f"{get_time()} Started {w.jid}")
+        # start all: параллельно, балансировка - после барьера готовности
+        await start_agents(workers, barrier=barrier, **(startup or {}))
 
         print('All agents started; press Ctrl+C to stop')
-        while True:
-            await asyncio.sleep(workers[0].COMMUNICATION_INTERVAL)
+        interval = workers[0].COMMUNICATION_INTERVAL if workers else 1
+        while any(w.is_alive() for w in workers) and not any(w.terminated for w in workers) \
+                and not (should_stop and should_stop()):
+            started = loop.time()
+            await asyncio.sleep(interval)
+            lag = loop.time() - started - interval
+            # Записываются только изменившиеся планы
             for w in workers:
-                if w.save_plan():
-                    print(f"{get_time()} [PERIODIC SAVE] {w.jid}: Периодическое сохранение выполнено")
-                else:
+                if not await w.flush_plan():
                     print(f"{get_time()} [PERIODIC SAVE] {w.jid}: Ошибка периодического сохранения")
-
-    except KeyboardInterrupt:
+            if on_tick:
+                on_tick(workers, lag)
+    finally:
         print('Stopping agents...')
         for w in workers:
-            await w.stop()
+            if w.is_alive():
+                await w.stop()
+
+
+def split_shards(result_dict, shards):
+    """Агенты по процессам: round-robin, чтобы шарды были одного размера"""
+    jids = list(result_dict)
+    return [jids[i::shards] for i in range(shards) if jids[i::shards]]
+
+
+def shard_stats(shard_id, workers, lag):
+    times = [w.calculate_time() for w in workers]
+    return {
+        "shard": shard_id,
+        "pid": os.getpid(),
+        "agents": len(workers),
+        "alive": sum(1 for w in workers if w.is_alive()),
+        "tasks": sum(len(w.plan) for w in workers),
+        "total_time": sum(times),
+        "max_time": max(times) if times else 0.0,
+        "min_time": min(times) if times else 0.0,
+        "terminated": any(w.terminated for w in workers),
+        "loop_lag": lag,
+        "metrics": collect(workers),
+    }
+
+
+def run_shard(shard_id, jids, result_dict, stop_event, stats_queue, ready_event, startup=None, logging_options=None,
+              inbox=None, overlay=None, hierarchy=None):
+    """Точка входа процесса-шарда: свой event loop для своей части агентов"""
+    logging_options = dict(logging_options or {})
+    if logging_options.get("jsonl_path"):
+        # У каждого процесса свой файл событий
+        root, ext = os.path.splitext(logging_options["jsonl_path"])
+        logging_options["jsonl_path"] = f"{root}.shard{shard_id}{ext}"
+    configure_logging(**logging_options)
+    # Ctrl+C получает вся группа процессов - остановкой шардов управляет родитель через stop_event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+
+    async def all_shards_ready():
+        # Барьер между процессами: родитель взводит ready_event, когда запустились все шарды
+        stats_queue.put({"shard": shard_id, "ready": True})
+        await asyncio.get_running_loop().run_in_executor(None, ready_event.wait)
+
+    async def shard_main():
+        workers = create_workers(result_dict, jids=set(jids), overlay=overlay, hierarchy=hierarchy)
+        if inbox:
+            attach_ingest(workers, result_dict, inbox)
+        await run_workers(workers,
+                          should_stop=stop_event.is_set,
+                          on_tick=lambda ws, lag: stats_queue.put(shard_stats(shard_id, ws, lag)),
+                          startup=startup,
+                          barrier=all_shards_ready)
+        stats_queue.put(shard_stats(shard_id, workers, 0.0))
+
+    try:
+        asyncio.run(shard_main())
+    finally:
+        shutdown_logging()
+
+
+def supervise_shards(result_dict, shards, max_restarts=5, shutdown_timeout=30.0, startup=None,
+                     logging_options=None, exporter=None, inbox=None, overlay=None, hierarchy=None):
+    """Запускает шарды в отдельных процессах, перезапускает упавшие и собирает их статистику.
+
+    Шард, завершившийся с кодом 0 (все его агенты остановились), не перезапускается.
+    После перезапуска агенты восстанавливают планы по журналу передач.
+    exporter (MetricsExporter) получает метрики агентов всех шардов из их отчетов.
+    """
+    ctx = multiprocessing.get_context('spawn')
+    stop_event = ctx.Event()
+    ready_event = ctx.Event()
+    stats_queue = ctx.Queue()
+    shard_jids = split_shards(result_dict, shards)
+
+    def start_shard(shard_id):
+        process = ctx.Process(target=run_shard, name=f"shard-{shard_id}",
+                              args=(shard_id, shard_jids[shard_id], result_dict, stop_event, stats_queue,
+                                    ready_event, startup, logging_options, inbox, overlay, hierarchy))
+        process.start()
+        print(f"{get_time()} [SHARDS] Шард {shard_id}: pid {process.pid}, агентов: {len(shard_jids[shard_id])}")
+        return process
+
+    # Сигналы остановки пересылаются шардам через stop_event
+    def request_stop(signum, frame):
+        if not stop_event.is_set():
+            print(f"{get_time()} [SHARDS] Получен сигнал {signum}, останавливаю шарды")
+        stop_event.set()
+    previous_handlers = {sig: signal.signal(sig, request_stop) for sig in (signal.SIGINT, signal.SIGTERM)}
+
+    processes = {shard_id: start_shard(shard_id) for shard_id in range(len(shard_jids))}
+    restarts = {shard_id: 0 for shard_id in processes}
+    restart_at = {}
+    finished = set()
+    stats = {}
+    ready = set()
+    stop_deadline = None
+    try:
+        while len(finished) < len(processes):
+            try:
+                report = stats_queue.get(timeout=1.0)
+                if report.get("ready"):
+                    ready.add(report["shard"])
+                else:
+                    stats[report["shard"]] = report
+                    if exporter is not None:
+                        exporter.update(series for s in stats.values() for series in s["metrics"])
+                    if report.get("terminated") and not stop_event.is_set():
+                        # Остальные шарды остановятся и без terminate, если сообщение до кого-то не дошло
+                        print(f"{get_time()} [SHARDS] Балансировка завершена, останавливаю шарды")
+                        stop_event.set()
+            except queue.Empty:
+                pass
+
+            now = time.monotonic()
+            if stop_event.is_set() and stop_deadline is None:
+                stop_deadline = now + shutdown_timeout
+
+            for shard_id, process in processes.items():
+                if shard_id in finished or process.is_alive():
+                    continue
+                if shard_id in restart_at:
+                    if now >= restart_at[shard_id] and not stop_event.is_set():
+                        del restart_at[shard_id]
+                        processes[shard_id] = start_shard(shard_id)
+                    elif stop_event.is_set():
+                        finished.add(shard_id)
+                    continue
+                if process.exitcode == 0 or stop_event.is_set():
+                    finished.add(shard_id)
+                elif restarts[shard_id] < max_restarts:
+                    delay = 2 ** restarts[shard_id]
+                    restarts[shard_id] += 1
+                    restart_at[shard_id] = now + delay
+                    print(f"{get_time()} [SHARDS] Шард {shard_id} упал (код {process.exitcode}),"
+                          f" перезапуск {restarts[shard_id]}/{max_restarts} через {delay} с")
+                else:
+                    finished.add(shard_id)
+                    print(f"{get_time()} [SHARDS] Шард {shard_id} упал (код {process.exitcode}),"
+                          f" лимит перезапусков исчерпан")
+
+            # Шард, которому исчерпали перезапуски, барьер не держит
+            if not ready_event.is_set() and ready >= set(processes) - finished:
+                print(f"{get_time()} [SHARDS] Все шарды запущены, начинаем балансировку")
+                ready_event.set()
+
+            if stop_deadline is not None and now > stop_deadline:
+                for process in processes.values():
+                    if process.is_alive():
+                        process.terminate()
+    finally:
+        stop_event.set()
+        ready_event.set()
+        for process in processes.values():
+            process.join(shutdown_timeout)
+            if process.is_alive():
+                process.kill()
+        for sig, handler in previous_handlers.items():
+            signal.signal(sig, handler)
+
+    while True:
+        try:
+            report = stats_queue.get_nowait()
+            if not report.get("ready"):
+                stats[report["shard"]] = report
+        except queue.Empty:
+            break
+    if exporter is not None:
+        exporter.update(series for s in stats.values() for series in s["metrics"])
+    print_shard_stats(stats, restarts)
+    return stats
+
+
+def print_shard_stats(stats, restarts):
+    print(f"{'shard':>5} {'pid':>7} {'agents':>6} {'alive':>5} {'tasks':>7} {'total':>12} {'max':>10} {'lag,s':>7} {'restarts':>8}")
+    for shard_id in sorted(stats):
+        s = stats[shard_id]
+        print(f"{shard_id:>5} {s['pid']:>7} {s['agents']:>6} {s['alive']:>5} {s['tasks']:>7}"
+              f" {s['total_time']:>12.2f} {s['max_time']:>10.2f} {s['loop_lag']:>7.3f} {restarts.get(shard_id, 0):>8}")
+
+
+def print_final_report(stats, elapsed):
+    """Итог работы по отчетам шардов (shard_stats): нагрузка, дисбаланс, передачи и сообщения"""
+    stats = list(stats)
+    agents = sum(s["agents"] for s in stats)
+    total = sum(s["total_time"] for s in stats)
+    max_time = max((s["max_time"] for s in stats), default=0.0)
+    min_time = min((s["min_time"] for s in stats), default=0.0)
+    average = total / agents if agents else 0.0
+    totals = {}
+    for series in (series for s in stats for series in s["metrics"]):
+        if series["type"] == "counter":
+            totals[series["name"]] = totals.get(series["name"], 0) + series["value"]
+    status = "обнаружено завершение" if any(s["terminated"] for s in stats) else "остановлено"
+    print(f"{get_time()} Итог ({status}, {elapsed:.1f} с): агентов {agents}, задач {sum(s['tasks'] for s in stats)}")
+    print(f"  нагрузка: средняя {average:.2f}, min {min_time:.2f}, max {max_time:.2f},"
+          f" max/средняя {max_time / average if average else 0.0:.3f}")
+    print(f"  передач {totals.get('transfers_committed_total', 0):.0f}, обменов {totals.get('swaps_committed_total', 0):.0f},"
+          f" сообщений {totals.get('messages_sent_total', 0):.0f}, волн маркера {totals.get('termination_waves_total', 0):.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Start all agents from data files and distribute tasks')
+    parser.add_argument('--agents-file', default='common/agents.json')
+    parser.add_argument('--tasks-file', default='common/tasks.json')
+    parser.add_argument('--strategy', default='lpt', choices=STRATEGIES, help='initial task assignment')
+    parser.add_argument('--plan-format', default='json', choices=PLAN_FORMATS,
+                        help='initial plans and snapshots: JSON or packed task id/time columns loaded with mmap')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='number of worker processes, each with its own event loop')
+    parser.add_argument('--max-restarts', type=int, default=5, help='restarts of a crashed shard')
+    parser.add_argument('--start-concurrency', type=int, default=50, help='agents connecting at the same time')
+    parser.add_argument('--start-retries', type=int, default=3, help='connection retries per agent')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve agent metrics on http://127.0.0.1:PORT/metrics (and /metrics.json)')
+    parser.add_argument('--metrics-json', help='write a JSON snapshot of agent metrics to this file every interval')
+    parser.add_argument('--topology', default='full', choices=TOPOLOGIES,
+                        help='neighbours of each agent, see common/topology.py')
+    parser.add_argument('--degree', type=int, default=DEFAULT_DEGREE, help='neighbours per agent (except full)')
+    parser.add_argument('--balancing', default='gossip', choices=('gossip', 'hierarchical'),
+                        help='pairwise negotiations or group coordinators planning the moves')
+    parser.add_argument('--group-size', type=int, default=DEFAULT_GROUP_SIZE, help='agents per group (hierarchical)')
+    parser.add_argument('--group-by', default='specializations', choices=GROUPINGS, help='how agents are grouped')
+    parser.add_argument('--inbox', help='accept new tasks while running: a directory of *.jsonl files, '
+                                        'an appended JSONL file or a named pipe, one task per line')
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    logging_options = {"level": args.log_level, "jsonl_path": args.log_jsonl, "sample": parse_sample(args.log_sample)}
+
+    agents_path = Path(args.agents_file)
+    tasks_path = Path(args.tasks_file)
+
+    if not agents_path.exists():
+        print(f'Agents file not found: {agents_path}')
+        agents_path = "agents.json"
+    if not tasks_path.exists():
+        print(f'Tasks file not found: {tasks_path}')
+        tasks_path = "tasks.json"
+
+    agents = load_json(agents_path)
+    # Задачи читаются потоком прямо в каталог: файл целиком в памяти не держится
+    result_dict = distribute_tasks(agents, iter_tasks(tasks_path), strategy=args.strategy, plan_format=args.plan_format)
+
+    # Каталог уже загружен в этом процессе, load_catalog возвращает тот же объект
+    catalog = load_catalog(os.path.join('plans', 'catalog.json'))
+    print(f"{get_time()} Loaded {len(agents)} agents and {len(catalog)} tasks")
+
+    exporter = None
+    if args.metrics_port is not None or args.metrics_json:
+        exporter = MetricsExporter(args.metrics_json)
+        if args.metrics_port is not None:
+            port = exporter.start(args.metrics_port)
+            print(f"{get_time()} Metrics: http://127.0.0.1:{port}/metrics")
+
+    startup = {"concurrency": args.start_concurrency, "retries": args.start_retries}
+    overlay = {"kind": args.topology, "degree": args.degree}
+    hierarchy = {"size": args.group_size, "key": args.group_by} if args.balancing == 'hierarchical' else None
+    started = time.monotonic()
+    try:
+        if args.shards > 1:
+            stats = supervise_shards(result_dict, args.shards, max_restarts=args.max_restarts, startup=startup,
+                                     logging_options=logging_options, exporter=exporter, inbox=args.inbox,
+                                     overlay=overlay, hierarchy=hierarchy)
+            print_final_report(stats.values(), time.monotonic() - started)
+            return
+
+        # Instantiate and start all agents
+        configure_logging(**logging_options)
+        workers = create_workers(result_dict, overlay=overlay, hierarchy=hierarchy)
+        if args.inbox:
+            attach_ingest(workers, result_dict, args.inbox)
+
+        def export_metrics(workers, lag):
+            # Снимок собирается в event loop, JSON пишется в фоновом потоке
+            asyncio.get_running_loop().run_in_executor(io_executor, exporter.update, collect(workers))
+
+        try:
+            asyncio.run(run_workers(workers, on_tick=export_metrics if exporter else None, startup=startup))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            shutdown_logging()
+        if exporter is not None:
+            exporter.update(collect(workers))
+        print_final_report([shard_stats(0, workers, 0.0)], time.monotonic() - started)
+    finally:
+        if exporter is not None:
+            exporter.stop()
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    main()
@@ -1,6 +1,8 @@
 import asyncio
 from agent_impl.agent import WorkerAgent
+from agent_impl.startup import start_agents
 from common.get_time import get_time
+from common.event_log import configure_logging
 
 async def main():
     workers = []
@@ -33,20 +35,18 @@ async def main():
     )
     workers.append(w)
 
-        # start all
-    for w in workers:
-        await w.start()
-        print(f"{get_time()} Started {w.jid}")
+    # start all
+    await start_agents(workers)
 
     print("All agents started; press Ctrl+C to stop")
     while True:
         await asyncio.sleep(workers[0].COMMUNICATION_INTERVAL)
+        # Записываются только изменившиеся планы
         for w in workers:
-            if w.save_plan():
-                print(f"{get_time()} [PERIODIC SAVE] {w.jid}: Периодическое сохранение выполнено")
-            else:
+            if not await w.flush_plan():
                 print(f"{get_time()} [PERIODIC SAVE] {w.jid}: Ошибка периодического сохранения")
 
 
 if __name__ == "__main__":
+    configure_logging()
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,101 @@
+import random
+from itertools import combinations
+import pytest
+from agent_impl.plan import Plan, closest_subset_sum, best_swap
+
+
+def make_tasks(times, masks=None):
+    masks = masks or [1] * len(times)
+    return [{"id": i, "time": t, "spec_mask": m} for i, (t, m) in enumerate(zip(times, masks))]
+
+
+def best_below(values, target, limit=None):
+    """Полный перебор: наибольшая сумма не более limit значений строго меньше target"""
+    limit = len(values) if limit is None else limit
+    return max(sum(c) for r in range(limit + 1) for c in combinations(values, r) if sum(c) < target)
+
+
+def test_find_batch_takes_only_compatible_tasks():
+    # Маска 3 несовместима с соседом, который принимает только специализацию 1
+    plan = Plan(make_tasks([4, 5, 6, 2], [1, 3, 1, 2]))
+    batch = plan.find_batch(20, accepted_mask=1, limit=10, epsilon=0.01)
+    assert sorted(t["id"] for t in batch) == [0, 2]
+
+
+def test_find_batch_respects_limit_and_exclude():
+    plan = Plan(make_tasks([1, 2, 3, 4, 5]))
+    batch = plan.find_batch(100, accepted_mask=1, limit=2, epsilon=0.01, exclude={4})
+    assert [t["id"] for t in batch] == [3, 2]
+
+
+def test_find_batch_sum_stays_below_target():
+    plan = Plan(make_tasks([7, 5, 5, 4]))
+    batch = plan.find_batch(10, accepted_mask=1, limit=10, epsilon=0.01)
+    assert sum(t["time"] for t in batch) == 9
+    assert plan.find_batch(3, accepted_mask=1, limit=10, epsilon=0.01) == []
+
+
+def test_find_batch_improves_greedy_choice():
+    # Жадно: 6 + 3 = 9; точнее 5 + 4 + 3 = 12 < 13
+    plan = Plan(make_tasks([6, 5, 4, 3]))
+    batch = plan.find_batch(13, accepted_mask=1, limit=10, epsilon=0.01)
+    assert sum(t["time"] for t in batch) == 12
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_find_batch_matches_brute_force(seed):
+    rng = random.Random(seed)
+    times = [round(rng.uniform(0.5, 10), 2) for _ in range(8)]
+    masks = [rng.choice([1, 2, 3]) for _ in times]
+    target, epsilon = rng.uniform(5, 40), 0.05
+    plan = Plan(make_tasks(times, masks))
+    batch = plan.find_batch(target, accepted_mask=1, limit=len(times), epsilon=epsilon)
+    total = sum(t["time"] for t in batch)
+    compatible = [t for t, m in zip(times, masks) if m == 1]
+    assert all(t["spec_mask"] == 1 for t in batch)
+    assert total < target
+    assert total >= best_below(compatible, target) - epsilon * target - 1e-9
+
+
+@pytest.mark.parametrize("epsilon", [0.01, 0.1, 0.3])
+def test_closest_subset_sum_error_bound(epsilon):
+    rng = random.Random(7)
+    for _ in range(200):
+        values = [round(rng.uniform(0.1, 20), 2) for _ in range(rng.randint(1, 10))]
+        target = rng.uniform(1, sum(values) + 5)
+        indices = closest_subset_sum(values, target, epsilon)
+        total = sum(values[i] for i in indices)
+        assert len(set(indices)) == len(indices)
+        assert total < target
+        assert total >= best_below(values, target) - epsilon * target - 1e-9
+
+
+def test_closest_subset_sum_edge_cases():
+    assert closest_subset_sum([], 10, 0.1) == []
+    assert closest_subset_sum([10, 11], 10, 0.1) == []
+    assert closest_subset_sum([3, 5, 9], 9, 0.001) == [0, 1]
+
+
+def test_best_swap_pair_exchange():
+    # Отдать 5 и взять 3: разница 4 - 2 * (5 - 3) = 0
+    assert best_swap([5], [3], 4, limit=2) == ([0], [0], 0)
+    # На пару не хватает лимита: только отдать 5, |4 - 10| = 6 > 4 - хода нет
+    assert best_swap([5], [3], 4, limit=1) == ([], [], 4)
+
+
+def test_best_swap_give_and_take():
+    assert best_swap([2, 7], [], 14, limit=5) == ([1], [], 0)
+    assert best_swap([], [1, 3], -6, limit=5) == ([], [1], 0)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_best_swap_diff_arithmetic(seed):
+    rng = random.Random(seed)
+    mine = [rng.randint(1, 20) for _ in range(rng.randint(0, 8))]
+    theirs = [rng.randint(1, 20) for _ in range(rng.randint(0, 8))]
+    diff, limit = rng.randint(-60, 60), rng.randint(1, 6)
+    given, taken, new_diff = best_swap(mine, theirs, diff, limit)
+    assert new_diff == diff - 2 * sum(mine[i] for i in given) + 2 * sum(theirs[j] for j in taken)
+    assert abs(new_diff) <= abs(diff)
+    assert len(given) + len(taken) <= limit
+    assert len(set(given)) == len(given) and len(set(taken)) == len(taken)
@@ -0,0 +1,142 @@
+import asyncio
+import os
+import pytest
+from agent_impl.plan import Plan
+from common.plan_journal import PlanJournal
+from common.task_catalog import TaskCatalog
+
+
+@pytest.fixture
+def catalog():
+    return TaskCatalog([{"name": f"task{i}", "time": i + 1, "specializations": ["A"]} for i in range(10)])
+
+
+def ids(plan):
+    return sorted(task["id"] for task in plan)
+
+
+def open_journal(path, catalog, base, snapshot=None, **kwargs):
+    journal = PlanJournal(str(path), catalog, **kwargs)
+    plan = Plan()
+    journal.recover(plan, lambda: base, snapshot)
+    return journal, plan
+
+
+def close(journal):
+    asyncio.run(journal.close())
+
+
+def test_replay_add_prepare_commit_abort(tmp_path, catalog):
+    path = tmp_path / "agent.journal"
+    journal, plan = open_journal(path, catalog, catalog.tasks[:4])
+    journal.log_add("t1", catalog.tasks[4:6])
+    journal.log_prepare("t2", "b@localhost", catalog.tasks[0:2])
+    journal.log_commit("t2")
+    journal.log_prepare("t3", "c@localhost", catalog.tasks[2:3])
+    journal.log_abort("t3")
+    journal.log_prepare("t4", "d@localhost", catalog.tasks[3:4])
+    close(journal)
+
+    journal, plan = open_journal(path, catalog, catalog.tasks[:4])
+    # t2 отдан, t3 отменен, t4 еще ждет ответа - задачи остаются в плане
+    assert ids(plan) == [2, 3, 4, 5]
+    assert journal.has_applied("t1")
+    assert list(journal.pending) == ["t4"]
+    assert journal.pending["t4"]["to"] == "d@localhost"
+    assert [t["id"] for t in journal.pending["t4"]["tasks"]] == [3]
+    assert journal.seq == 6
+    close(journal)
+
+
+def test_torn_last_record_is_dropped(tmp_path, catalog):
+    path = tmp_path / "agent.journal"
+    journal, plan = open_journal(path, catalog, catalog.tasks[:2])
+    journal.log_add("t1", catalog.tasks[2:4])
+    journal.log_add("t2", catalog.tasks[4:6])
+    close(journal)
+    # Сбой посреди записи последней строки
+    size = os.path.getsize(path)
+    with open(path, 'r+b') as f:
+        f.truncate(size - 10)
+
+    journal, plan = open_journal(path, catalog, catalog.tasks[:2])
+    assert ids(plan) == [0, 1, 2, 3]
+    assert journal.has_applied("t1") and not journal.has_applied("t2")
+    assert journal.seq == 1
+    # Новая запись начинается с новой строки и не склеивается с оборванной
+    journal.log_add("t3", catalog.tasks[6:7])
+    close(journal)
+
+    journal, plan = open_journal(path, catalog, catalog.tasks[:2])
+    assert ids(plan) == [0, 1, 2, 3, 6]
+    assert journal.seq == 2
+    close(journal)
+
+
+def test_recover_from_snapshot_replays_only_tail(tmp_path, catalog):
+    path = tmp_path / "agent.journal"
+    journal, plan = open_journal(path, catalog, catalog.tasks[:2])
+    journal.log_add("t1", catalog.tasks[2:3])
+    plan.append(catalog.tasks[2])
+    snapshot = {"task_ids": catalog.encode(plan), "journal": journal.checkpoint()}
+    journal.log_add("t2", catalog.tasks[3:4])
+    close(journal)
+
+    # Начальные задачи не нужны: все, что до снимка, уже в нем
+    journal = PlanJournal(str(path), catalog)
+    plan = Plan()
+    journal.recover(plan, lambda: pytest.fail("снимок должен заменить начальные задачи"), snapshot)
+    assert ids(plan) == [0, 1, 2, 3]
+    assert journal.has_applied("t1") and journal.has_applied("t2")
+    close(journal)
+
+
+def test_segment_rotation(tmp_path, catalog):
+    path = tmp_path / "agent.journal"
+    old_path = str(path) + ".1"
+    journal, plan = open_journal(path, catalog, [], compact_every=2)
+    for i in range(3):
+        journal.log_add(f"t{i}", catalog.tasks[i:i + 1])
+        plan.append(catalog.tasks[i])
+    journal.log_prepare("p", "b@localhost", catalog.tasks[0:1])
+    state = journal.checkpoint()
+    snapshot = {"task_ids": catalog.encode(plan), "journal": state}
+    assert os.path.exists(old_path)
+    journal.log_commit("p")
+    journal.log_add("t3", catalog.tasks[3:4])
+    close(journal)
+
+    # Снимок еще не записан (release не вызван): восстановление без снимка читает оба сегмента
+    journal, plan = open_journal(path, catalog, [])
+    assert ids(plan) == [1, 2, 3]
+    assert journal.seq == 6
+    close(journal)
+
+    # Со снимком из сегмента <path>.1 нужен только pending, сами записи пропускаются
+    journal, plan = open_journal(path, catalog, [], snapshot)
+    assert ids(plan) == [1, 2, 3]
+    assert not journal.pending
+    # Восстановленный журнал помнит повернутый сегмент и удаляет его, когда снимок записан
+    assert os.path.exists(old_path)
+    journal.release(state)
+    assert not os.path.exists(old_path)
+    close(journal)
+
+
+def test_release_removes_rotated_segment(tmp_path, catalog):
+    path = tmp_path / "agent.journal"
+    old_path = str(path) + ".1"
+    journal, plan = open_journal(path, catalog, [], compact_every=1)
+    journal.log_add("t0", catalog.tasks[0:1])
+    plan.append(catalog.tasks[0])
+    state = journal.checkpoint()
+    snapshot = {"task_ids": catalog.encode(plan), "journal": state}
+    journal.log_add("t1", catalog.tasks[1:2])
+    journal.release(state)
+    assert not os.path.exists(old_path)
+    close(journal)
+
+    journal, plan = open_journal(path, catalog, [], snapshot)
+    assert ids(plan) == [0, 1]
+    assert journal.has_applied("t0") and journal.has_applied("t1")
+    close(journal)
@@ -0,0 +1,71 @@
+import os
+from common import task_catalog
+from common.task_catalog import append_catalog, append_path, load_catalog, save_catalog
+
+
+def make_tasks(start, count):
+    return [{"name": f"task{i}", "time": i + 1, "specializations": ["A"]} for i in range(start, start + count)]
+
+
+def reload(path):
+    """Каталог, каким его прочитает новый процесс"""
+    task_catalog._catalogs.pop(os.path.abspath(path), None)
+    return load_catalog(path)
+
+
+def names(catalog):
+    return [task["name"] for task in catalog.tasks]
+
+
+def test_append_and_reload(tmp_path):
+    path = str(tmp_path / "catalog.json")
+    catalog = save_catalog(path, make_tasks(0, 3))
+    added = append_catalog(path, catalog, make_tasks(3, 2), {"a.jsonl": 10})
+    append_catalog(path, catalog, make_tasks(5, 1), {"a.jsonl": 20})
+    assert [task["id"] for task in added] == [3, 4]
+
+    loaded = reload(path)
+    assert names(loaded) == names(catalog) == [f"task{i}" for i in range(6)]
+    assert [task["id"] for task in loaded.tasks] == list(range(6))
+    assert loaded.inbox_offsets == {"a.jsonl": 20}
+
+
+def test_load_reads_only_new_records(tmp_path):
+    path = str(tmp_path / "catalog.json")
+    writer = save_catalog(path, make_tasks(0, 2))
+    reader = reload(path)
+    first = reader.tasks[0]
+    append_catalog(path, writer, make_tasks(2, 2))
+
+    # Тот же объект каталога: ссылки на прежние задачи остаются действительными
+    assert load_catalog(path) is reader
+    assert reader.tasks[0] is first
+    assert names(reader) == [f"task{i}" for i in range(4)]
+    assert reader.appended_bytes == writer.appended_bytes
+
+
+def test_torn_record_is_ignored_and_overwritten(tmp_path):
+    path = str(tmp_path / "catalog.json")
+    catalog = save_catalog(path, make_tasks(0, 1))
+    append_catalog(path, catalog, make_tasks(1, 1), {"a.jsonl": 5})
+    with open(append_path(path), 'ab') as f:
+        f.write(b'{"tasks":[{"name":"torn"')
+
+    loaded = reload(path)
+    assert names(loaded) == ["task0", "task1"]
+    assert loaded.inbox_offsets == {"a.jsonl": 5}
+
+    append_catalog(path, loaded, make_tasks(2, 1), {"a.jsonl": 9})
+    assert names(reload(path)) == ["task0", "task1", "task2"]
+
+
+def test_save_catalog_drops_appended(tmp_path):
+    path = str(tmp_path / "catalog.json")
+    catalog = save_catalog(path, make_tasks(0, 1))
+    append_catalog(path, catalog, make_tasks(1, 1), {"a.jsonl": 5})
+    save_catalog(path, make_tasks(10, 2))
+
+    loaded = reload(path)
+    assert not os.path.exists(append_path(path))
+    assert names(loaded) == ["task10", "task11"]
+    assert loaded.inbox_offsets is None